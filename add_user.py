@@ -1,6 +1,8 @@
-from app import app
+from app import create_app
 from models import db, User
 
+app = create_app()
+
 with app.app_context():
     new_user = User(username='geoff', email='geoff@example.com')
     new_user.set_password('securepassword123')
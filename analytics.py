@@ -0,0 +1,276 @@
+import atexit
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+import database
+import repository
+
+# Seller analytics for /dashboard: listing views and buyer inquiries.
+# Counting a view with a write on every /item/<id> hit would put the
+# database write lock on the hottest read path. Instead each worker process
+# adds events to an in-memory buffer of counters, and a background thread
+# writes the buffer out every ANALYTICS_FLUSH_SECONDS in one transaction,
+# as upserts into the analytics_hourly and analytics_daily rollups:
+#   - the buffer holds at most ANALYTICS_BUFFER_KEYS (seller, listing, hour)
+#     counters; events that would need a new one past that are dropped
+#     (and counted), never queued;
+#   - a crash loses at most one flush interval of events; a clean stop
+#     (SIGTERM under gunicorn, interpreter exit) flushes what is left;
+#   - hourly rows are kept for HOURLY_RETENTION_DAYS, daily rows for good.
+# Buckets are local time, like message timestamps: "2025-06-01T14" and
+# "2025-06-01".
+
+DEFAULT_FLUSH_SECONDS = 5
+DEFAULT_BUFFER_KEYS = 10_000
+HOURLY_RETENTION_DAYS = 2
+DASHBOARD_DAYS = 30
+DASHBOARD_HOURS = 24
+
+
+def hour_bucket(when):
+    return when.strftime("%Y-%m-%dT%H")
+
+
+def day_bucket(when):
+    return when.strftime("%Y-%m-%d")
+
+
+class Recorder:
+    def __init__(self, engine, flush_seconds=DEFAULT_FLUSH_SECONDS, max_keys=DEFAULT_BUFFER_KEYS):
+        self.engine = engine
+        self.flush_seconds = flush_seconds
+        self.max_keys = max_keys
+        # (seller_id, product_id, hour) -> [views, inquiries]
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._pruned_before = None
+        self.recorded = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failures = 0
+        thread = threading.Thread(target=self._run, name="analytics-flush", daemon=True)
+        thread.start()
+
+    def record(self, seller_id, product_id, views=0, inquiries=0, when=None):
+        key = (seller_id, product_id, hour_bucket(when or datetime.now()))
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                if len(self._counts) >= self.max_keys:
+                    self.dropped += 1
+                    # Flush early rather than keep dropping until the next tick
+                    self._wake.set()
+                    return False
+                counts = self._counts[key] = [0, 0]
+            counts[0] += views
+            counts[1] += inquiries
+            self.recorded += 1
+        return True
+
+    def flush(self):
+        """Write the buffered counters to the rollups; returns how many were written."""
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, {}
+            if not counts:
+                return 0
+            hourly, daily = [], {}
+            for (seller_id, product_id, hour), (views, inquiries) in counts.items():
+                hourly.append({"seller_id": seller_id, "bucket": hour, "product_id": product_id,
+                               "views": views, "inquiries": inquiries})
+                day = daily.setdefault((seller_id, hour[:10], product_id), [0, 0])
+                day[0] += views
+                day[1] += inquiries
+            daily = [{"seller_id": seller_id, "bucket": day, "product_id": product_id,
+                      "views": views, "inquiries": inquiries}
+                     for (seller_id, day, product_id), (views, inquiries) in daily.items()]
+            try:
+                with self.engine.connect() as conn:
+                    repository.add_activity(conn, hourly, daily)
+                    self._prune(conn)
+            except (SQLAlchemyError, sqlite3.Error) as e:
+                print("Analytics flush error:", e)
+                self.failures += 1
+                self._restore(counts)
+                return 0
+            self.flushes += 1
+            return len(counts)
+
+    def _restore(self, counts):
+        # Put a batch that could not be written back, within the bound
+        with self._lock:
+            for key, (views, inquiries) in counts.items():
+                current = self._counts.get(key)
+                if current is None:
+                    if len(self._counts) >= self.max_keys:
+                        self.dropped += 1
+                        continue
+                    current = self._counts[key] = [0, 0]
+                current[0] += views
+                current[1] += inquiries
+
+    def _prune(self, conn):
+        # Once an hour, drop hourly rows past their retention
+        before = hour_bucket(datetime.now() - timedelta(days=HOURLY_RETENTION_DAYS))
+        if before != self._pruned_before:
+            repository.prune_hourly_activity(conn, before)
+            self._pruned_before = before
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._counts)
+        return {
+            "pending": pending,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failures": self.failures,
+        }
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder(app=None):
+    # One buffer and flush thread per worker process, started after the fork
+    app = app or current_app
+    key = os.getpid()
+    recorder = _recorders.get(key)
+    if recorder is None:
+        with _recorders_lock:
+            recorder = _recorders.get(key)
+            if recorder is None:
+                recorder = Recorder(database.get_engine(app),
+                                    flush_seconds=app.config["ANALYTICS_FLUSH_SECONDS"],
+                                    max_keys=app.config["ANALYTICS_BUFFER_KEYS"])
+                _recorders[key] = recorder
+    return recorder
+
+
+@atexit.register
+def _flush_at_exit():
+    recorder = _recorders.get(os.getpid())
+    if recorder is not None:
+        recorder.close()
+
+
+def record_view(item, viewer_id):
+    # A seller looking at their own listing is not a view
+    if item["seller_id"] and item["seller_id"] != viewer_id:
+        get_recorder().record(item["seller_id"], item["id"], views=1)
+
+
+def record_inquiry(item_id, seller_id, sender_id):
+    # Only a buyer's message counts, not the seller's replies
+    if seller_id and seller_id != sender_id:
+        get_recorder().record(seller_id, item_id, inquiries=1)
+
+
+def dashboard(rows, now=None):
+    """Shape activity_series() rows for the dashboard.
+
+    Returns {"hours": [(hour, views, inquiries)] for the last
+    DASHBOARD_HOURS, "days": the same per day for the last DASHBOARD_DAYS,
+    "products": {product id: (views, inquiries)} over those days,
+    "views"/"inquiries": the totals}, oldest first with empty buckets as 0.
+    """
+    now = now or datetime.now()
+    hours = {hour_bucket(now - timedelta(hours=n)): [0, 0] for n in range(DASHBOARD_HOURS - 1, -1, -1)}
+    days = {day_bucket(now - timedelta(days=n)): [0, 0] for n in range(DASHBOARD_DAYS - 1, -1, -1)}
+    products = {}
+    for grain, bucket, product_id, views, inquiries in rows:
+        series = hours if grain == "hour" else days
+        if bucket not in series:
+            continue
+        series[bucket][0] += views
+        series[bucket][1] += inquiries
+        if grain == "day":
+            totals = products.setdefault(product_id, [0, 0])
+            totals[0] += views
+            totals[1] += inquiries
+    return {
+        "hours": [(hour, *counts) for hour, counts in hours.items()],
+        "days": [(day, *counts) for day, counts in days.items()],
+        "products": {product_id: tuple(counts) for product_id, counts in products.items()},
+        "views": sum(counts[0] for counts in days.values()),
+        "inquiries": sum(counts[1] for counts in days.values()),
+    }
+
+
+def dashboard_since(now=None):
+    # (since_hour, since_day) bounds for activity_series()
+    now = now or datetime.now()
+    return (hour_bucket(now - timedelta(hours=DASHBOARD_HOURS - 1)),
+            day_bucket(now - timedelta(days=DASHBOARD_DAYS - 1)))
+
+
+# SQL equivalents of hour_bucket() / day_bucket() for a message timestamp.
+# strftime() reads both datetime.isoformat() and the older
+# 'YYYY-MM-DD HH:MM:SS' form, and is NULL for anything else.
+HOUR_BUCKET_SQL = "strftime('%Y-%m-%dT%H', {column})"
+DAY_BUCKET_SQL = "strftime('%Y-%m-%d', {column})"
+
+
+def rebuild_inquiries(conn):
+    # Recount inquiries from the messages table (buyers' messages about a
+    # listing); views cannot be recovered and are kept. Needs the user id
+    # columns filled (migrations.backfill_user_ids() calls it once they
+    # are). Does not commit.
+    since_hour = hour_bucket(datetime.now() - timedelta(days=HOURLY_RETENTION_DAYS))
+    hour = HOUR_BUCKET_SQL.format(column="m.timestamp")
+    for table, bucket, where in (("analytics_daily", DAY_BUCKET_SQL.format(column="m.timestamp"), ""),
+                                 ("analytics_hourly", hour, f"AND {hour} >= :since_hour")):
+        conn.execute(f"UPDATE {table} SET inquiries = 0")
+        conn.execute(f"""
+            INSERT INTO {table} (seller_id, bucket, product_id, inquiries)
+            SELECT p.seller_id, {bucket}, m.item_id, COUNT(*)
+            FROM messages m
+            JOIN products p ON p.id = m.item_id
+            WHERE p.seller_id IS NOT NULL AND m.sender_id IS NOT p.seller_id
+              AND {bucket} IS NOT NULL {where}
+            GROUP BY 1, 2, 3
+            ON CONFLICT (seller_id, bucket, product_id) DO UPDATE SET inquiries = excluded.inquiries
+        """, {"since_hour": since_hour})
+        conn.execute(f"DELETE FROM {table} WHERE views = 0 AND inquiries = 0")
+
+
+def init_app(app):
+    app.config.setdefault("ANALYTICS_FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS)
+    app.config.setdefault("ANALYTICS_BUFFER_KEYS", DEFAULT_BUFFER_KEYS)
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+
+    db_path = "marketplace.db"
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        if sys.argv[1:] == ["rebuild"]:
+            rebuild_inquiries(conn)
+            conn.commit()
+            print("✅ Recounted inquiries from the messages table.")
+        else:
+            print("Usage: python analytics.py rebuild")
+    finally:
+        conn.close()
@@ -1,44 +1,284 @@
-from flask import Flask, render_template, request, redirect, session, flash, jsonify, url_for
-from werkzeug.security import check_password_hash
-from werkzeug.utils import secure_filename
-from models import db, User, Item
+from flask import Flask, Response, current_app, render_template, request, redirect, session, flash, jsonify, url_for
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from models import db, User, current_user_id
+import database
+import migrations
+import repository
+import search
+import events
+import images
+import assets
+import cache
+import metrics
+import passwords
+import bulk
+import facets
+import analytics
+import archive
+import writer
+import geo
+import similar
+import streaming
+import csv
+import io
+import json
+import math
 import os
-import sqlite3
+from database import get_connection, get_db
+from inbox import (INBOX_PAGE_SIZE, archived_thread_token, conversation_page, decode_position,
+                   publish_message, publish_read, thread_page)
+from routes.api import api_routes
+from pagination import SORTS, decode_cursor, encode_cursor, encode_token
 from datetime import datetime
 
-app = Flask(__name__)
-app.secret_key = "super_secret_key_123"
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///marketplace.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
-
-# Image upload configuration
-UPLOAD_FOLDER = 'static/uploads'
+# Accounts per /users page
+USERS_PAGE_SIZE = 100
+MAX_USERS_PAGE_SIZE = 1000
+
+# Radius choices offered next to near= on /items (any radius= up to geo.MAX_RADIUS_KM works)
+RADIUS_CHOICES_KM = (0.5, 1.0, 2.0, 5.0)
+
+# Views are collected by @route and added to each app by create_app()
+_routes = []
+
+def route(rule, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
+
+def metric_gauges():
+    # Point-in-time numbers added to /metrics next to the histograms
+    pool = database.pool_stats(current_app)
+    catalog_cache = cache.get_cache().stats()
+    hashing = passwords.get_guard().stats()
+    activity = analytics.get_recorder().stats()
+    writes = writer.get_writer().stats()
+    gauges = [
+        ("marketplace_db_pool_open", "Open pooled SQLite connections.", pool["open"]),
+        ("marketplace_db_pool_idle", "Idle pooled SQLite connections.", pool["idle"]),
+        ("marketplace_db_pool_checked_out", "Pooled SQLite connections in use.", pool["checked_out"]),
+        ("marketplace_cache_hits_total", "Catalog cache hits.", catalog_cache["hits"]),
+        ("marketplace_cache_misses_total", "Catalog cache misses.", catalog_cache["misses"]),
+        ("marketplace_event_connections", "Open event streams and long polls.",
+         events.get_hub().stats()["connections"]),
+        ("marketplace_event_streams", "Open event streams.", events.get_hub().stats()["streams"]),
+        ("marketplace_event_publish_failures_total", "Events that could not be published.",
+         events.get_hub().stats()["publish_failures"]),
+        ("marketplace_password_hash_pending", "Password hashes queued or running.", hashing["pending"]),
+        ("marketplace_password_hash_rejected_total", "Hashes refused because the pool was full.",
+         hashing["rejected"]),
+        ("marketplace_password_rehashed_total", "Logins that upgraded a stored hash.", hashing["rehashed"]),
+        ("marketplace_auth_throttled_total", "Login/register attempts refused by rate limits.",
+         hashing["throttled_ip"] + hashing["throttled_account"]),
+        ("marketplace_analytics_pending", "Analytics counters waiting for the next flush.",
+         activity["pending"]),
+        ("marketplace_analytics_dropped_total", "Analytics events dropped because the buffer was full.",
+         activity["dropped"]),
+        ("marketplace_analytics_flush_failures_total", "Analytics flushes that failed and were retried.",
+         activity["failures"]),
+        ("marketplace_message_writer_queued", "Message writes waiting for the next group commit.",
+         writes["queued"]),
+        ("marketplace_message_writer_writes_total", "Message writes committed by the writer.",
+         writes["writes"]),
+        ("marketplace_message_writer_commits_total", "Group commits made by the writer.", writes["batches"]),
+        ("marketplace_message_writer_rejected_total", "Message writes refused with a 503.",
+         writes["rejected"]),
+    ]
+    maintainer = archive.get_maintainer()
+    if maintainer is not None:
+        archived = maintainer.stats()
+        gauges += [
+            ("marketplace_archived_threads_total", "Message threads moved to the archive by this worker.",
+             archived["threads"]),
+            ("marketplace_archive_failures_total", "Maintenance runs that failed.", archived["failures"]),
+        ]
+    refresher = similar.get_refresher()
+    if refresher is not None:
+        lists = refresher.stats()
+        gauges += [
+            ("marketplace_similar_refreshed_total", "Listings whose similar items this worker recomputed.",
+             lists["refreshed"]),
+            ("marketplace_similar_rebuilds_total", "Full rebuilds of the similar items run by this worker.",
+             lists["rebuilds"]),
+            ("marketplace_similar_refresh_failures_total", "Similar items refreshes that failed.",
+             lists["failures"]),
+        ]
+    return gauges
+
+def check_session():
+    # Resolve an old username-only session before any view reads it, so a
+    # deleted account is signed out and every view's login check applies
+    if "username" in session and "user_id" not in session:
+        current_user_id()
+
+def create_app(config=None):
+    """Build the app; `config` overrides the defaults and environment.
+
+    Applies pending migrations, so under gunicorn (preload_app) they run
+    once in the master instead of racing in every worker.
+    """
+    app = Flask(__name__)
+    # Every worker has to sign sessions with the same key: set SECRET_KEY
+    # in production
+    app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "super_secret_key_123")
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Every pooled connection times its statements for /metrics
+    app.config["DB_CONNECTION_FACTORY"] = metrics.InstrumentedConnection
+    app.config.update(config or {})
+
+    database.init_app(app, db)
+    events.init_app(app)
+    images.init_app(app)
+    assets.init_app(app)
+    cache.init_app(app)
+    passwords.init_app(app)
+    analytics.init_app(app)
+    writer.init_app(app)
+    archive.init_app(app)
+    similar.init_app(app)
+    migrations.migrate(app.config["DATABASE"])
+    streaming.init_app(app)
+    metrics.init_app(app, gauges=metric_gauges)
+    app.before_request(check_session)
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_blueprint(api_routes)
+    # Behind a reverse proxy (Render) the client's address is in
+    # X-Forwarded-For; trust as many hops as there are proxies, or the
+    # per-IP login limits throttle everyone as the proxy
+    hops = app.config.setdefault("PROXY_FIX_HOPS", int(os.environ.get("PROXY_FIX_HOPS", 0)))
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    return app
+
+def warm_up(app):
+    """Per-process setup for a freshly started worker, before it takes traffic.
+
+    Starts the hashing pool while the process has few threads, opens every
+    pooled connection, and compiles the hot statements and templates.
+    """
+    with app.app_context():
+        passwords.get_guard(app)
+        events.get_hub(app)
+        cache.get_cache(app)
+        analytics.get_recorder(app)
+        writer.get_writer(app)
+        archive.get_maintainer(app)
+        similar.get_refresher(app)
+        database.fill_pool(app)
+        conn = get_connection()
+        for sort_option in (None, *SORTS):
+            if sort_option not in ("relevance", "nearest"):
+                repository.list_products(conn, sort_option=sort_option, limit=1)
+        repository.list_products(conn, sort_option="nearest", limit=1,
+                                 near=(0.0, 0.0, geo.DEFAULT_RADIUS_KM))
+        repository.list_products(conn, match=search.match_expression("warm"), sort_option="relevance",
+                                 limit=1)
+        repository.count_products(conn)
+        repository.place_names(conn)
+        repository.facet_counts(conn)
+        repository.conversations_for(conn, 0, limit=1)
+        repository.similar_listings(conn, 0)
+        for template in ("items.html", "_item_list.html", "item_detail.html", "_item_info.html",
+                         "_similar_items.html", "inbox.html", "dashboard.html"):
+            app.jinja_env.get_template(template)
+
+def shut_down(app):
+    # Graceful stop: end open event streams (clients reconnect to another
+    # worker) so in-flight requests can finish within the grace period, and
+    # write out the buffered analytics; a maintenance run stops after its
+    # current batch, and queued similar items wait for the next worker
+    events.get_hub(app).close()
+    analytics.get_recorder(app).flush()
+    maintainer = archive.get_maintainer(app)
+    if maintainer is not None:
+        maintainer.close()
+    refresher = similar.get_refresher(app)
+    if refresher is not None:
+        refresher.close()
+
+# Image upload configuration (storage limits and variants live in images.py)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route("/")
+def refresh_similar():
+    # Triggers have queued the changed listings (and, after a delete, the
+    # lists it left); score them now rather than at the refresher's next poll
+    refresher = similar.get_refresher()
+    if refresher is not None:
+        refresher.wake()
+
+def price_arg(name):
+    # A price range bound from the query string; None if missing or invalid
+    value = request.args.get(name, type=float)
+    if value is None or not math.isfinite(value) or value < 0:
+        return None
+    return value
+
+def near_arg(conn, catalog_cache, catalog_version):
+    """(place name, (latitude, longitude, radius km)) for near= and radius=.
+
+    (None, None) without near=; (near, None) for a place the gazetteer
+    doesn't know.
+    """
+    place = (request.args.get("near") or "").strip()
+    if not place:
+        return None, None
+    found = catalog_cache.get_or_set(("place", catalog_version, place.lower()),
+                                     lambda: repository.resolve_place(conn, place))
+    if found is None:
+        return place, None
+    radius = request.args.get("radius", type=float)
+    if radius is None or not math.isfinite(radius) or radius <= 0:
+        radius = geo.DEFAULT_RADIUS_KM
+    name, latitude, longitude = found
+    return name, (latitude, longitude, min(radius, geo.MAX_RADIUS_KM))
+
+@route("/")
 def home():
     return render_template("home.html")
 
-@app.route("/users")
+@route("/users")
 def get_users():
-    users = User.query.all()
-    user_list = [
-        {
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "created_at": user.created_at.isoformat()
-        }
-        for user in users
-    ]
-    return jsonify(user_list)
-
-@app.route("/register", methods=["GET", "POST"])
+    # Accounts by id, one page at a time (?after=<last id seen>&limit=N),
+    # with a Link header to the next page; the JSON array is written
+    # straight from the cursor
+    after = request.args.get("after", 0, type=int)
+    limit = max(1, min(request.args.get("limit", USERS_PAGE_SIZE, type=int), MAX_USERS_PAGE_SIZE))
+
+    # As with /items/export, the stream holds its own pooled connection
+    connection = database.connect(current_app)
+    try:
+        next_after = repository.next_users_page(connection, after, limit)
+    except Exception:
+        connection.close()
+        raise
+
+    def stream():
+        try:
+            yield "["
+            for n, user in enumerate(repository.users_page(connection, after, limit)):
+                yield ("," if n else "") + json.dumps({
+                    "id": user.id,
+                    "username": user.username,
+                    "email": user.email,
+                    "created_at": user.created_at.isoformat() if user.created_at else None,
+                })
+            yield "]"
+        finally:
+            connection.close()
+
+    headers = {}
+    if next_after is not None:
+        headers["Link"] = f'<{url_for("get_users", after=next_after, limit=limit)}>; rel="next"'
+    return Response(stream(), mimetype="application/json", headers=headers)
+
+@route("/register", methods=["GET", "POST"])
+@passwords.protect("register.html")
 def register_user():
     if request.method == "GET":
         return render_template("register.html")
@@ -67,7 +307,8 @@ def register_user():
     flash("Registration successful! Please log in.", "success")
     return redirect("/login")
 
-@app.route("/login", methods=["GET", "POST"])
+@route("/login", methods=["GET", "POST"])
+@passwords.protect("login.html")
 def login():
     if request.method == "GET":
         return render_template("login.html")
@@ -76,26 +317,46 @@ def login():
     password = request.form.get("password")
 
     user = User.query.filter_by(email=email).first()
-
-    if user and check_password_hash(user.password_hash, password):
+    valid, new_hash = passwords.verify_password(user.password_hash, password) if user else (False, None)
+
+    if valid:
+        if new_hash:
+            # Stored with older hash parameters: upgrade it now that we
+            # know the password
+            user.password_hash = new_hash
+            db.session.commit()
         session["username"] = user.username
+        session["user_id"] = user.id
         flash("Logged in successfully!", "success")
         return redirect("/items")
     else:
         flash("Invalid email or password", "danger")
         return render_template("login.html")
 
-@app.route("/logout", methods=["POST"])
+@route("/logout", methods=["POST"])
 def logout():
     session.clear()
     flash("You’ve been logged out.", "info")
     return redirect("/login")
 
-@app.route("/about")
+@route("/pool-stats")
+def get_pool_stats():
+    # Internals: behind the same token as /metrics
+    if not metrics.authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(database.pool_stats(current_app))
+
+@route("/cache-stats")
+def get_cache_stats():
+    if not metrics.authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(cache.get_cache().stats())
+
+@route("/about")
 def about():
     return "This is a student-built backend for YU Marketplace."
 
-@app.route("/items")
+@route("/items")
 def get_items():
     if "username" not in session:
         flash("Please log in to view products.", "warning")
@@ -103,100 +364,214 @@ def get_items():
 
     category = request.args.get("category")
     search_query = request.args.get("search")
-    sort_option = request.args.get("sort")
-    page = int(request.args.get("page", 1))
+    match = search.match_expression(search_query)
+    min_price = price_arg("min_price")
+    max_price = price_arg("max_price")
     per_page = 10
-    offset = (page - 1) * per_page
-
-    conn = sqlite3.connect("marketplace.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    base_query = """SELECT id, product_name, price, category, image_url, seller, 
-                           location, description, timestamp FROM products"""
-    filters = []
-    params = []
-
-    if category:
-        filters.append("LOWER(category) = ?")
-        params.append(category.lower())
-
-    if search_query:
-        filters.append("(LOWER(product_name) LIKE ? OR LOWER(seller) LIKE ?)")
-        search_term = f"%{search_query.lower()}%"
-        params.extend([search_term, search_term])
-
-    query = base_query
-    if filters:
-        query += " WHERE " + " AND ".join(filters)
-
-    if sort_option == "newest":
-        query += " ORDER BY timestamp DESC"
-    elif sort_option == "price_asc":
-        query += " ORDER BY price ASC"
-    elif sort_option == "price_desc":
-        query += " ORDER BY price DESC"
-    elif sort_option == "category":
-        query += " ORDER BY category ASC"
-
-    query += " LIMIT ? OFFSET ?"
-    params.extend([per_page, offset])
-
-    cursor.execute(query, params)
-    items = cursor.fetchall()
-
-    count_query = "SELECT COUNT(*) FROM products"
-    if filters:
-        count_query += " WHERE " + " AND ".join(filters)
-    cursor.execute(count_query, params[:-2])  # exclude LIMIT/OFFSET
-    total_items = cursor.fetchone()[0]
-    conn.close()
-
-    total_pages = (total_items + per_page - 1) // per_page
-
-    return render_template("items.html", items=items, selected_category=category,
-                           current_page=page, total_pages=total_pages)
-
-@app.route("/item/<int:item_id>")
+
+    conn = get_connection()
+    catalog_cache = cache.get_cache()
+    # Listing pages depend only on shared catalog data; the generation
+    # changes whenever a product is added, edited or deleted.
+    catalog_version = cache.generations(get_db(), "catalog")
+    place, near = near_arg(conn, catalog_cache, catalog_version)
+    if place and near is None:
+        flash(f"Unknown place “{place}”: showing listings everywhere.", "warning")
+
+    sort_option = request.args.get("sort")
+    if (sort_option not in SORTS or (sort_option == "relevance" and not match)
+            or (sort_option == "nearest" and not near)):
+        sort_option = None
+    if not sort_option:
+        sort_option = "relevance" if match else "nearest" if near else None
+
+    # Keyset pagination: `after` / `before` carry the (sort key, id) of the
+    # last / first row of the neighbouring page.
+    after = decode_cursor(request.args.get("after"), sort_option)
+    before = None if after else decode_cursor(request.args.get("before"), sort_option)
+    backwards = before is not None
+
+    def load_page():
+        # Fetch one extra row to know whether another page exists
+        items = repository.list_products(conn, category, match, sort_option, after or before,
+                                         backwards, limit=per_page + 1,
+                                         min_price=min_price, max_price=max_price, near=near)
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+
+        next_cursor = prev_cursor = None
+        if items:
+            if has_more or backwards:
+                next_cursor = encode_cursor(sort_option, items[-1])
+            if after or (backwards and has_more):
+                prev_cursor = encode_cursor(sort_option, items[0])
+
+        highlights = repository.highlights(conn, match, [item["id"] for item in items]) if match else {}
+
+        # Shared markup only: owner controls are filled in per user below
+        fragment = render_template("_item_list.html", items=items, highlights=highlights)
+        return {"items": items, "next_cursor": next_cursor, "prev_cursor": prev_cursor,
+                "fragment": fragment}
+
+    def count_items():
+        return repository.count_products(conn, category, match, min_price, max_price, near)
+
+    def load_facets():
+        # A few dozen rollup rows, however many listings there are
+        return [tuple(row) for row in repository.facet_counts(conn)]
+
+    filter_key = (catalog_version, category and category.lower(), match, min_price, max_price, near)
+    page = catalog_cache.get_or_set(("items",) + filter_key + (sort_option, after, before), load_page,
+                                  ttl=cache.fragment_ttl)
+    total_items = catalog_cache.get_or_set(("item_count",) + filter_key, count_items)
+    item_list = cache.fill_owner_controls(page["fragment"], page["items"], current_user_id())
+    categories, price_buckets = facets.summarize(
+        catalog_cache.get_or_set(("facets", catalog_version), load_facets), category)
+
+    page_args = {key: value for key, value in
+                 (("category", category), ("search", search_query), ("sort", sort_option),
+                  ("min_price", min_price is not None and request.args["min_price"]),
+                  ("max_price", max_price is not None and request.args["max_price"]),
+                  ("near", near and place), ("radius", near and request.args.get("radius"))) if value}
+
+    # One link per price bucket, keeping the other filters; a bucket's
+    # upper edge belongs to the next bucket
+    range_args = {key: value for key, value in page_args.items()
+                  if key not in ("min_price", "max_price")}
+    price_links = []
+    for bucket, low, high, count in price_buckets:
+        args = dict(range_args, min_price=low)
+        if high is not None:
+            args["max_price"] = round(high - 0.01, 2)
+        active = min_price == low and max_price == args.get("max_price")
+        price_links.append((low, high, count, url_for("get_items", **args), active))
+
+    return streaming.stream_template("items.html", items=page["items"], item_list=item_list,
+                           selected_category=category, categories=categories,
+                           price_links=price_links, min_price=min_price, max_price=max_price,
+                           next_cursor=page["next_cursor"], prev_cursor=page["prev_cursor"],
+                           total_items=total_items, page_args=page_args, searching=bool(match),
+                           place=place if near else None, radius=near[2] if near else None,
+                           radius_choices=RADIUS_CHOICES_KM,
+                           places=catalog_cache.get_or_set(("places", catalog_version),
+                                                           lambda: repository.place_names(conn)))
+
+@route("/items/suggest")
+def suggest_items():
+    if "username" not in session:
+        return jsonify([]), 401
+    return jsonify(repository.suggest(get_connection(), request.args.get("q", "")))
+
+@route("/items/import", methods=["POST"])
+def import_items():
+    # Bulk upload of the signed-in user's listings: a multipart "file"
+    # field or the raw request body, as CSV or NDJSON
+    if "username" not in session:
+        return jsonify({"error": "Login required"}), 401
+
+    upload = request.files.get("file")
+    source = upload.stream if upload else request.stream
+    fmt = request.args.get("format") or bulk.format_for(
+        upload.filename if upload else request.mimetype)
+    if fmt not in bulk.FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    # Jobs are per user so one seller cannot resume (or block) another's
+    job = request.values.get("job")
+    if job:
+        job = f"{current_user_id()}:{job}"
+    text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    try:
+        summary = bulk.import_rows(get_db(), bulk.read_rows(text, fmt), job=job,
+                                   seller=session["username"],
+                                   restart=request.values.get("restart") == "1")
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": f"Could not read the file: {e}"}), 400
+    refresh_similar()
+    return jsonify(summary)
+
+@route("/items/export")
+def export_items():
+    if "username" not in session:
+        return jsonify({"error": "Login required"}), 401
+
+    fmt = request.args.get("format", "csv")
+    if fmt not in bulk.FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+    seller = session["username"] if request.args.get("mine") == "1" else None
+    category = request.args.get("category")
+
+    # The response outlives the request context, so the stream holds its
+    # own pooled connection and hands it back when the client is done
+    connection = database.connect(current_app)
+
+    def stream():
+        try:
+            yield from bulk.export_rows(repository.dbapi(connection), fmt, category=category,
+                                        seller=seller)
+        finally:
+            connection.close()
+
+    return Response(stream(), mimetype=bulk.MIME_TYPES[fmt],
+                    headers={"Content-Disposition": f"attachment; filename=products.{fmt}"})
+
+@route("/item/<int:item_id>")
 def view_item(item_id):
     if "username" not in session:
         flash("Please log in to view product details.", "warning")
         return redirect("/login")
 
-    conn = sqlite3.connect("marketplace.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    conn = get_connection()
+
+    # The product row and its rendered details (with the precomputed
+    # similar listings) are shared by every viewer and cached until the
+    # item or its list changes, or every list is rebuilt
+    def load_item():
+        row = repository.get_product(conn, item_id)
+        if not row:
+            return {"item": None}
+        similar_items = repository.similar_listings(conn, item_id)
+        return {"item": row, "fragment": render_template("_item_info.html", item=row,
+                                                         similar_items=similar_items)}
 
-    # Fetch the item
-    cursor.execute("SELECT * FROM products WHERE id = ?", (item_id,))
-    item = cursor.fetchone()
+    version = cache.generations(get_db(), f"item:{item_id}", "similar")
+    cached = cache.get_cache().get_or_set(("item", item_id, version), load_item,
+                                          ttl=cache.fragment_ttl)
+    item = cached["item"]
 
     if not item:
-        conn.close()
         flash("Product not found.", "danger")
         return redirect("/items")
 
-    # Fetch messages where current user is sender or receiver
-    cursor.execute("""
-        SELECT * FROM messages
-        WHERE item_id = ?
-        AND (sender = ? OR receiver = ?)
-        ORDER BY timestamp ASC
-    """, (item_id, session['username'], session['username']))
-    messages = cursor.fetchall()
+    # Latest page of the buyer's thread with the seller; older messages
+    # are loaded on demand from /inbox/thread
+    messages, older_cursor = [], None
+    user_id = current_user_id()
+    # Buffered in memory; no write on this path
+    analytics.record_view(item, user_id)
+    if item["seller_id"] and item["seller_id"] != user_id:
+        messages, older_cursor = thread_page(conn, item_id, user_id, item["seller_id"])
 
-    conn.close()
+        # Opening the item page reads the buyer's thread with the seller
+        unread = repository.unread_count(conn, item_id, user_id, item["seller_id"])
+        read_threads = [(item_id, item["seller_id"], unread)]
+        if writer.mark_read(user_id, read_threads):
+            publish_read(user_id, read_threads)
 
-    return render_template("item_detail.html", item=item, messages=messages)
+    return render_template("item_detail.html", item=item, item_info=Markup(cached["fragment"]),
+                           messages=messages, older_cursor=older_cursor)
 
 
-@app.route("/add", methods=["GET", "POST"])
+@route("/add", methods=["GET", "POST"])
 def add_product():
     if "username" not in session:
         flash("Please log in to upload products.", "warning")
         return redirect("/login")
 
     if request.method == "POST":
+        images.limit_upload(request)
         name = request.form['product_name']
         price = request.form['price']
         category = request.form['category']
@@ -208,194 +583,264 @@ def add_product():
         file = request.files.get('image')
         image_url = None
 
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            image_url = url_for('static', filename='uploads/' + filename)
-
         if not name or not price:
             flash("Missing product name or price", "danger")
             return render_template("add.html")
 
-        conn = sqlite3.connect("marketplace.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO products 
-               (product_name, price, category, image_url, seller, location, description, timestamp) 
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-            (name, price, category, image_url, seller, location, description, timestamp)
-        )
-        conn.commit()
-        conn.close()
+        if file and allowed_file(file.filename):
+            # Stored under its content hash; resized variants are generated
+            # in the background
+            try:
+                filename = images.store_upload(file, current_app.config['UPLOAD_PATH'],
+                                               max_bytes=current_app.config['MAX_UPLOAD_BYTES'])
+            except images.UploadRejected as e:
+                flash(str(e), "danger")
+                return render_template("add.html")
+            images.generate_variants_async(filename)
+            image_url = url_for('static', filename='uploads/' + filename)
+
+        repository.add_product(get_connection(), product_name=name, price=price, category=category,
+                               image_url=image_url, seller=seller, seller_id=current_user_id(),
+                               location=location, description=description, timestamp=timestamp)
+        refresh_similar()
         flash("Product uploaded successfully!", "success")
         return redirect("/items")
 
     return render_template("add.html")
 
 
-@app.route("/edit/<int:item_id>", methods=["GET", "POST"])
+@route("/edit/<int:item_id>", methods=["GET", "POST"])
 def edit_item(item_id):
-    conn = sqlite3.connect("marketplace.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    conn = get_connection()
 
     if request.method == "POST":
         new_name = request.form['product_name']
         new_price = request.form['price']
         new_category = request.form['category']
         new_image_url = request.form['image_url']
-        cursor.execute(
-            "UPDATE products SET product_name = ?, price = ?, category = ?, image_url = ? WHERE id = ?",
-            (new_name, new_price, new_category, new_image_url, item_id)
-        )
-        conn.commit()
-        conn.close()
+        repository.update_product(conn, item_id, product_name=new_name, price=new_price,
+                                  category=new_category, image_url=new_image_url)
+        refresh_similar()
         flash("Product updated successfully!", "success")
         return redirect("/items")
 
-    cursor.execute("SELECT product_name, price, category, image_url FROM products WHERE id = ?", (item_id,))
-    item = cursor.fetchone()
-    conn.close()
+    item = repository.product_form(conn, item_id)
     return render_template("edit.html", item=item, item_id=item_id)
 
-@app.route("/delete/<int:item_id>", methods=["POST"])
+@route("/delete/<int:item_id>", methods=["POST"])
 def delete_item(item_id):
-    conn = sqlite3.connect("marketplace.db")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM products WHERE id = ?", (item_id,))
-    conn.commit()
-    conn.close()
+    repository.delete_product(get_connection(), item_id)
+    refresh_similar()
     flash("Product deleted successfully!", "info")
     return redirect("/items")
 
-@app.route("/inbox")
+@route("/inbox")
 def inbox():
     if "username" not in session:
         flash("Please log in to view your inbox.", "warning")
         return redirect("/login")
 
-    conn = sqlite3.connect("marketplace.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    user_id = current_user_id()
+    conn = get_connection()
+
+    # One indexed query over the latest page of per-thread summaries
+    conversations, next_cursor = conversation_page(conn, user_id, request.args.get("before"))
 
-    # Get all messages where user is sender or receiver
-    cursor.execute("""
-        SELECT sender, receiver, products.product_name, content, timestamp, item_id
-        FROM messages
-        JOIN products ON messages.item_id = products.id
-        WHERE sender = ? OR receiver = ?
-        ORDER BY item_id, timestamp ASC
-    """, (session["username"], session["username"]))
-    raw_messages = cursor.fetchall()
+    # Mark only the threads that actually have unread messages as read
+    read_threads = [(c["item_id"], c["other_id"], c["unread"]) for c in conversations]
+    if writer.mark_read(user_id, read_threads):
+        publish_read(user_id, read_threads)
 
-    threads = {}
-    unread_counts = {}
+    return streaming.stream_template("inbox.html", conversations=conversations, next_cursor=next_cursor)
 
-    for sender, receiver, item_name, content, timestamp, item_id in raw_messages:
-        # Skip broken or orphaned rows
-        if not item_id or not item_name or not sender or not receiver:
-            continue
 
-        other = receiver if sender == session["username"] else sender
-        key = (item_id, other, item_name)
+@route("/inbox/archived")
+def archived_inbox():
+    if "username" not in session:
+        flash("Please log in to view your inbox.", "warning")
+        return redirect("/login")
 
-        if key not in threads:
-            threads[key] = []
-            unread_counts[key] = 0
+    # Read from the archive database only when asked for
+    before = decode_position(request.args.get("before"))
+    conversations = archive.get_reader().conversations(current_user_id(), INBOX_PAGE_SIZE + 1, before)
+    next_cursor = None
+    if len(conversations) > INBOX_PAGE_SIZE:
+        conversations = conversations[:INBOX_PAGE_SIZE]
+        last = conversations[-1]
+        next_cursor = encode_token([last["last_timestamp"], last["last_message_id"]])
+    return render_template("inbox.html", conversations=conversations, next_cursor=next_cursor,
+                           archived_token=archived_thread_token())
 
-        threads[key].append((sender, content, timestamp))
 
-        try:
-            if receiver == session["username"]:
-                cursor.execute("""
-                    SELECT COUNT(*) FROM messages
-                    WHERE item_id = ? AND sender = ? AND receiver = ? AND read = 0
-                """, (item_id, other, session["username"]))
-                unread_counts[key] = cursor.fetchone()[0]
-        except Exception as e:
-            print("Unread count error:", e)
-            unread_counts[key] = 0
-
-    # Mark all received messages as read
-    cursor.execute("""
-        UPDATE messages SET read = 1
-        WHERE receiver = ? AND read = 0
-    """, (session["username"],))
-    conn.commit()
-    conn.close()
-
-    return render_template("inbox.html", threads=threads, unread_counts=unread_counts)
-
-
-@app.route("/dashboard")
+@route("/inbox/threads")
+def list_threads():
+    if "username" not in session:
+        return jsonify({"error": "Login required"}), 401
+
+    conversations, next_cursor = conversation_page(get_connection(), current_user_id(),
+                                                   request.args.get("before"))
+    return jsonify({
+        "threads": [
+            {
+                "item_id": c["item_id"],
+                "product_name": c["product_name"],
+                "other_id": c["other_id"],
+                "other_user": c["other_user"],
+                "unread": c["unread"],
+                "last_sender": c["last_sender"],
+                "last_content": c["last_content"],
+                "last_timestamp": c["last_timestamp"],
+            }
+            for c in conversations
+        ],
+        "next": next_cursor,
+    })
+
+
+@route("/inbox/thread/<int:item_id>/<int:other_id>")
+def thread_history(item_id, other_id):
+    if "username" not in session:
+        return jsonify({"error": "Login required"}), 401
+
+    messages, older_cursor = thread_page(get_connection(), item_id, current_user_id(), other_id,
+                                         request.args.get("before"))
+    return jsonify({
+        "messages": [
+            {
+                "id": m["id"],
+                "sender": m["sender"],
+                "sender_id": m["sender_id"],
+                "content": m["content"],
+                "timestamp": m["timestamp"],
+            }
+            for m in messages
+        ],
+        "before": older_cursor,
+    })
+
+
+@route("/dashboard")
 def seller_dashboard():
     if "username" not in session:
         flash("Please log in to view your dashboard.", "warning")
         return redirect("/login")
 
-    seller = session["username"]
-    conn = sqlite3.connect("marketplace.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    # Get seller's products
-    cursor.execute("""
-        SELECT id, product_name, price, category, timestamp
-        FROM products
-        WHERE seller = ?
-        ORDER BY timestamp DESC
-    """, (seller,))
-    products = cursor.fetchall()
-
-    # Get message counts per product
-    cursor.execute("""
-        SELECT item_id, COUNT(*) as message_count
-        FROM messages
-        WHERE receiver = ?
-        GROUP BY item_id
-    """, (seller,))
-    raw_counts = cursor.fetchall()
-    message_counts = {row["item_id"]: row["message_count"] for row in raw_counts}
-
-    conn.close()
-    return render_template("dashboard.html", products=products, message_counts=message_counts)
-
-
-@app.route("/message/<int:item_id>", methods=["POST"])
+    seller_id = current_user_id()
+    conn = get_connection()
+
+    # Views and inquiries from the rollups
+    since_hour, since_day = analytics.dashboard_since()
+    activity = analytics.dashboard(repository.activity_series(conn, seller_id, since_hour, since_day))
+
+    def products():
+        # The seller's listings, read from the cursor as the table is sent,
+        # on the connection checked out inside the stream
+        yield from repository.seller_products(get_connection(), seller_id)
+
+    return streaming.stream_template("dashboard.html", products=products(), activity=activity,
+                                     days=analytics.DASHBOARD_DAYS)
+
+
+@route("/message/<int:item_id>", methods=["POST"])
 def send_message(item_id):
     if "username" not in session:
         flash("Please log in to send messages.", "warning")
         return redirect("/login")
 
     content = request.form.get("content")
-    sender = session["username"]
+    sender = current_user_id()
     timestamp = datetime.now().isoformat()
 
-    conn = sqlite3.connect("marketplace.db")
-    cursor = conn.cursor()
+    conn = get_connection()
 
     # Get the receiver (seller of the item)
-    cursor.execute("SELECT seller FROM products WHERE id = ?", (item_id,))
-    result = cursor.fetchone()
-    if not result:
+    receiver = seller = repository.seller_of(conn, item_id)
+    if receiver is None:
         flash("Product not found.", "danger")
-        conn.close()
         return redirect("/items")
 
-    receiver = result[0]
+    # The seller replies to a buyer who already wrote about this item
+    reply_to = request.form.get("to", type=int)
+    if sender == receiver and reply_to and repository.has_conversation(conn, item_id, sender, reply_to):
+        receiver = reply_to
 
-    # Insert message with read = 0
-    cursor.execute("""
-        INSERT INTO messages (sender, receiver, item_id, content, timestamp, read)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (sender, receiver, item_id, content, timestamp, 0))
+    # Returns once the message is committed, batched with other writers'
+    message_id = writer.send_message(item_id, sender, receiver, content, timestamp)
+    analytics.record_inquiry(item_id, seller, sender)
 
-    conn.commit()
-    conn.close()
+    publish_message(message_id, item_id, sender, session["username"], receiver, content, timestamp)
 
     flash("Message sent to seller!", "success")
     return redirect("/inbox")
 
+@route("/events/stream")
+def event_stream():
+    if "username" not in session:
+        return jsonify({"error": "Login required"}), 401
+
+    user_id = current_user_id()
+    hub = events.get_hub()
+    try:
+        subscription = hub.subscribe(user_id, stream=True)
+    except events.HubFull:
+        # The page falls back to long polling (base.html)
+        return jsonify({"error": "Too many open connections"}), 503, {"Retry-After": "30"}
+
+    unread = repository.total_unread(get_connection(), user_id)
+    heartbeat = current_app.config["EVENT_HEARTBEAT"]
+
+    def stream():
+        try:
+            yield "retry: 5000\n" + events.format_sse({"type": "unread", "total": unread})
+            while True:
+                event = subscription.get(timeout=heartbeat)
+                if subscription.closed:
+                    # The worker is shutting down; the client reconnects
+                    return
+                if event is None:
+                    yield ": heartbeat\n\n"
+                else:
+                    yield events.format_sse(event)
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@route("/events/poll")
+def event_poll():
+    # Long-poll fallback for clients without EventSource support. Each
+    # response carries a cursor for the next poll, so events published
+    # between polls are replayed, and the current unread total
+    if "username" not in session:
+        return jsonify({"error": "Login required"}), 401
+
+    user_id = current_user_id()
+    cursor = request.args.get("cursor")
+    hub = events.get_hub()
+    try:
+        subscription = hub.subscribe(user_id)
+    except events.HubFull:
+        return jsonify({"error": "Too many open connections"}), 503, {"Retry-After": "30"}
+
+    try:
+        # Subscribed first: whatever is not in the buffer yet wakes us up
+        received, cursor = hub.replay(user_id, cursor)
+        # The first poll of a page answers at once, with the unread total
+        if not received and request.args.get("cursor"):
+            timeout = request.args.get("timeout", 25, type=float)
+            if not math.isfinite(timeout):
+                timeout = 25
+            if subscription.get(timeout=max(0, min(timeout, 25))) is not None:
+                # Give events published together a moment to arrive
+                while subscription.get(timeout=0.05) is not None:
+                    pass
+            received, cursor = hub.replay(user_id, cursor)
+    finally:
+        hub.unsubscribe(subscription)
+    return jsonify({"events": received, "cursor": cursor,
+                    "unread": repository.total_unread(get_connection(), user_id)})
+
 if __name__ == "__main__":
-    app.run(debug=True, port=5050)
+    # Development server; production runs under gunicorn (gunicorn.conf.py)
+    create_app().run(debug=True, port=int(os.environ.get("PORT", 5050)))
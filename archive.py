@@ -0,0 +1,542 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from flask import current_app
+
+import messaging
+
+# Message retention and compaction.
+# The messages table only grows, and every message of a thread nobody has
+# touched in months (or of a listing that was deleted) still costs index
+# pages that share the page cache with the inbox queries. The maintenance
+# job moves such threads to a separate archive database, attached to its
+# connection as `archive`:
+#   - a thread is archived once its conversation's last message is older
+#     than ARCHIVE_AFTER_DAYS, or its listing is gone. Threads go in
+#     batches of ARCHIVE_BATCH_THREADS: one transaction copies the batch's
+#     messages into the archive (synchronous=FULL), a second deletes them
+#     from marketplace.db. Across attached WAL databases a single COMMIT
+#     is only atomic per file, so the copy must be durable before anything
+#     is deleted; an interrupted run leaves copies that the next run
+#     overwrites. Messages that arrive in between stay hot;
+#   - archived_threads keeps one tombstone per moved thread, so a thread
+#     page that runs out of hot messages can offer the archived ones;
+#   - after archiving, freed pages are returned to the filesystem a few at
+#     a time with PRAGMA incremental_vacuum (databases created by
+#     migrate() have auto_vacuum=INCREMENTAL; convert an older one once
+#     with `python archive.py vacuum`), and the message tables are
+#     re-ANALYZEd for the planner.
+# Every worker runs a Maintainer thread, but a lease row in
+# maintenance_runs lets only one of them run the job per
+# MAINTENANCE_INTERVAL_SECONDS. Archived threads are read on demand
+# through a read-only connection per process (ArchiveReader), never
+# through the request pool. analytics.py rebuild only recounts inquiries
+# from the messages still in marketplace.db.
+
+DEFAULT_AFTER_DAYS = 180
+DEFAULT_BATCH_THREADS = 200
+DEFAULT_INTERVAL = 24 * 3600
+# How often each worker checks whether the lease is due
+CHECK_SECONDS = 300
+BATCH_PAUSE = 0.05
+VACUUM_PAGES = 1024
+VACUUM_PAUSE = 0.01
+JOB = "message archive"
+
+
+def default_path(database):
+    # marketplace.db -> marketplace-archive.db
+    return os.path.splitext(database)[0] + "-archive.db"
+
+
+def _archive_schema(conn):
+    conn.executescript("""
+        PRAGMA archive.journal_mode=WAL;
+        PRAGMA archive.synchronous=FULL;
+        CREATE TABLE IF NOT EXISTS archive.messages (
+            id INTEGER PRIMARY KEY,
+            item_id INTEGER NOT NULL,
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            sender_id INTEGER,
+            receiver_id INTEGER,
+            sender TEXT,
+            receiver TEXT,
+            content TEXT NOT NULL,
+            timestamp TEXT,
+            read INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS archive.idx_messages_thread
+            ON messages (item_id, user_a, user_b, timestamp);
+        CREATE TABLE IF NOT EXISTS archive.conversations (
+            item_id INTEGER NOT NULL,
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            product_name TEXT,
+            last_message_id INTEGER NOT NULL,
+            last_timestamp TEXT,
+            messages INTEGER NOT NULL,
+            archived_at TEXT NOT NULL,
+            PRIMARY KEY (item_id, user_a, user_b)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS archive.idx_conversations_user_a
+            ON conversations (user_a, last_timestamp);
+        CREATE INDEX IF NOT EXISTS archive.idx_conversations_user_b
+            ON conversations (user_b, last_timestamp);
+    """)
+
+
+def connect(path, archive_path, busy_timeout_ms=5000):
+    """A maintenance connection to `path` with the archive attached (and created)."""
+    conn = sqlite3.connect(path, timeout=busy_timeout_ms / 1000, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    _archive_schema(conn)
+    conn.executescript("""
+        CREATE TEMP TABLE IF NOT EXISTS archive_batch (
+            item_id INTEGER, user_a INTEGER, user_b INTEGER,
+            PRIMARY KEY (item_id, user_a, user_b)
+        );
+        CREATE TEMP TABLE IF NOT EXISTS archive_ids (id INTEGER PRIMARY KEY);
+    """)
+    return conn
+
+
+# The batch's messages in marketplace.db, found through the sender index
+# from both ends of each thread
+_BATCH_MESSAGES = """
+    SELECT m.id FROM temp.archive_batch b
+    JOIN main.messages m
+      ON m.sender_id = b.user_a AND m.item_id = b.item_id AND m.receiver_id = b.user_b
+    UNION ALL
+    SELECT m.id FROM temp.archive_batch b
+    JOIN main.messages m
+      ON m.sender_id = b.user_b AND m.item_id = b.item_id AND m.receiver_id = b.user_a
+    WHERE b.user_a != b.user_b
+"""
+
+
+def _copy_batch(conn, after, cutoff, batch_size):
+    # Transaction 1: pick the next threads after the `after` key and copy
+    # their messages into the archive. Returns the last key, or None.
+    conn.execute("BEGIN")
+    try:
+        conn.execute("DELETE FROM temp.archive_batch")
+        conn.execute("DELETE FROM temp.archive_ids")
+        conn.execute("""
+            INSERT INTO temp.archive_batch (item_id, user_a, user_b)
+            SELECT c.item_id, c.user_a, c.user_b FROM main.conversations c
+            WHERE (c.item_id, c.user_a, c.user_b) > (?, ?, ?)
+              AND (c.last_timestamp < ?
+                   OR NOT EXISTS (SELECT 1 FROM main.products p WHERE p.id = c.item_id))
+            ORDER BY c.item_id, c.user_a, c.user_b
+            LIMIT ?
+        """, (*after, cutoff, batch_size))
+        last = conn.execute("""
+            SELECT item_id, user_a, user_b FROM temp.archive_batch
+            ORDER BY item_id DESC, user_a DESC, user_b DESC LIMIT 1
+        """).fetchone()
+        if last is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(f"INSERT OR IGNORE INTO temp.archive_ids (id) {_BATCH_MESSAGES}")
+        conn.execute("""
+            INSERT OR REPLACE INTO archive.messages
+                (id, item_id, user_a, user_b, sender_id, receiver_id, sender, receiver,
+                 content, timestamp, read)
+            SELECT id, item_id, MIN(sender_id, receiver_id), MAX(sender_id, receiver_id),
+                   sender_id, receiver_id, sender, receiver, content, timestamp, read
+            FROM main.messages WHERE id IN (SELECT id FROM temp.archive_ids)
+        """)
+        # Summaries are recounted from the archive, so copying a thread
+        # twice (or in two runs) comes out the same. MAX(id) makes SQLite
+        # take the bare timestamp from that row.
+        conn.execute("""
+            INSERT INTO archive.conversations
+                (item_id, user_a, user_b, product_name, last_message_id, last_timestamp,
+                 messages, archived_at)
+            SELECT m.item_id, m.user_a, m.user_b,
+                   (SELECT product_name FROM main.products WHERE id = m.item_id),
+                   MAX(m.id), m.timestamp, COUNT(*), ?
+            FROM temp.archive_batch b
+            JOIN archive.messages m
+              ON m.item_id = b.item_id AND m.user_a = b.user_a AND m.user_b = b.user_b
+            WHERE 1
+            GROUP BY m.item_id, m.user_a, m.user_b
+            ON CONFLICT (item_id, user_a, user_b) DO UPDATE SET
+                product_name = COALESCE(excluded.product_name, product_name),
+                last_message_id = excluded.last_message_id,
+                last_timestamp = excluded.last_timestamp,
+                messages = excluded.messages,
+                archived_at = excluded.archived_at
+        """, (datetime.now().isoformat(),))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return tuple(last)
+
+
+def _delete_batch(conn):
+    # Transaction 2: drop the copied messages from marketplace.db and
+    # leave tombstones. A message sent to one of these threads since the
+    # copy was not copied; its conversation row is rebuilt from it.
+    # Returns the number of messages removed.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        removed = conn.execute("""
+            DELETE FROM main.messages WHERE id IN (SELECT id FROM temp.archive_ids)
+        """).rowcount
+        conn.execute("""
+            INSERT OR IGNORE INTO main.archived_threads (item_id, user_a, user_b)
+            SELECT item_id, user_a, user_b FROM temp.archive_batch
+        """)
+        conn.execute("""
+            DELETE FROM main.conversations
+            WHERE (item_id, user_a, user_b) IN (SELECT item_id, user_a, user_b FROM temp.archive_batch)
+        """)
+        messaging.fold(conn, f"id IN ({_BATCH_MESSAGES})")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return removed
+
+
+def archive_threads(conn, cutoff, batch_size=DEFAULT_BATCH_THREADS, pause=BATCH_PAUSE,
+                    stopping=lambda: False):
+    """Move threads last active before `cutoff` (an ISO timestamp), and
+    threads of deleted listings, to the archive.
+
+    `conn` comes from connect(). Writers get the lock between batches.
+    Returns (threads, messages) moved.
+    """
+    threads = moved = 0
+    after = (-1, -1, -1)
+    while not stopping():
+        last = _copy_batch(conn, after, cutoff, batch_size)
+        if last is None:
+            break
+        threads += conn.execute("SELECT COUNT(*) FROM temp.archive_batch").fetchone()[0]
+        moved += _delete_batch(conn)
+        after = last
+        if pause:
+            time.sleep(pause)
+    return threads, moved
+
+
+def compact(conn, pages=VACUUM_PAGES, pause=VACUUM_PAUSE, stopping=lambda: False):
+    """Give free pages back to the filesystem, `pages` per write transaction.
+
+    Returns the number of pages freed, or None when the database is not in
+    incremental auto-vacuum mode (see full_vacuum()).
+    """
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+        return None
+    freed = 0
+    free = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+    while free and not stopping():
+        # executescript() steps the pragma to the end; execute() frees one page
+        conn.executescript(f"PRAGMA main.incremental_vacuum({int(pages)})")
+        remaining = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        freed += free - remaining
+        free = remaining
+        if pause:
+            time.sleep(pause)
+    conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)")
+    return freed
+
+
+def analyze(conn):
+    # Row counts change a lot after archiving; refresh the planner's statistics
+    for table in ("messages", "conversations", "archived_threads"):
+        conn.execute(f"ANALYZE main.{table}")
+
+
+def full_vacuum(path):
+    """Rewrite the whole database in incremental auto-vacuum mode.
+
+    Locks out writers for as long as it runs: once per older database, in
+    a maintenance window.
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def run(path, archive_path, after_days=DEFAULT_AFTER_DAYS, batch_size=DEFAULT_BATCH_THREADS,
+        busy_timeout_ms=5000, stopping=lambda: False):
+    """Archive, compact and analyze once. Returns a summary dict."""
+    cutoff = (datetime.now() - timedelta(days=after_days)).isoformat()
+    conn = connect(path, archive_path, busy_timeout_ms)
+    try:
+        threads, moved = archive_threads(conn, cutoff, batch_size, stopping=stopping)
+        freed = compact(conn, stopping=stopping)
+        analyze(conn)
+    finally:
+        conn.close()
+    return {"threads": threads, "messages": moved, "pages_freed": freed}
+
+
+def claim(path, interval, busy_timeout_ms=5000, name=JOB):
+    """True if this process gets to run the job `name` now (at most once per
+    `interval` seconds across every process sharing the database)."""
+    conn = sqlite3.connect(path, timeout=busy_timeout_ms / 1000, isolation_level=None)
+    try:
+        now = time.time()
+        cursor = conn.execute("""
+            INSERT INTO maintenance_runs (name, started_at) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET started_at = excluded.started_at
+            WHERE started_at <= ?
+        """, (name, now, now - interval))
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def _finished(path, summary, busy_timeout_ms=5000):
+    conn = sqlite3.connect(path, timeout=busy_timeout_ms / 1000, isolation_level=None)
+    try:
+        conn.execute("""
+            UPDATE maintenance_runs SET finished_at = ?, threads = ?, messages = ? WHERE name = ?
+        """, (time.time(), summary["threads"], summary["messages"], JOB))
+    finally:
+        conn.close()
+
+
+class Maintainer:
+    def __init__(self, path, archive_path, interval=DEFAULT_INTERVAL, after_days=DEFAULT_AFTER_DAYS,
+                 batch_size=DEFAULT_BATCH_THREADS, busy_timeout_ms=5000):
+        self.path = path
+        self.archive_path = archive_path
+        self.interval = interval
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._stop = threading.Event()
+        self.runs = 0
+        self.failures = 0
+        self.threads = 0
+        self.messages = 0
+        thread = threading.Thread(target=self._loop, name="message-archive", daemon=True)
+        thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(min(self.interval, CHECK_SECONDS)):
+            try:
+                if claim(self.path, self.interval, self.busy_timeout_ms):
+                    self.run()
+            except sqlite3.Error as e:
+                print("Message archive error:", e)
+                self.failures += 1
+
+    def run(self):
+        summary = run(self.path, self.archive_path, self.after_days, self.batch_size,
+                      self.busy_timeout_ms, stopping=self._stop.is_set)
+        _finished(self.path, summary, self.busy_timeout_ms)
+        self.runs += 1
+        self.threads += summary["threads"]
+        self.messages += summary["messages"]
+        return summary
+
+    def close(self):
+        # A run in progress stops after its current batch
+        self._stop.set()
+
+    def stats(self):
+        return {"runs": self.runs, "failures": self.failures, "threads": self.threads,
+                "messages": self.messages}
+
+
+def _read_only(path):
+    return f"file:{quote(os.path.abspath(path))}?mode=ro"
+
+
+class ArchiveReader:
+    """Read-only access to archived threads.
+
+    One connection per process, opened on first use: marketplace.db (for
+    usernames) with the archive attached, both read-only.
+    """
+
+    def __init__(self, path, archive_path):
+        self.path = path
+        self.archive_path = archive_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _query(self, sql, params):
+        with self._lock:
+            if self._conn is None:
+                if not os.path.exists(self.archive_path):
+                    # Nothing archived yet
+                    return []
+                conn = sqlite3.connect(_read_only(self.path), uri=True, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                conn.execute("ATTACH DATABASE ? AS archive", (_read_only(self.archive_path),))
+                self._conn = conn
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+    def thread_messages(self, item_id, user_id, other_id, limit, before=None):
+        """Like repository.thread_messages(), from the archive."""
+        user_a, user_b = messaging.participants(user_id, other_id)
+        params = [item_id, user_a, user_b]
+        older = ""
+        if before:
+            older = "AND (m.timestamp < ? OR (m.timestamp = ? AND m.id < ?))"
+            params += [before[0], before[0], before[1]]
+        rows = self._query(f"""
+            SELECT m.id, m.sender_id, COALESCE(u.username, m.sender) AS sender, m.content,
+                   m.timestamp, m.read
+            FROM archive.messages m
+            LEFT JOIN main.user u ON u.id = m.sender_id
+            WHERE m.item_id = ? AND m.user_a = ? AND m.user_b = ? {older}
+            ORDER BY m.timestamp DESC, m.id DESC
+            LIMIT ?
+        """, params + [limit])
+        rows.reverse()
+        return rows
+
+    def conversations(self, user_id, limit, before=None):
+        """Archived threads of `user_id`, newest first, shaped like
+        repository.conversations_for() rows (unread is always 0)."""
+        older = ""
+        params = {"user_id": user_id, "limit": limit}
+        if before:
+            older = ("AND (c.last_timestamp < :before_ts OR "
+                     "(c.last_timestamp = :before_ts AND c.last_message_id < :before_id))")
+            params["before_ts"], params["before_id"] = before
+
+        def branch(user, other, extra=""):
+            return f"""
+                SELECT c.item_id, c.{other} AS other_id, o.username AS other_user, 0 AS unread,
+                       c.last_timestamp, c.last_message_id,
+                       COALESCE(s.username, m.sender) AS last_sender, m.content AS last_content,
+                       c.product_name
+                FROM archive.conversations c
+                JOIN archive.messages m ON m.id = c.last_message_id
+                LEFT JOIN main.user o ON o.id = c.{other}
+                LEFT JOIN main.user s ON s.id = m.sender_id
+                WHERE c.{user} = :user_id {extra} {older}
+            """
+        return self._query(f"""
+            {branch("user_a", "user_b")}
+            UNION ALL
+            {branch("user_b", "user_a", "AND c.user_a != c.user_b")}
+            ORDER BY last_timestamp DESC, last_message_id DESC
+            LIMIT :limit
+        """, params)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_maintainers = {}
+_readers = {}
+_lock = threading.Lock()
+
+
+def get_maintainer(app=None):
+    # One maintenance thread per worker process, started after the fork;
+    # None when MAINTENANCE_INTERVAL_SECONDS is 0
+    app = app or current_app
+    config = app.config
+    if not config["MAINTENANCE_INTERVAL_SECONDS"]:
+        return None
+    key = os.getpid()
+    maintainer = _maintainers.get(key)
+    if maintainer is None:
+        with _lock:
+            maintainer = _maintainers.get(key)
+            if maintainer is None:
+                maintainer = Maintainer(
+                    config["DATABASE"], config["ARCHIVE_DATABASE"],
+                    interval=config["MAINTENANCE_INTERVAL_SECONDS"],
+                    after_days=config["ARCHIVE_AFTER_DAYS"],
+                    batch_size=config["ARCHIVE_BATCH_THREADS"],
+                    busy_timeout_ms=config.get("DB_BUSY_TIMEOUT_MS", 5000),
+                )
+                _maintainers[key] = maintainer
+    return maintainer
+
+
+def get_reader(app=None):
+    app = app or current_app
+    key = os.getpid()
+    reader = _readers.get(key)
+    if reader is None:
+        with _lock:
+            reader = _readers.get(key)
+            if reader is None:
+                reader = ArchiveReader(app.config["DATABASE"], app.config["ARCHIVE_DATABASE"])
+                _readers[key] = reader
+    return reader
+
+
+def init_app(app):
+    """Archive settings; call after database.init_app() (the archive sits next to DATABASE)."""
+    app.config.setdefault("ARCHIVE_DATABASE", os.environ.get(
+        "ARCHIVE_DATABASE", default_path(app.config["DATABASE"])))
+    app.config.setdefault("ARCHIVE_AFTER_DAYS", int(os.environ.get("ARCHIVE_AFTER_DAYS", DEFAULT_AFTER_DAYS)))
+    app.config.setdefault("ARCHIVE_BATCH_THREADS", DEFAULT_BATCH_THREADS)
+    app.config.setdefault("MAINTENANCE_INTERVAL_SECONDS", int(os.environ.get(
+        "MAINTENANCE_INTERVAL_SECONDS", DEFAULT_INTERVAL)))
+
+
+def status(path, archive_path):
+    conn = connect(path, archive_path)
+    try:
+        def one(sql):
+            return conn.execute(sql).fetchone()[0]
+        page_size = one("PRAGMA main.page_size")
+        return {
+            "hot_messages": one("SELECT COUNT(*) FROM main.messages"),
+            "hot_threads": one("SELECT COUNT(*) FROM main.conversations"),
+            "archived_messages": one("SELECT COUNT(*) FROM archive.messages"),
+            "archived_threads": one("SELECT COUNT(*) FROM archive.conversations"),
+            "database_mb": one("PRAGMA main.page_count") * page_size / 2**20,
+            "free_mb": one("PRAGMA main.freelist_count") * page_size / 2**20,
+            "incremental_vacuum": one("PRAGMA main.auto_vacuum") == 2,
+        }
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+
+    parser = argparse.ArgumentParser(description="Archive old message threads and compact marketplace.db.")
+    parser.add_argument("command", choices=["run", "vacuum", "status"])
+    parser.add_argument("--database", default="marketplace.db")
+    parser.add_argument("--archive", help="archive database (default: next to --database)")
+    parser.add_argument("--days", type=int, default=DEFAULT_AFTER_DAYS,
+                        help="archive threads with no message for this many days")
+    args = parser.parse_args()
+    archive_path = args.archive or default_path(args.database)
+    migrate(args.database)
+    if args.command == "run":
+        summary = run(args.database, archive_path, after_days=args.days)
+        print(f"✅ Archived {summary['threads']} threads ({summary['messages']} messages) "
+              f"to {archive_path}.")
+        if summary["pages_freed"] is None:
+            print("ℹ️ Not in incremental auto-vacuum mode; run `python archive.py vacuum` once.")
+        else:
+            print(f"✅ Freed {summary['pages_freed']} pages.")
+    elif args.command == "vacuum":
+        full_vacuum(args.database)
+        print("✅ Vacuumed; free pages are now reclaimed incrementally by `run`.")
+    else:
+        for name, value in status(args.database, archive_path).items():
+            print(f"{name}: {value:.1f}" if isinstance(value, float) else f"{name}: {value}")
@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+from flask import abort, current_app, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always possible
+    brotli = None
+
+# Cache-friendly serving for everything under static/ (bundled assets and
+# uploads). asset_url() puts a content fingerprint in the URL, so the
+# response can be cached "forever" and a changed file simply gets a new
+# URL. Responses carry a strong ETag, answer If-None-Match with 304,
+# support byte ranges and go out through wsgi.file_wrapper, which lets
+# gunicorn use sendfile() (or X-Sendfile with USE_X_SENDFILE).
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Text assets that may have pre-compressed .br / .gz siblings on disk
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt"}
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+_HASHED_UPLOAD = re.compile(r"^uploads/([0-9a-f]{64})(_\w+)?\.\w+$")
+
+_fingerprints = {}
+_lock = threading.Lock()
+
+
+def fingerprint(path):
+    """Content hash of a file under static/, cached on (mtime, size)."""
+    full_path = os.path.join(current_app.static_folder, path)
+    stat = os.stat(full_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _fingerprints.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    match = _HASHED_UPLOAD.match(path)
+    if match and not match.group(2):
+        # Content-addressed uploads are already named by their hash
+        digest = match.group(1)
+    else:
+        with open(full_path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+    with _lock:
+        _fingerprints[path] = (key, digest)
+    return digest
+
+
+def asset_url(path):
+    # Fingerprinted URL for a file under static/; plain static URL if missing
+    path = path.lstrip("/")
+    if path.startswith("static/"):
+        path = path[len("static/"):]
+    try:
+        digest = fingerprint(path)
+    except (OSError, ValueError):
+        return url_for("static", filename=path)
+    return url_for("serve_asset", version=digest[:16], filename=path)
+
+
+def _safe_path(filename):
+    root = os.path.realpath(current_app.static_folder)
+    full_path = os.path.realpath(os.path.join(root, filename))
+    if not full_path.startswith(root + os.sep) or not os.path.isfile(full_path):
+        abort(404)
+    return full_path
+
+
+def _precompressed(full_path):
+    # Best encoding the client accepts that has a file on disk
+    if os.path.splitext(full_path)[1] not in COMPRESSIBLE:
+        return None, None
+    accepted = request.accept_encodings
+    source_mtime = os.stat(full_path).st_mtime_ns
+    for encoding, suffix in ENCODINGS:
+        if not accepted[encoding]:
+            continue
+        try:
+            # Ignore a compressed copy older than the file it was made from
+            if os.stat(full_path + suffix).st_mtime_ns >= source_mtime:
+                return encoding, full_path + suffix
+        except OSError:
+            continue
+    return None, None
+
+
+def serve_asset(version, filename):
+    full_path = _safe_path(filename)
+    digest = fingerprint(filename)
+    current = len(version) >= 8 and digest.startswith(version)
+    mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+    encoding, encoded_path = _precompressed(full_path)
+    response = send_file(
+        encoded_path or full_path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=f"{digest}-{encoding}" if encoding else digest,
+        max_age=IMMUTABLE_MAX_AGE if current else 0,
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if os.path.splitext(full_path)[1] in COMPRESSIBLE:
+        response.vary.add("Accept-Encoding")
+    if current:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        # Stale fingerprint from an old page: serve the current bytes but
+        # make the client revalidate instead of pinning them for a year.
+        response.cache_control.no_cache = True
+    return response
+
+
+def precompress(static_folder, quality=11):
+    """Write .gz (and .br when brotli is installed) next to text assets."""
+    written = 0
+    for root, _, files in os.walk(static_folder):
+        if os.path.relpath(root, static_folder).split(os.sep)[0] == "uploads":
+            continue
+        for name in files:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path + ".gz", "wb") as out:
+                out.write(gzip.compress(data, compresslevel=9, mtime=0))
+            written += 1
+            if brotli is not None:
+                with open(path + ".br", "wb") as out:
+                    out.write(brotli.compress(data, quality=quality))
+                written += 1
+    return written
+
+
+def init_app(app):
+    app.add_url_rule("/assets/<version>/<path:filename>", "serve_asset", serve_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "compress":
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+        print(f"✅ Wrote {precompress(folder)} pre-compressed files.")
+    else:
+        print("Usage: python assets.py compress")
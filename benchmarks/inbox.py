@@ -0,0 +1,126 @@
+"""Inbox rendering cost: per-message unread counts vs. conversation summaries.
+
+Seeds a throwaway database with one heavy seller whose mailbox holds
+10k+ messages, then times the old inbox() query pattern against the
+conversations table and reports queries issued per page load.
+
+    python -m benchmarks.inbox [--messages 12000] [--runs 5]
+"""
+import argparse
+import functools
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import messaging
+import repository
+from migrations import migrate
+
+USER = "heavy_seller"
+USER_ID = 1
+
+
+def seed(path, messages, items=400, buyers=60):
+    migrate(path)
+    conn = sqlite3.connect(path)
+    rng = random.Random(42)
+    conn.executemany(
+        "INSERT INTO user (id, username, email, password_hash) VALUES (?, ?, ?, '')",
+        [(USER_ID, USER, f"{USER}@bench.local")]
+        + [(n + 1, f"buyer{n}", f"buyer{n}@bench.local") for n in range(1, buyers + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO products (id, product_name, price, seller, seller_id, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(i, f"Item {i}", rng.uniform(1, 200), USER, USER_ID, "2025-01-01T00:00:00")
+         for i in range(1, items + 1)],
+    )
+    for n in range(messages):
+        item_id = rng.randint(1, items)
+        buyer = rng.randint(1, buyers) + 1
+        sender, receiver = (buyer, USER_ID) if rng.random() < 0.6 else (USER_ID, buyer)
+        timestamp = f"2025-01-{1 + n * 28 // messages:02d}T00:00:{n % 60:02d}.{n:06d}"
+        messaging.send(conn, item_id, sender, receiver, f"message {n}", timestamp)
+    conn.execute("UPDATE messages SET read = 1 WHERE id % 3 = 0")
+    messaging.rebuild(conn)
+    conn.commit()
+    conn.close()
+
+
+def legacy_inbox(conn, user_id):
+    # The inbox() implementation this replaced: read the whole mailbox and
+    # run one COUNT(*) per received message.
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT sender_id, receiver_id, products.product_name, content, messages.timestamp, item_id
+        FROM messages
+        JOIN products ON messages.item_id = products.id
+        WHERE sender_id = ? OR receiver_id = ?
+        ORDER BY item_id, messages.timestamp ASC
+    """, (user_id, user_id))
+    threads = {}
+    unread_counts = {}
+    for sender, receiver, item_name, content, timestamp, item_id in cursor.fetchall():
+        other = receiver if sender == user_id else sender
+        key = (item_id, other, item_name)
+        threads.setdefault(key, []).append((sender, content, timestamp))
+        unread_counts.setdefault(key, 0)
+        if receiver == user_id:
+            unread_counts[key] = conn.execute("""
+                SELECT COUNT(*) FROM messages
+                WHERE item_id = ? AND sender_id = ? AND receiver_id = ? AND read = 0
+            """, (item_id, other, user_id)).fetchone()[0]
+    return threads, unread_counts
+
+
+@functools.lru_cache(maxsize=None)
+def engine_for(conn):
+    # An engine over the traced sqlite3 connection, so the app's own
+    # statement is what gets measured
+    return create_engine("sqlite://", creator=lambda: conn, poolclass=StaticPool)
+
+
+def summary_inbox(conn, user_id):
+    with engine_for(conn).connect() as connection:
+        return repository.conversations_for(connection, user_id)
+
+
+def measure(path, render, runs):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    queries = []
+    conn.set_trace_callback(queries.append)
+    timings = []
+    for _ in range(runs):
+        queries.clear()
+        start = time.perf_counter()
+        render(conn, USER_ID)
+        timings.append((time.perf_counter() - start) * 1000)
+    conn.close()
+    return len(queries), statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=12000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        seed(path, args.messages)
+        print(f"Mailbox: {args.messages} messages for {USER}")
+        print(f"{'inbox':<24}{'queries':>10}{'median ms':>12}")
+        for name, render in (("legacy (N+1 counts)", legacy_inbox),
+                             ("conversation summaries", summary_inbox)):
+            count, median = measure(path, render, args.runs)
+            print(f"{name:<24}{count:>10}{median:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
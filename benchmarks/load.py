@@ -0,0 +1,315 @@
+"""Replay realistic user sessions and report per-route latency.
+
+Seeds a throwaway database (see benchmarks.seed), then plays scripted
+sessions against the app. Each session logs in, browses and pages /items,
+searches, opens listings, sends messages, and checks the inbox and the
+dashboard. Sessions run through the Flask test client (in-process, no
+network) or through a real threaded WSGI server over HTTP. The report
+gives, for each route, p50/p95/p99 latency, requests per second and SQL
+statements per request.
+
+    python -m benchmarks.load [--scale small] [--mode client|server]
+        [--sessions 60] [--concurrency 4]
+        [--save-baseline benchmarks/baseline.json]
+        [--check benchmarks/baseline.json] [--threshold 0.25]
+
+--check exits with status 1 when any route's p95 is worse than the
+baseline by more than the threshold, or when it issues more queries per
+request than before.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmarks import seed as seeding
+
+QUERY_HEADER = "X-Bench-Queries"
+# Latency changes smaller than this are noise whatever the ratio
+NOISE_MS = 2.0
+QUERY_SLACK = 0.5
+# Too few samples for a stable p95; only queries/request are compared
+MIN_SAMPLES = 20
+
+_NEXT_LINK = re.compile(r'href="(/items\?[^"]*after=[^"]*)"')
+_ITEM_LINK = re.compile(r'href="/item/(\d+)"')
+
+
+def load_app(path):
+    from app import create_app
+    # Every simulated visitor comes from 127.0.0.1
+    app = create_app({"DATABASE": path, "AUTH_RATE_LIMIT_IP": (10 ** 6, 10 ** 6)})
+    instrument(app)
+    return app
+
+
+def instrument(app):
+    """Report each request's SQL statement count (from metrics.py) in a header."""
+    import metrics
+
+    @app.after_request
+    def report_count(response):
+        stats = metrics.current()
+        response.headers[QUERY_HEADER] = str(len(stats.queries) if stats else 0)
+        return response
+
+
+class ClientTransport:
+    # In-process requests through the Flask test client
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, form=None):
+        response = self.client.open(url, method=method, data=form)
+        body = response.get_data(as_text=True)
+        return response.status_code, int(response.headers.get(QUERY_HEADER, 0)), body
+
+
+class HTTPTransport:
+    # Real HTTP against the threaded WSGI server, with a cookie jar of one
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.cookie = None
+        self.conn = http.client.HTTPConnection(host, port, timeout=30)
+
+    def request(self, method, url, form=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        for attempt in range(2):
+            try:
+                self.conn.request(method, url, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read().decode("utf-8", "replace")
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection
+                self.conn.close()
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+                if attempt:
+                    raise
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status, int(response.getheader(QUERY_HEADER) or 0), data
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def timed(self, transport, route, method, url, form=None):
+        start = time.perf_counter()
+        status, queries, body = transport.request(method, url, form)
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.samples.setdefault(route, []).append((elapsed, queries))
+            if status >= 400:
+                self.errors += 1
+        return body
+
+
+def run_session(transport, recorder, rng, sizes):
+    """One visitor: log in, browse, search, read listings, message, inbox."""
+    user = rng.randint(1, sizes["users"])
+    timed = recorder.timed
+    timed(transport, "POST /login", "POST", "/login",
+          {"email": seeding.email(user), "password": seeding.PASSWORD})
+
+    page = timed(transport, "GET /items", "GET", "/items")
+    sort = rng.choice(["newest", "price_asc", "price_desc", "category"])
+    page = timed(transport, "GET /items?sort", "GET", f"/items?sort={sort}")
+    for _ in range(rng.randint(1, 3)):
+        link = _NEXT_LINK.search(page)
+        if not link:
+            break
+        page = timed(transport, "GET /items?after", "GET", link.group(1).replace("&amp;", "&"))
+    category = rng.choice(seeding.CATEGORIES)
+    timed(transport, "GET /items?category", "GET", f"/items?category={category}")
+    timed(transport, "GET /items?price", "GET",
+          f"/items?category={category}&min_price=10&max_price=49.99")
+
+    word = rng.choice(seeding.WORDS)
+    page = timed(transport, "GET /items?search", "GET", f"/items?search={word}")
+    timed(transport, "GET /items/suggest", "GET", f"/items/suggest?q={word[:3]}")
+
+    item_ids = [int(i) for i in _ITEM_LINK.findall(page)] or [rng.randint(1, sizes["products"])]
+    for _ in range(rng.randint(1, 3)):
+        item_id = rng.choice(item_ids)
+        timed(transport, "GET /item/<id>", "GET", f"/item/{item_id}")
+        if rng.random() < 0.3:
+            timed(transport, "POST /message/<id>", "POST", f"/message/{item_id}",
+                  {"content": f"Is this still available? ({rng.random():.6f})"})
+
+    timed(transport, "GET /inbox", "GET", "/inbox")
+    timed(transport, "GET /inbox/threads", "GET", "/inbox/threads")
+    timed(transport, "GET /dashboard", "GET", "/dashboard")
+    if rng.random() < 0.1:
+        timed(transport, "GET /users", "GET", "/users")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(recorder, wall_seconds):
+    routes = {}
+    for route, samples in sorted(recorder.samples.items()):
+        latencies = [ms for ms, _ in samples]
+        routes[route] = {
+            "requests": len(samples),
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "rps": round(len(samples) / wall_seconds, 1),
+            "queries": round(statistics.mean(q for _, q in samples), 2),
+        }
+    total = sum(len(s) for s in recorder.samples.values())
+    return {"requests": total, "errors": recorder.errors,
+            "rps": round(total / wall_seconds, 1), "routes": routes}
+
+
+def replay(make_transport, sessions, concurrency, sizes, seed, warmup=5):
+    """Play the scripted sessions through transports from make_transport()."""
+    recorder = Recorder()
+    # Untimed sessions first, so one-off costs (template compilation, the
+    # first connections, cold caches) do not land in the percentiles
+    for n in range(warmup):
+        run_session(make_transport(), Recorder(), random.Random(-1 - n), sizes)
+
+    # Session n always replays the same script, whichever thread runs it
+    pending = list(range(sessions))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                n = pending.pop(0)
+            run_session(make_transport(), recorder, random.Random(seed * 100_003 + n), sizes)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    return summarize(recorder, wall)
+
+
+def run(app, mode, sessions, concurrency, sizes, seed, warmup=5):
+    server = None
+    if mode == "server":
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        make_transport = lambda: HTTPTransport("127.0.0.1", server.server_port)
+    else:
+        make_transport = lambda: ClientTransport(app)
+        # The test client is not meant to be shared, and in-process
+        # timings are only comparable without thread contention
+        concurrency = 1
+    try:
+        return replay(make_transport, sessions, concurrency, sizes, seed, warmup)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+def print_report(report):
+    print(f"{'route':<22}{'reqs':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>8}{'queries':>9}")
+    for route, row in report["routes"].items():
+        print(f"{route:<22}{row['requests']:>6}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}"
+              f"{row['p99_ms']:>9.2f}{row['rps']:>8.1f}{row['queries']:>9.2f}")
+    print(f"{report['requests']} requests, {report['rps']} req/s, {report['errors']} errors")
+
+
+def regressions(report, baseline, threshold):
+    """Routes that got slower (p95) or chattier (queries) than the baseline."""
+    problems = []
+    for route, old in baseline["routes"].items():
+        new = report["routes"].get(route)
+        if new is None:
+            continue
+        limit = old["p95_ms"] * (1 + threshold)
+        if (min(new["requests"], old["requests"]) >= MIN_SAMPLES and new["p95_ms"] > limit
+                and new["p95_ms"] - old["p95_ms"] > NOISE_MS):
+            problems.append(f"{route}: p95 {new['p95_ms']:.2f} ms vs baseline "
+                            f"{old['p95_ms']:.2f} ms (limit {limit:.2f})")
+        if new["queries"] > old["queries"] + QUERY_SLACK:
+            problems.append(f"{route}: {new['queries']:.2f} queries/request vs baseline "
+                            f"{old['queries']:.2f}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    seeding.scale_args(parser)
+    parser.add_argument("--mode", choices=("client", "server"), default="client")
+    parser.add_argument("--sessions", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=5, help="untimed sessions run first")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--check", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed p95 slowdown as a fraction (default 0.25)")
+    args = parser.parse_args()
+    sizes = seeding.sizes(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        counts = seeding.seed(path, seed=args.seed, **sizes)
+        print(f"Seeded {counts['user']} users, {counts['products']} products, "
+              f"{counts['messages']} messages ({args.scale}, seed {args.seed}); "
+              f"{args.sessions} sessions via {args.mode}")
+        app = load_app(path)
+        report = run(app, args.mode, args.sessions, args.concurrency, sizes, args.seed,
+                     warmup=args.warmup)
+
+    report.update({"scale": args.scale, "mode": args.mode, "sessions": args.sessions,
+                   "seed": args.seed})
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        if (baseline.get("scale"), baseline.get("mode")) != (args.scale, args.mode):
+            print(f"Baseline was recorded with --scale {baseline.get('scale')} "
+                  f"--mode {baseline.get('mode')}; run with the same settings.")
+            sys.exit(2)
+        problems = regressions(report, baseline, args.threshold)
+        for problem in problems:
+            print("REGRESSION", problem)
+        if problems:
+            sys.exit(1)
+        print("No regressions against", args.check)
+
+
+if __name__ == "__main__":
+    main()
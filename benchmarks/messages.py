@@ -0,0 +1,169 @@
+"""Sustained message throughput: one commit per message vs. group commit.
+
+Seeds a throwaway database (see benchmarks.seed), then has --clients
+threads in each of --processes processes (gunicorn workers) send messages
+about random listings as fast as they can for --seconds, with a
+read-mark of the seller's thread after every fourth send, through:
+
+  per-message commit  each client commits every write on its own
+                      connection, as /message and /inbox did; with the
+                      pool's synchronous=NORMAL and with synchronous=FULL
+                      (durable on return, like the writer)
+  group commit        writer.GroupCommitWriter: one writer thread, one
+                      durable commit per batch, per process
+
+    python -m benchmarks.messages [--processes 4] [--clients 8] [--seconds 5]
+        [--window-ms 0]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+import messaging
+from benchmarks import seed as seeding
+from writer import GroupCommitWriter
+
+READ_MARK_EVERY = 4
+
+
+def listings(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT id, seller_id FROM products WHERE seller_id IS NOT NULL").fetchall()
+    users = conn.execute("SELECT MAX(id) FROM user").fetchone()[0]
+    conn.close()
+    return rows, users
+
+
+def direct_client(path, synchronous):
+    conn = sqlite3.connect(path, timeout=5)
+    conn.executescript(f"PRAGMA journal_mode=WAL; PRAGMA synchronous={synchronous};")
+
+    def write(work, *args):
+        try:
+            return work(conn, *args)
+        finally:
+            conn.commit()
+    return write, conn.close
+
+
+def fsync_ms(directory, rounds=200):
+    # What one durable commit costs on this disk, for reading the results
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            os.write(fd, b"x" * 4096)
+            os.fsync(fd)
+        return (time.perf_counter() - start) * 1000 / rounds
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+def run_clients(mode, path, clients, seconds, window_ms, seed):
+    """One process: `clients` threads writing through `mode` until time is up.
+
+    Returns (latencies in ms, errors, writer stats or None).
+    """
+    rows, users = listings(path)
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    writer = None
+    if mode == "group":
+        writer = GroupCommitWriter(path, window_ms=window_ms)
+        make_client = lambda: (writer.submit, lambda: None)
+    else:
+        make_client = lambda: direct_client(path, mode)
+    stop = time.monotonic() + seconds
+
+    def client(n):
+        write, close = make_client()
+        rng = random.Random(seed * 1000 + n)
+        sent, mine = 0, []
+        try:
+            while time.monotonic() < stop:
+                item_id, seller = rng.choice(rows)
+                buyer = rng.randint(1, users)
+                start = time.perf_counter()
+                try:
+                    if sent % READ_MARK_EVERY == READ_MARK_EVERY - 1:
+                        write(messaging.mark_read, seller, [(item_id, buyer, 1)])
+                    else:
+                        write(messaging.send, item_id, buyer, seller, f"bench {n}/{sent}",
+                              "2025-06-01T00:00:00")
+                    mine.append((time.perf_counter() - start) * 1000)
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+                sent += 1
+        finally:
+            close()
+            with lock:
+                latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], writer.stats() if writer else None
+
+
+def run(mode, path, args):
+    # Forked like gunicorn workers, each process with its own connections
+    jobs = [(mode, path, args.clients, args.seconds, args.window_ms, n)
+            for n in range(args.processes)]
+    start = time.perf_counter()
+    with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+        results = pool.starmap(run_clients, jobs)
+    wall = time.perf_counter() - start
+    latencies = sorted(ms for result in results for ms in result[0])
+    writes = sum(result[2]["writes"] for result in results if result[2])
+    batches = sum(result[2]["batches"] for result in results if result[2])
+    return {
+        "rate": len(latencies) / wall,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        "errors": sum(result[1] for result in results),
+        "per_commit": writes / batches if batches else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    seeding.scale_args(parser)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=8, help="threads per process")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--window-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    sizes = seeding.sizes(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        seeding.seed(path, seed=args.seed, **sizes)
+        print(f"{args.processes} processes x {args.clients} clients for {args.seconds:g}s, "
+              f"one read-mark per {READ_MARK_EVERY} writes, {os.cpu_count()} CPUs, "
+              f"fsync {fsync_ms(tmp):.2f} ms")
+        print(f"{'writes':<32}{'writes/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}{'commits':>12}")
+
+        def report(name, result):
+            commits = "1/write"
+            if result["per_commit"] is not None:
+                commits = f"{result['per_commit']:.1f}/commit"
+            print(f"{name:<32}{result['rate']:>10.0f}{result['p50']:>10.2f}{result['p95']:>10.2f}"
+                  f"{result['errors']:>8}{commits:>12}")
+
+        for synchronous in ("NORMAL", "FULL"):
+            report(f"per-message commit ({synchronous})", run(synchronous, path, args))
+        report(f"group commit ({args.window_ms:g} ms window)", run("group", path, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Deterministic marketplace data for benchmarks.
+
+Seeds a database with users, products and messages at a chosen scale.
+The same scale and --seed always produce the same rows. Activity is
+skewed the way a real board is: a few heavy sellers own most listings
+and receive most messages, and popular listings get most of the views.
+
+    python -m benchmarks.seed bench.db [--scale small|medium|large]
+        [--users N] [--products N] [--messages N] [--seed 42]
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import analytics
+import messaging
+import similar
+from migrations import migrate
+
+SCALES = {
+    "small": {"users": 200, "products": 2_000, "messages": 5_000},
+    "medium": {"users": 2_000, "products": 20_000, "messages": 50_000},
+    "large": {"users": 10_000, "products": 100_000, "messages": 300_000},
+}
+
+# Every seeded account shares this password so load sessions can log in
+PASSWORD = "benchmark"
+CATEGORIES = ["Stationery", "Electronics", "Clothing", "Books", "Furniture", "Sports"]
+LOCATIONS = ["Library", "Student Centre", "Residence", "Gym", "Cafeteria", "Lab"]
+WORDS = ["desk", "lamp", "calculator", "hoodie", "textbook", "chair", "laptop", "bike",
+         "notebook", "charger", "jacket", "monitor", "backpack", "kettle", "poster",
+         "headphones", "mug", "shelf", "scarf", "racket", "printer", "novel", "cable", "boots"]
+START = datetime(2025, 1, 1)
+
+
+def username(n):
+    return f"user{n:05d}"
+
+
+def email(n):
+    return f"user{n:05d}@bench.local"
+
+
+class Zipf:
+    # Picks 0..n-1 with probability ∝ 1 / (rank + 1) ** s
+    def __init__(self, n, s=1.1):
+        self.cumulative = list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(n)))
+
+    def pick(self, rng):
+        return bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])
+
+
+def seed(path, users, products, messages, seed=42):
+    """Fill `path` with benchmark data; returns the row counts written."""
+    migrate(path)
+    conn = sqlite3.connect(path)
+    rng = random.Random(seed)
+
+    # Hashing is deliberately slow, so every account shares one hash
+    password_hash = generate_password_hash(PASSWORD)
+    conn.executemany(
+        "INSERT INTO user (id, username, email, password_hash, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(n, username(n), email(n), password_hash, START.isoformat(sep=" "))
+         for n in range(1, users + 1)],
+    )
+
+    sellers = Zipf(users)
+    product_rows = []
+    for n in range(1, products + 1):
+        name = " ".join(rng.sample(WORDS, 2)).title()
+        product_rows.append((
+            n, f"{name} {n}", round(rng.uniform(1, 500), 2), rng.choice(CATEGORIES), None,
+            username(seller := sellers.pick(rng) + 1), seller, rng.choice(LOCATIONS),
+            f"{name.lower()} in good condition, {rng.choice(WORDS)} included",
+            (START + timedelta(minutes=n * 7)).isoformat(),
+        ))
+    conn.executemany("""
+        INSERT INTO products (id, product_name, price, category, image_url, seller, seller_id,
+                              location, description, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, product_rows)
+
+    # Buyers write about popular listings; about a third of messages are
+    # the seller's reply
+    popular = Zipf(products, s=0.9)
+    for n in range(messages):
+        listing = product_rows[popular.pick(rng)]
+        item_id, seller = listing[0], listing[6]
+        buyer = rng.randint(1, users)
+        if buyer == seller:
+            continue
+        sender, receiver = (buyer, seller) if rng.random() < 0.65 else (seller, buyer)
+        timestamp = (START + timedelta(seconds=n * 50)).isoformat()
+        messaging.send(conn, item_id, sender, receiver, f"message {n} about item {item_id}", timestamp)
+    conn.execute("UPDATE messages SET read = 1 WHERE id % 3 <> 0")
+    messaging.rebuild(conn)
+    analytics.rebuild_inquiries(conn)
+    similar.rebuild(conn)
+    conn.execute("ANALYZE")
+    conn.commit()
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ("user", "products", "messages")}
+    conn.close()
+    return counts
+
+
+def scale_args(parser):
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--products", type=int)
+    parser.add_argument("--messages", type=int)
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def sizes(args):
+    chosen = dict(SCALES[args.scale])
+    for key in chosen:
+        if getattr(args, key) is not None:
+            chosen[key] = getattr(args, key)
+    return chosen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    scale_args(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        parser.error(f"{args.path} already exists; seed a fresh file")
+    counts = seed(args.path, seed=args.seed, **sizes(args))
+    print(", ".join(f"{count} {table}" for table, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Throughput of the gunicorn setup against the development server.
+
+Seeds a throwaway database, then replays the load sessions (see
+benchmarks.load) over HTTP against each server in turn:
+
+  dev server  `python app.py`: Flask's single-process debug server, which
+              is how render.yaml used to start the service
+  gunicorn    `gunicorn -c gunicorn.conf.py`: preloaded app, CPU-sized
+              workers and threads, warmed up on boot
+
+    python -m benchmarks.serve [--scale small] [--sessions 120]
+        [--concurrency 8] [--workers N] [--worker-class gthread|gevent]
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import load
+from benchmarks import seed as seeding
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ("GET /items", "GET /items?search", "GET /item/<id>", "GET /inbox", "POST /message/<id>")
+
+
+def bench_app():
+    """The app under test; the database comes from the DATABASE variable."""
+    from app import create_app
+
+    data_dir = os.path.dirname(os.environ["DATABASE"])
+    # Every simulated visitor comes from 127.0.0.1, and all of them log in
+    # at once: queue the hashing instead of shedding logins with a 503
+    return create_app({"AUTH_RATE_LIMIT_IP": (10 ** 6, 10 ** 6),
+                       "PASSWORD_HASH_QUEUE": 256,
+                       "EVENTS_DATABASE": os.path.join(data_dir, "events.db")})
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/about")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def start(command, env):
+    # Own process group, so the reloader's child or gunicorn's workers
+    # stop with it
+    return subprocess.Popen(command, cwd=ROOT, env=env, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=40)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def measure(name, command, env, port, args, sizes):
+    process = start(command, env)
+    try:
+        wait_until_up(port, process)
+        report = load.replay(lambda: load.HTTPTransport("127.0.0.1", port), args.sessions,
+                             args.concurrency, sizes, args.seed, warmup=args.warmup)
+    finally:
+        stop(process)
+    routes = report["routes"]
+    p95 = "".join(f"{routes[r]['p95_ms']:>20.2f}" if r in routes else f"{'-':>20}" for r in ROUTES)
+    print(f"{name:<12}{report['rps']:>8.1f}{report['errors']:>8}{p95}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    seeding.scale_args(parser)
+    parser.add_argument("--sessions", type=int, default=120)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--workers", type=int, help="gunicorn workers (default from CPU count)")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--run-dev-server", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_dev_server:
+        # What `python app.py` does, on the benchmark's app
+        bench_app().run(debug=True, port=args.run_dev_server)
+        return
+
+    sizes = seeding.sizes(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        counts = seeding.seed(path, seed=args.seed, **sizes)
+        print(f"Seeded {counts['user']} users, {counts['products']} products, "
+              f"{counts['messages']} messages ({args.scale}, seed {args.seed}); "
+              f"{args.sessions} sessions, {args.concurrency} concurrent clients, "
+              f"{os.cpu_count()} CPUs")
+        env = dict(os.environ, DATABASE=path, SECRET_KEY="benchmark", WORKER_CLASS=args.worker_class)
+        if args.workers:
+            env["WEB_CONCURRENCY"] = str(args.workers)
+
+        print(f"{'server':<12}{'req/s':>8}{'errors':>8}" + "".join(f"{r + ' p95':>20}" for r in ROUTES))
+        port = free_port()
+        measure("dev server", [sys.executable, "-m", "benchmarks.serve", "--run-dev-server", str(port)],
+                env, port, args, sizes)
+        # Logins queue on the hashing pool while holding a request thread:
+        # give gunicorn a thread per client as well, as the dev server has
+        env.setdefault("GUNICORN_THREADS", str(max(8, 2 * args.concurrency)))
+        port = free_port()
+        measure("gunicorn", [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                             "--bind", f"127.0.0.1:{port}", "benchmarks.serve:bench_app()"],
+                env, port, args, sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Similar listings: a naive pairwise loop vs. the batched NumPy build.
+
+Generates catalogs of each --sizes listing count (two or three words from a
+Zipf-distributed vocabulary per name, a short description, one of the seed
+categories and a price), then finds every listing's top-K two ways, timing
+each and measuring its peak memory with tracemalloc:
+
+  pairwise  TF-IDF vectors as Python dicts, every pair's cosine times the
+            price factor, heapq for the top K, as a straightforward
+            implementation would
+  numpy     similar.build(): CSR term weights, a batch of rows scored
+            against the whole catalog at a time (dense matrix product for
+            common terms, posting lists for the rest), argpartition top K
+
+The pairwise loop is quadratic in Python, so it only runs up to
+--pairwise-max listings. Finally the largest catalog is stored in a
+throwaway database and one edited listing is refreshed incrementally, as
+the refresher thread does after /edit.
+
+    python -m benchmarks.similar [--sizes 1000,2000,5000,20000] [--pairwise-max 2000] [--k 6]
+"""
+import argparse
+import heapq
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import similar
+from benchmarks.seed import CATEGORIES, WORDS
+from migrations import migrate
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "bo", "da", "fe", "gu", "pi"]
+EXTRA_WORDS = 3000
+
+
+def catalog(size, seed=42):
+    # [(id, product_name, description, category, price)]
+    rng = random.Random(seed)
+    vocabulary = [word.lower() for word in WORDS] + [
+        "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(EXTRA_WORDS)]
+    # Zipf-like: a few words are everywhere, most are rare
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    def words(count):
+        return rng.choices(vocabulary, weights, k=count)
+
+    return [
+        (n, " ".join(words(rng.randint(2, 3))).title(),
+         f"{' '.join(words(rng.randint(3, 8)))}, in good condition",
+         rng.choice(CATEGORIES), round(rng.uniform(1, 500), 2))
+        for n in range(1, size + 1)
+    ]
+
+
+def pairwise(rows, k):
+    """[(product_id, similar_id, score)] comparing every pair in Python."""
+    documents = [similar.terms(*row[1:4]) for row in rows]
+    df = {}
+    for document in documents:
+        for term in document:
+            df[term] = df.get(term, 0) + 1
+    idf = {term: math.log((1 + len(rows)) / (1 + count)) + 1 for term, count in df.items()}
+    vectors = []
+    for document in documents:
+        vector = {term: (1 + math.log(count)) * idf[term] for term, count in document.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        vectors.append({term: w / norm for term, w in vector.items()})
+
+    neighbors = []
+    for i, (product_id, *_, price) in enumerate(rows):
+        scored = []
+        for j, (other_id, *_, other_price) in enumerate(rows):
+            if i == j:
+                continue
+            a, b = vectors[i], vectors[j]
+            if len(b) < len(a):
+                a, b = b, a
+            cosine = sum(w * b[term] for term, w in a.items() if term in b)
+            factor = (min(price, other_price) + 1) / (max(price, other_price) + 1)
+            score = cosine * (1 - similar.PRICE_WEIGHT + similar.PRICE_WEIGHT * factor)
+            if score > similar.MIN_SCORE:
+                scored.append((score, -other_id))
+        for score, other_id in heapq.nlargest(k, scored):
+            neighbors.append((product_id, -other_id, score))
+    return neighbors
+
+
+def numpy_build(rows, k):
+    return similar.build(rows, k)[1]
+
+
+def measure(fn, *args):
+    # (seconds, peak MiB, result); timed without tracemalloc, which slows Python code down
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+def agreement(expected, actual):
+    """(fraction of top-K ids in common, largest score difference)."""
+    def lists(neighbors):
+        result = {}
+        for product_id, similar_id, score in neighbors:
+            result.setdefault(product_id, []).append((similar_id, score))
+        return result
+
+    expected, actual = lists(expected), lists(actual)
+    shared = total = 0
+    difference = 0.0
+    for product_id in expected.keys() | actual.keys():
+        left, right = expected.get(product_id, []), actual.get(product_id, [])
+        shared += len({i for i, _ in left} & {i for i, _ in right})
+        total += max(len(left), len(right))
+        # Scores are compared rank by rank, so ties may swap ids
+        for (_, a), (_, b) in zip(left, right):
+            difference = max(difference, abs(a - b))
+    return shared / max(total, 1), difference
+
+
+def refresh_one(rows, k):
+    # ms to refresh one edited listing against the stored catalog
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        migrate(path)
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO products (id, product_name, description, category, price) "
+                         "VALUES (?, ?, ?, ?, ?)", rows)
+        similar.rebuild(conn, k)
+        conn.execute("COMMIT")
+        product_id, name, description, category, price = rows[len(rows) // 2]
+        conn.execute("UPDATE products SET product_name = ?, price = ? WHERE id = ?",
+                     (f"{name} {rows[0][1]}", price * 1.1, product_id))
+        start = time.perf_counter()
+        refreshed, _ = similar.drain(conn, path, k)
+        ms = (time.perf_counter() - start) * 1000
+        conn.close()
+    return refreshed, ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,2000,5000,20000")
+    parser.add_argument("--pairwise-max", type=int, default=2000)
+    parser.add_argument("--k", type=int, default=similar.DEFAULT_K)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"top {args.k} similar listings for every listing")
+    print(f"{'listings':>9}{'pairwise s':>12}{'MiB':>8}{'numpy s':>10}{'MiB':>8}{'speedup':>10}"
+          f"{'same ids':>10}{'max diff':>10}")
+    for size in sizes:
+        rows = catalog(size)
+        numpy_s, numpy_mib, fast = measure(numpy_build, rows, args.k)
+        if size > args.pairwise_max:
+            print(f"{size:>9}{'-':>12}{'-':>8}{numpy_s:>10.2f}{numpy_mib:>8.1f}")
+            continue
+        slow_s, slow_mib, slow = measure(pairwise, rows, args.k)
+        same, difference = agreement(slow, fast)
+        # float32 scores; ids only differ between tied scores
+        assert difference < 1e-4, difference
+        print(f"{size:>9}{slow_s:>12.2f}{slow_mib:>8.1f}{numpy_s:>10.2f}{numpy_mib:>8.1f}"
+              f"{slow_s / numpy_s:>9.1f}x{same:>10.1%}{difference:>10.1e}")
+
+    refreshed, ms = refresh_one(catalog(sizes[-1]), args.k)
+    print(f"incremental refresh of one edited listing in {sizes[-1]}: {ms:.1f} ms "
+          f"({refreshed} lists rewritten)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import sqlite3
+import sys
+from datetime import datetime
+import cache
+
+# Bulk import/export of product listings as CSV or NDJSON.
+# Imports stream the input row by row, validate each row and insert the
+# valid ones with executemany() in transactions of `chunk_size` rows, so a
+# few thousand listings cost a handful of commits instead of one each.
+# Each transaction also records how far the job got in bulk_imports; if
+# the import dies half way, running it again with the same job name skips
+# the rows that were already committed. Exports read the table in id
+# order, one batch at a time, and yield text as they go.
+
+FIELDS = ("product_name", "price", "category", "image_url", "seller",
+          "location", "description", "timestamp")
+EXPORT_FIELDS = ("id",) + FIELDS
+FORMATS = ("csv", "ndjson")
+MIME_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+DEFAULT_CHUNK_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+MAX_NAME_LENGTH = 200
+MAX_TEXT_LENGTH = 5000
+# Rejected rows listed in the summary; the rest are only counted
+MAX_ERRORS = 50
+
+# seller_id is looked up from the row's seller name (parameter number
+# FIELDS.index("seller") + 1); unknown names leave the listing without one
+INSERT_SQL = f"""INSERT INTO products ({", ".join(FIELDS)}, seller_id)
+                 VALUES ({", ".join("?" for _ in FIELDS)},
+                         (SELECT id FROM user WHERE username = ?{FIELDS.index("seller") + 1}))"""
+
+
+class RowError(ValueError):
+    pass
+
+
+def format_for(filename, default="csv"):
+    # Format from a file name or content type, e.g. "items.ndjson"
+    name = (filename or "").lower()
+    if name.endswith((".ndjson", ".jsonl", "ndjson", "jsonl")):
+        return "ndjson"
+    if name.endswith("csv"):
+        return "csv"
+    return default
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row dict) from a text stream.
+
+    Unparseable NDJSON lines are yielded as (line number, None) so the
+    caller can count them as rejected and carry on.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None
+                continue
+            yield line_number, row if isinstance(row, dict) else None
+
+
+def _text(row, field, limit=MAX_TEXT_LENGTH):
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    if len(value) > limit:
+        raise RowError(f"{field} is longer than {limit} characters")
+    return value or None
+
+
+def clean_row(row, seller=None, now=None):
+    """Validate one input row and return the tuple to insert (FIELDS order).
+
+    `seller` overrides the row's own seller column (used by the web
+    endpoint, where every imported listing belongs to the signed-in user).
+    """
+    if row is None:
+        raise RowError("not a valid record")
+    name = _text(row, "product_name", MAX_NAME_LENGTH)
+    if not name:
+        raise RowError("product_name is required")
+
+    try:
+        price = float(row.get("price"))
+    except (TypeError, ValueError):
+        raise RowError("price must be a number")
+    if not math.isfinite(price) or price < 0:
+        raise RowError("price must be zero or more")
+
+    image_url = _text(row, "image_url")
+    if image_url and not image_url.startswith(("http://", "https://", "/static/")):
+        raise RowError("image_url must be an http(s) URL or a /static/ path")
+
+    seller = seller or _text(row, "seller", MAX_NAME_LENGTH)
+    if not seller:
+        raise RowError("seller is required")
+
+    timestamp = _text(row, "timestamp")
+    if timestamp:
+        try:
+            timestamp = datetime.fromisoformat(timestamp).isoformat()
+        except ValueError:
+            raise RowError("timestamp must be an ISO 8601 date")
+    else:
+        timestamp = now or datetime.now().isoformat()
+
+    return (name, price, _text(row, "category", MAX_NAME_LENGTH), image_url, seller,
+            _text(row, "location", MAX_NAME_LENGTH), _text(row, "description"), timestamp)
+
+
+def _job_state(conn, job):
+    row = conn.execute("SELECT rows_done, imported, rejected, finished FROM bulk_imports "
+                       "WHERE job = ?", (job,)).fetchone()
+    return tuple(row) if row else (0, 0, 0, 0)
+
+
+def _save_progress(conn, job, rows_done, imported, rejected, finished=False):
+    conn.execute("""
+        INSERT INTO bulk_imports (job, rows_done, imported, rejected, finished, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (job) DO UPDATE SET rows_done = excluded.rows_done,
+            imported = excluded.imported, rejected = excluded.rejected,
+            finished = excluded.finished, updated_at = excluded.updated_at
+    """, (job, rows_done, imported, rejected, int(finished), datetime.now().isoformat()))
+
+
+def import_rows(conn, rows, job=None, seller=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                progress=None, restart=False):
+    """Insert validated rows from read_rows() in chunked transactions.
+
+    With a `job` name, progress is committed alongside every chunk and a
+    later call with the same name resumes after the last committed row
+    (`restart=True` starts over). `progress(summary)` is called after each
+    commit. Returns the summary dict.
+    """
+    rows_done = imported = rejected = 0
+    if job and not restart:
+        rows_done, imported, rejected, finished = _job_state(conn, job)
+        if finished:
+            return {"job": job, "imported": imported, "rejected": rejected,
+                    "rows": rows_done, "resumed_from": rows_done, "errors": [],
+                    "already_finished": True}
+    skip = rows_done
+    summary = {"job": job, "imported": imported, "rejected": rejected, "rows": rows_done,
+               "resumed_from": skip, "errors": []}
+
+    now = datetime.now().isoformat()
+    batch = []
+    batch_rejected = 0
+    seen = 0
+
+    def flush(finished=False):
+        nonlocal batch, batch_rejected
+        if batch:
+            conn.executemany(INSERT_SQL, batch)
+            cache.invalidate(conn, "catalog")
+        summary["imported"] += len(batch)
+        summary["rejected"] += batch_rejected
+        summary["rows"] = seen
+        if job:
+            _save_progress(conn, job, seen, summary["imported"], summary["rejected"], finished)
+        conn.commit()
+        batch, batch_rejected = [], 0
+        if progress:
+            progress(summary)
+
+    try:
+        for line_number, row in rows:
+            seen += 1
+            if seen <= skip:
+                continue
+            try:
+                batch.append(clean_row(row, seller=seller, now=now))
+            except RowError as e:
+                batch_rejected += 1
+                if len(summary["errors"]) < MAX_ERRORS:
+                    summary["errors"].append({"line": line_number, "error": str(e)})
+            if len(batch) + batch_rejected >= chunk_size:
+                flush()
+        flush(finished=True)
+    except BaseException:
+        # Keep everything committed so far; the open chunk is retried on resume
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    return summary
+
+
+def export_rows(conn, fmt, category=None, seller=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the catalog as CSV or NDJSON text, one batch of rows at a time."""
+    filters, params = ["id > ?"], []
+    if category:
+        filters.append("category_lower = ?")
+        params.append(category.lower())
+    if seller:
+        filters.append("seller_id = (SELECT id FROM user WHERE username = ?)")
+        params.append(seller)
+    query = (f"SELECT {', '.join(EXPORT_FIELDS)} FROM products WHERE {' AND '.join(filters)} "
+             f"ORDER BY id LIMIT ?")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+
+    last_id = 0
+    while True:
+        rows = conn.execute(query, [last_id] + params + [batch_size]).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        buffer.seek(0)
+        buffer.truncate()
+        if fmt == "csv":
+            writer.writerows(tuple(row) for row in rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n")
+        yield buffer.getvalue()
+
+
+def main(argv=None):
+    from migrations import migrate
+
+    parser = argparse.ArgumentParser(description="Bulk import/export of product listings.")
+    parser.add_argument("--db", default="marketplace.db")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="load listings from a CSV or NDJSON file")
+    importer.add_argument("path", help="input file, or - for stdin")
+    importer.add_argument("--format", choices=FORMATS)
+    importer.add_argument("--seller", help="assign every listing to this seller")
+    importer.add_argument("--job", help="job name used to resume (default: the file name)")
+    importer.add_argument("--restart", action="store_true", help="ignore earlier progress")
+    importer.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+
+    exporter = commands.add_parser("export", help="write listings as CSV or NDJSON")
+    exporter.add_argument("path", nargs="?", default="-", help="output file (default: stdout)")
+    exporter.add_argument("--format", choices=FORMATS)
+    exporter.add_argument("--category")
+    exporter.add_argument("--seller")
+    args = parser.parse_args(argv)
+
+    migrate(args.db)
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    try:
+        fmt = args.format or format_for(args.path)
+        if args.command == "export":
+            out = sys.stdout if args.path == "-" else open(args.path, "w", newline="", encoding="utf-8")
+            try:
+                for text in export_rows(conn, fmt, category=args.category, seller=args.seller):
+                    out.write(text)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            return
+
+        job = args.job or (None if args.path == "-" else os.path.basename(args.path))
+        stream = sys.stdin if args.path == "-" else open(args.path, newline="", encoding="utf-8-sig")
+
+        def report(summary):
+            print(f"… {summary['rows']} rows read, {summary['imported']} imported, "
+                  f"{summary['rejected']} rejected", file=sys.stderr)
+
+        try:
+            summary = import_rows(conn, read_rows(stream, fmt), job=job, seller=args.seller,
+                                  chunk_size=args.chunk_size, progress=report,
+                                  restart=args.restart)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if summary.get("already_finished"):
+            print(f"Job {job!r} already finished; use --restart to import it again.")
+            return
+        for error in summary["errors"]:
+            print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+        if summary["resumed_from"]:
+            print(f"Resumed after row {summary['resumed_from']}.")
+        print(f"✅ Imported {summary['imported']} products ({summary['rejected']} rejected).")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context, render_template
+from markupsafe import Markup
+from images import PLACEHOLDER
+
+# Query-result and fragment cache for the product catalog.
+# Entries are keyed on the current "generation" of the data they were
+# built from (see cache_generations in migrations.py). Views that change a
+# listing bump its generations in the same transaction as the write, so
+# every worker misses on its next lookup and nothing stale is served, with
+# no TTL guessing. Old entries simply stop being asked for and age out.
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class MemoryCache:
+    # Per-process LRU with a TTL per entry
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    # Shared between gunicorn workers through a small SQLite file
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES * 8):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires REAL NOT NULL
+                )
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (repr(key), time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                     (repr(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl))
+        self._writes += 1
+        if self._writes % 256 == 0:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            cursor = conn.execute("""
+                DELETE FROM cache WHERE rowid IN (
+                    SELECT rowid FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            self.evictions += cursor.rowcount
+        conn.commit()
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class CatalogCache:
+    def __init__(self, backend, ttl=DEFAULT_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_or_set(self, key, compute, ttl=None):
+        # `ttl` may be a function of the computed value
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        if callable(ttl):
+            ttl = ttl(value)
+        self.backend.set(key, value, ttl or self.ttl)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.backend.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def generations(conn, *tags):
+    """Current version of each tag, as a tuple usable in a cache key."""
+    placeholders = ", ".join("?" for _ in tags)
+    rows = dict(conn.execute(
+        f"SELECT tag, version FROM cache_generations WHERE tag IN ({placeholders})", tags
+    ).fetchall())
+    return tuple(rows.get(tag, 0) for tag in tags)
+
+
+def invalidate(conn, *tags):
+    # Call inside the transaction that changes the data; does not commit
+    conn.executemany("""
+        INSERT INTO cache_generations (tag, version) VALUES (?, 1)
+        ON CONFLICT (tag) DO UPDATE SET version = version + 1
+    """, [(tag,) for tag in tags])
+    if has_app_context():  # command-line writers have no cache to count on
+        get_cache().invalidations += 1
+
+
+def invalidate_product(conn, item_id=None):
+    # Every listing page depends on "catalog"; a detail page on its item
+    if item_id is None:
+        invalidate(conn, "catalog")
+    else:
+        invalidate(conn, "catalog", f"item:{item_id}")
+
+
+OWNER_CONTROLS = "<!--owner-controls:{}-->"
+# Fragments that still show an image placeholder are kept only briefly, so
+# the real thumbnail appears as soon as the variant worker has written it.
+PLACEHOLDER_TTL = 5
+
+
+def fragment_ttl(value):
+    return PLACEHOLDER_TTL if PLACEHOLDER in value.get("fragment", "") else None
+
+
+def fill_owner_controls(fragment, items, user_id):
+    """Swap the per-item placeholders in a cached listing fragment.
+
+    Edit/Delete buttons depend on who is looking, so the shared fragment
+    only carries a marker; it is replaced here for the viewer's own items.
+    """
+    for item in items:
+        marker = OWNER_CONTROLS.format(item["id"])
+        controls = ""
+        if item.get("seller_id") == user_id:
+            controls = render_template("_owner_controls.html", item_id=item["id"])
+        fragment = fragment.replace(marker, controls, 1)
+    return Markup(fragment)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(app=None):
+    app = app or current_app
+    key = os.getpid()
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                if app.config["CACHE_BACKEND"] == "disk":
+                    backend = DiskCache(app.config["CACHE_DATABASE"],
+                                        max_entries=app.config["CACHE_MAX_ENTRIES"] * 8)
+                else:
+                    backend = MemoryCache(app.config["CACHE_MAX_ENTRIES"])
+                cache = CatalogCache(backend, ttl=app.config["CACHE_TTL"])
+                _caches[key] = cache
+    return cache
+
+
+def init_app(app):
+    app.config.setdefault("CACHE_BACKEND", os.environ.get("CACHE_BACKEND", "memory"))
+    app.config.setdefault("CACHE_DATABASE", os.path.join(app.root_path, "cache.db"))
+    app.config.setdefault("CACHE_TTL", DEFAULT_TTL)
+    app.config.setdefault("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import threading
+from flask import current_app, g
+from sqlalchemy import event, exc
+
+import geo
+
+# One engine for everything: the Flask-SQLAlchemy engine over marketplace.db.
+# Its QueuePool hands each request one connection (stored on flask.g and
+# returned in a teardown hook), so connect + PRAGMA setup only happens once
+# per pooled connection. repository.py runs SQLAlchemy statements on it;
+# modules written against sqlite3 (messaging, search, cache, bulk) get the
+# same underlying DB-API connection from get_db(), so both kinds of query
+# share one transaction.
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_MMAP_SIZE = 64 * 1024 * 1024
+DEFAULT_CACHED_STATEMENTS = 256
+
+
+class PoolCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+
+    def connected(self):
+        with self._lock:
+            self.connects += 1
+
+    def checked_out(self):
+        with self._lock:
+            self.checkouts += 1
+
+
+def _configure_engine(engine, busy_timeout, mmap_size, counters):
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+        dbapi_connection.row_factory = sqlite3.Row
+        geo.register_math(dbapi_connection)
+        # One script, so connection setup is not counted as request queries
+        dbapi_connection.executescript(f"""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA busy_timeout={int(busy_timeout)};
+            PRAGMA mmap_size={int(mmap_size)};
+        """)
+        counters.connected()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        # A forked gunicorn worker must never reuse a connection that was
+        # opened in the master process: drop it and open a fresh one
+        if connection_record.info["pid"] != os.getpid():
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError("connection belongs to another process")
+        counters.checked_out()
+
+
+def get_engine(app=None):
+    return (app or current_app).extensions["sqlalchemy"].engine
+
+
+def get_connection():
+    """The request's SQLAlchemy Connection, checked out on first use."""
+    if "db_connection" not in g:
+        g.db_connection = get_engine().connect()
+        g.db_conn = g.db_connection.connection.dbapi_connection
+    return g.db_connection
+
+
+def get_db():
+    """The same connection as a sqlite3 DB-API connection."""
+    get_connection()
+    return g.db_conn
+
+
+def connect(app):
+    # A connection that outlives the request (streamed responses); the
+    # caller closes it to give it back to the pool
+    return get_engine(app).connect()
+
+
+def fill_pool(app):
+    # Open every pooled connection now (PRAGMA setup included), so the
+    # first requests a worker serves do not pay for it
+    engine = get_engine(app)
+    connections = [engine.connect() for _ in range(engine.pool.size())]
+    for connection in connections:
+        connection.close()
+
+
+def close_db(exc=None):
+    g.pop("db_conn", None)
+    connection = g.pop("db_connection", None)
+    if connection is not None:
+        if isinstance(exc, sqlite3.DatabaseError):
+            connection.invalidate()
+        # Rolls back anything left uncommitted
+        connection.close()
+
+
+def pool_stats(app):
+    pool = get_engine(app).pool
+    counters = app.extensions["db_pool_counters"]
+    idle, checked_out = pool.checkedin(), pool.checkedout()
+    reuses = max(0, counters.checkouts - counters.connects)
+    return {
+        "size": pool.size(),
+        "open": idle + checked_out,
+        "idle": idle,
+        "checked_out": checked_out,
+        "checkouts": counters.checkouts,
+        "reuses": reuses,
+        "reuse_ratio": round(reuses / counters.checkouts, 4) if counters.checkouts else 0.0,
+    }
+
+
+def init_app(app, db):
+    """Point `db` (the Flask-SQLAlchemy extension) at DATABASE and set up its pool."""
+    config = app.config
+    config.setdefault("DATABASE", os.environ.get("DATABASE", os.path.join(app.root_path, "marketplace.db")))
+    # Users live in the same database as the listings and messages that
+    # reference them
+    config.setdefault("SQLALCHEMY_DATABASE_URI", os.environ.get(
+        "SQLALCHEMY_DATABASE_URI", "sqlite:///" + os.path.abspath(config["DATABASE"])))
+    config.setdefault("DB_POOL_SIZE", int(os.environ.get("DB_POOL_SIZE", DEFAULT_POOL_SIZE)))
+    busy_timeout = config.get("DB_BUSY_TIMEOUT_MS", DEFAULT_BUSY_TIMEOUT_MS)
+    config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": 0,
+        "pool_timeout": busy_timeout / 1000,
+        "connect_args": {
+            "timeout": busy_timeout / 1000,
+            "check_same_thread": False,
+            "cached_statements": config.get("DB_CACHED_STATEMENTS", DEFAULT_CACHED_STATEMENTS),
+            "factory": config.get("DB_CONNECTION_FACTORY", sqlite3.Connection),
+        },
+    })
+    db.init_app(app)
+
+    counters = app.extensions["db_pool_counters"] = PoolCounters()
+    with app.app_context():
+        _configure_engine(db.engine, busy_timeout,
+                          config.get("DB_MMAP_SIZE", DEFAULT_MMAP_SIZE), counters)
+    app.teardown_appcontext(close_db)
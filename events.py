@@ -0,0 +1,313 @@
+import collections
+import json
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from flask import current_app
+
+# Push channel for new messages and unread-count changes.
+# Views publish events to a per-process EventHub; connected users receive
+# them over /events/stream (server-sent events) or /events/poll (long-poll).
+# The hub delivers through a pluggable backend:
+#   - LocalBackend: in-process only (single worker, or tests)
+#   - SQLiteBackend: events are appended to a small fan-out table that every
+#     worker process tails, so gunicorn workers see each other's events.
+# Every event gets an id (the events table row id with the SQLite backend,
+# so ids agree across workers), and the hub keeps the latest ones in a
+# replay buffer: a long-poll client passes back the cursor it was given and
+# gets whatever was published while it was between requests.
+
+DEFAULT_MAX_CONNECTIONS = 200
+# Of which event streams; None: no limit of their own
+DEFAULT_MAX_STREAMS = None
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_HEARTBEAT = 15
+DEFAULT_REPLAY_SIZE = 1024
+
+
+class HubFull(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, user, queue_size):
+        self.user = user
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A slow client fell behind: drop its backlog and tell it to
+            # refetch state instead of letting the queue grow without bound.
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.queue.put_nowait({"type": "resync"})
+
+    def close(self):
+        # Ends the stream: wakes a waiting get(), which then returns None
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    def __init__(self, backend, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 queue_size=DEFAULT_QUEUE_SIZE, replay_size=DEFAULT_REPLAY_SIZE,
+                 max_streams=DEFAULT_MAX_STREAMS):
+        self.backend = backend
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._count = 0
+        self._streams = 0
+        self._lock = threading.Lock()
+        # (id, user, event) of the latest events; ids up to _forgotten are
+        # no longer (or were never) in the buffer
+        self._replay = collections.deque(maxlen=replay_size)
+        self._last_id = self._forgotten = 0
+        self.closed = False
+        self.published = 0
+        self.publish_failures = 0
+        self.delivered = 0
+        backend.start(self)
+
+    def subscribe(self, user, stream=False):
+        # Keys are compared as text: the SQLite backend hands them back as TEXT.
+        # `stream`: held open for as long as the page is (/events/stream),
+        # not just for one long poll
+        user = str(user)
+        with self._lock:
+            if self.closed or self._count >= self.max_connections:
+                raise HubFull()
+            if stream and self.max_streams is not None and self._streams >= self.max_streams:
+                raise HubFull()
+            subscription = Subscription(user, self.queue_size)
+            subscription.stream = stream
+            self._subscribers.setdefault(user, set()).add(subscription)
+            self._count += 1
+            self._streams += stream
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._count -= 1
+                self._streams -= subscription.stream
+                if not subscribers:
+                    del self._subscribers[subscription.user]
+
+    def close(self):
+        # Worker shutdown: refuse new subscribers and end the open streams
+        with self._lock:
+            self.closed = True
+            subscriptions = [s for subscribers in self._subscribers.values() for s in subscribers]
+        for subscription in subscriptions:
+            subscription.close()
+
+    def publish(self, user, event):
+        # Called after the write it reports is committed: a failure here
+        # must not turn a stored message into an error the client retries
+        self.published += 1
+        try:
+            self.backend.publish(str(user), event)
+        except sqlite3.Error as e:
+            self.publish_failures += 1
+            print("Event publish error:", e)
+
+    def dispatch(self, user, event, event_id=None):
+        # Called by the backend in every process that may hold `user`'s
+        # connections; delivers to the local ones only. Buffered first, so
+        # a poll that subscribed before it read the buffer misses nothing.
+        with self._lock:
+            event_id = event_id or self._last_id + 1
+            if len(self._replay) == self._replay.maxlen:
+                self._forgotten = self._replay[0][0]
+            self._replay.append((event_id, user, event))
+            self._last_id = event_id
+            subscribers = list(self._subscribers.get(user, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+        self.delivered += len(subscribers)
+
+    def start_from(self, event_id):
+        # Events up to `event_id` happened before this process was listening
+        with self._lock:
+            self._last_id = self._forgotten = event_id
+
+    def replay(self, user, cursor):
+        """(events for `user` published after `cursor`, cursor to pass next time).
+
+        Without a cursor, starts from now. A cursor the buffer no longer
+        reaches back to, or one issued for other event ids (another process
+        with the local backend), gets a resync event instead.
+        """
+        user = str(user)
+        epoch, _, after = (cursor or "").partition(".")
+        with self._lock:
+            if not cursor:
+                return [], f"{self.backend.epoch}.{self._last_id}"
+            if epoch != self.backend.epoch or not after.isdigit() or int(after) < self._forgotten:
+                return [{"type": "resync"}], f"{self.backend.epoch}.{self._last_id}"
+            after = int(after)
+            received = [event for event_id, for_user, event in self._replay
+                        if event_id > after and for_user == user]
+            return received, f"{self.backend.epoch}.{max(after, self._last_id)}"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections": self._count,
+                "max_connections": self.max_connections,
+                "streams": self._streams,
+                "max_streams": self.max_streams,
+                "users": len(self._subscribers),
+                "published": self.published,
+                "publish_failures": self.publish_failures,
+                "delivered": self.delivered,
+            }
+
+
+class LocalBackend:
+    # Event ids are counted in this process only
+    def __init__(self):
+        self.epoch = secrets.token_hex(4)
+
+    def start(self, hub):
+        self.hub = hub
+
+    def publish(self, user, event):
+        self.hub.dispatch(user, event)
+
+
+class SQLiteBackend:
+    # Event ids are the events table's, the same in every worker
+    epoch = "db"
+
+    def __init__(self, path, poll_interval=0.25, retention=60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        """)
+        return conn
+
+    def start(self, hub):
+        self.hub = hub
+        self._publish_conn = self._connect()
+        self._publish_lock = threading.Lock()
+        # Only deliver events published after this process started
+        row = self._publish_conn.execute("SELECT MAX(id) FROM events").fetchone()
+        self._last_id = row[0] or 0
+        hub.start_from(self._last_id)
+        thread = threading.Thread(target=self._tail, name="events-tail", daemon=True)
+        thread.start()
+
+    def publish(self, user, event):
+        with self._publish_lock:
+            self._publish_conn.execute(
+                "INSERT INTO events (user, payload, created) VALUES (?, ?, ?)",
+                (user, json.dumps(event), time.time()),
+            )
+            self._publish_conn.commit()
+
+    def _tail(self):
+        conn = self._connect()
+        last_prune = time.monotonic()
+        while True:
+            try:
+                rows = conn.execute(
+                    "SELECT id, user, payload FROM events WHERE id > ? ORDER BY id",
+                    (self._last_id,),
+                ).fetchall()
+                for event_id, user, payload in rows:
+                    self._last_id = event_id
+                    self.hub.dispatch(user, json.loads(payload), event_id)
+                if time.monotonic() - last_prune > self.retention:
+                    conn.execute("DELETE FROM events WHERE created < ?",
+                                 (time.time() - self.retention,))
+                    conn.commit()
+                    last_prune = time.monotonic()
+            except sqlite3.Error as e:
+                print("Event backend error:", e)
+            time.sleep(self.poll_interval)
+
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def get_hub(app=None):
+    # One hub per worker process; the SQLite tail thread must be started
+    # after gunicorn forks, never inherited from the master.
+    app = app or current_app
+    key = os.getpid()
+    hub = _hubs.get(key)
+    if hub is None:
+        with _hubs_lock:
+            hub = _hubs.get(key)
+            if hub is None:
+                if app.config["EVENT_BACKEND"] == "sqlite":
+                    backend = SQLiteBackend(app.config["EVENTS_DATABASE"])
+                else:
+                    backend = LocalBackend()
+                hub = EventHub(
+                    backend,
+                    max_connections=app.config["EVENT_MAX_CONNECTIONS"],
+                    queue_size=app.config["EVENT_QUEUE_SIZE"],
+                    replay_size=app.config["EVENT_REPLAY_SIZE"],
+                    max_streams=app.config["EVENT_MAX_STREAMS"],
+                )
+                _hubs[key] = hub
+    return hub
+
+
+def publish(user, event):
+    get_hub().publish(user, event)
+
+
+def format_sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+def init_app(app):
+    app.config.setdefault("EVENT_BACKEND", os.environ.get("EVENT_BACKEND", "local"))
+    app.config.setdefault("EVENTS_DATABASE", os.path.join(app.root_path, "events.db"))
+    # Each open stream or long poll holds a request thread under gthread;
+    # gunicorn.conf.py sizes both limits below the thread count
+    app.config.setdefault("EVENT_MAX_CONNECTIONS",
+                          int(os.environ.get("EVENT_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)))
+    max_streams = os.environ.get("EVENT_MAX_STREAMS")
+    app.config.setdefault("EVENT_MAX_STREAMS", int(max_streams) if max_streams else DEFAULT_MAX_STREAMS)
+    app.config.setdefault("EVENT_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)
+    app.config.setdefault("EVENT_HEARTBEAT", DEFAULT_HEARTBEAT)
+    app.config.setdefault("EVENT_REPLAY_SIZE", DEFAULT_REPLAY_SIZE)
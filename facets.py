@@ -0,0 +1,121 @@
+import sqlite3
+import sys
+import cache
+
+# Category and price facets for the /items filters.
+# The `facets` table (created in migrations.py) holds one row per
+# (category, price bucket) with the number of listings in it. Triggers on
+# products keep it current on every INSERT/UPDATE/DELETE, so the filter
+# dropdown is built from a few dozen rollup rows instead of a GROUP BY
+# over every listing.
+
+# Lower edges of the price buckets: bucket i holds prices from
+# PRICE_EDGES[i] up to (not including) PRICE_EDGES[i + 1]; the last bucket
+# is open-ended. Changing them needs a migration that recreates the
+# triggers and rebuilds the table.
+PRICE_EDGES = (0, 5, 10, 25, 50, 100, 250, 500)
+
+
+def bucket_expression(price):
+    """SQL CASE giving the price bucket of the column/expression `price`."""
+    cases = " ".join(f"WHEN {price} < {edge} THEN {index - 1}"
+                     for index, edge in enumerate(PRICE_EDGES) if index)
+    return f"(CASE WHEN {price} IS NULL THEN 0 {cases} ELSE {len(PRICE_EDGES) - 1} END)"
+
+
+# Rows the table should hold, computed from scratch
+EXPECTED_QUERY = f"""
+    SELECT COALESCE(category, '') AS category, {bucket_expression('price')} AS price_bucket,
+           COUNT(*) AS products
+    FROM products
+    GROUP BY 1, 2
+"""
+
+
+def bucket_range(bucket):
+    # (min_price, max_price) for a bucket; max_price is None for the last one
+    low = PRICE_EDGES[bucket]
+    high = PRICE_EDGES[bucket + 1] if bucket + 1 < len(PRICE_EDGES) else None
+    return low, high
+
+
+def summarize(rows, category=None):
+    """Shape facet rows for the /items filters.
+
+    Returns (categories, buckets): categories are (label, count) pairs
+    with names that only differ in case merged (the most common spelling
+    is shown); buckets are (bucket, min_price, max_price, count) for the
+    selected category, or for all listings.
+    """
+    spellings = {}
+    bucket_counts = [0] * len(PRICE_EDGES)
+    selected = category.lower() if category else None
+    for name, bucket, count in rows:
+        if name:
+            key = name.lower()
+            spellings.setdefault(key, {})
+            spellings[key][name] = spellings[key].get(name, 0) + count
+        if selected is None or name.lower() == selected:
+            bucket_counts[bucket] += count
+
+    categories = sorted(
+        ((max(names, key=names.get), sum(names.values())) for names in spellings.values()),
+        key=lambda pair: pair[0].lower(),
+    )
+    buckets = [(bucket, *bucket_range(bucket), count)
+               for bucket, count in enumerate(bucket_counts) if count]
+    return categories, buckets
+
+
+def check(conn):
+    """Rollup rows that disagree with the products table.
+
+    Returns a list of (category, bucket, stored count, actual count).
+    """
+    rows = conn.execute(f"""
+        SELECT e.category, e.price_bucket, COALESCE(f.products, 0), e.products
+        FROM ({EXPECTED_QUERY}) e
+        LEFT JOIN facets f ON f.category = e.category AND f.price_bucket = e.price_bucket
+        WHERE f.products IS NOT e.products
+        UNION ALL
+        SELECT f.category, f.price_bucket, f.products, 0
+        FROM facets f
+        WHERE f.products != 0 AND NOT EXISTS (
+            SELECT 1 FROM ({EXPECTED_QUERY}) e
+            WHERE e.category = f.category AND e.price_bucket = f.price_bucket
+        )
+    """).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def rebuild(conn):
+    # Recompute every rollup row from the products table. Does not commit.
+    conn.execute("DELETE FROM facets")
+    conn.execute(f"INSERT INTO facets (category, price_bucket, products) {EXPECTED_QUERY}")
+    # Listing pages render the dropdown from the rollup
+    cache.invalidate(conn, "catalog")
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+
+    db_path = "marketplace.db"
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        command = sys.argv[1] if len(sys.argv) > 1 else None
+        if command == "check":
+            problems = check(conn)
+            for category, bucket, stored, actual in problems:
+                print(f"❌ {category or '(none)'} / bucket {bucket}: {stored} stored, {actual} actual")
+            if not problems:
+                print("✅ Facet counts match the products table.")
+            sys.exit(1 if problems else 0)
+        elif command == "rebuild":
+            rebuild(conn)
+            conn.commit()
+            print(f"✅ Rebuilt {conn.execute('SELECT COUNT(*) FROM facets').fetchone()[0]} facet rows.")
+        else:
+            print("Usage: python facets.py check | python facets.py rebuild")
+    finally:
+        conn.close()
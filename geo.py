@@ -0,0 +1,211 @@
+import csv
+import math
+import os
+import re
+import sqlite3
+import sys
+import cache
+
+# Nearby-listing search.
+# Listing locations are free text ("Scott Library, 2nd floor", "Stong").
+# They are matched against a gazetteer of campus buildings and
+# neighbourhoods (gazetteer.csv, loaded into the `places` and
+# `place_names` tables), and every listing whose location names a place
+# gets a point in the `products_geo` R*Tree. Triggers on products keep the
+# R*Tree current on every INSERT/UPDATE OF location/DELETE, so a near=
+# query is a bounding-box lookup in the R*Tree followed by a distance check
+# on the points inside the box (repository.py).
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv")
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.radians(EARTH_RADIUS_KM)
+DEFAULT_RADIUS_KM = 1.0
+MAX_RADIUS_KM = 25.0
+
+# Treated as spaces when matching names, so "Vari Hall, rm. 1022" names
+# Vari Hall. normalize() and normalized_sql() must agree. Each character is
+# one nested replace() in the trigger SQL, and SQLite's parser stack only
+# takes a couple of dozen levels.
+PUNCTUATION = ",.;:!?()/-&'#"
+_COORDINATES = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+
+# SQLite builds without SQLITE_ENABLE_MATH_FUNCTIONS lack sqrt()
+try:
+    sqlite3.connect(":memory:").execute("SELECT sqrt(0)")
+    MATH_FUNCTIONS = True
+except sqlite3.OperationalError:
+    MATH_FUNCTIONS = False
+
+
+def register_math(conn):
+    # A Python stand-in for the SQL sqrt() the distance check uses
+    if not MATH_FUNCTIONS:
+        conn.create_function("sqrt", 1, math.sqrt, deterministic=True)
+
+
+def normalize(text):
+    text = (text or "").lower()
+    for char in PUNCTUATION:
+        text = text.replace(char, " ")
+    return " ".join(text.split())
+
+
+def normalized_sql(expr):
+    # normalize() in SQL, for ASCII text with runs of up to 4 spaces
+    for char in PUNCTUATION:
+        expr = f"replace({expr}, '{char.replace(chr(39), chr(39) * 2)}', ' ')"
+    for _ in range(2):
+        expr = f"replace({expr}, '  ', ' ')"
+    return f"trim(lower({expr}))"
+
+
+def resolve_sql(expr):
+    """SQL for the id of the place named in `expr`, or NULL.
+
+    The longest name or alias found as whole words wins: "Steacie Library"
+    is Steacie, not Scott Library ("library").
+    """
+    # The text is normalized once (materialized), not once per place name
+    return f"""
+        SELECT n.place_id
+        FROM (SELECT ' ' || {normalized_sql(expr)} || ' ' AS words) s, place_names n
+        WHERE instr(s.words, ' ' || n.name || ' ') > 0
+        ORDER BY length(n.name) DESC
+        LIMIT 1
+    """
+
+
+def geo_row_sql(product_id, location):
+    # INSERT INTO products_geo for one listing; no row if nothing matches
+    return f"""
+        INSERT INTO products_geo (id, min_lat, max_lat, min_lon, max_lon, place_id)
+        SELECT {product_id}, latitude, latitude, longitude, longitude, id
+        FROM places WHERE id = ({resolve_sql(location)})
+    """
+
+
+def read_gazetteer(path=GAZETTEER_PATH):
+    """[(name, latitude, longitude, [aliases])] from a gazetteer CSV."""
+    with open(path, newline="", encoding="utf-8") as f:
+        lines = (line for line in f if not line.startswith("#"))
+        return [
+            (row["name"].strip(), float(row["latitude"]), float(row["longitude"]),
+             [alias.strip() for alias in (row.get("aliases") or "").split(";") if alias.strip()])
+            for row in csv.DictReader(lines)
+        ]
+
+
+def load(conn, path=GAZETTEER_PATH):
+    """Replace the places with the gazetteer's and re-match every listing.
+
+    Does not commit. Returns the number of listings placed.
+    """
+    conn.execute("DELETE FROM place_names")
+    conn.execute("DELETE FROM places")
+    for place_id, (name, latitude, longitude, aliases) in enumerate(read_gazetteer(path), 1):
+        conn.execute("INSERT INTO places (id, name, latitude, longitude) VALUES (?, ?, ?, ?)",
+                     (place_id, name, latitude, longitude))
+        # A name listed twice keeps its first place
+        conn.executemany("INSERT OR IGNORE INTO place_names (name, place_id) VALUES (?, ?)",
+                         [(normalize(n), place_id) for n in [name, *aliases] if normalize(n)])
+    conn.execute("DELETE FROM products_geo")
+    conn.execute(f"""
+        INSERT INTO products_geo (id, min_lat, max_lat, min_lon, max_lon, place_id)
+        SELECT m.id, p.latitude, p.latitude, p.longitude, p.longitude, p.id
+        FROM (SELECT id, ({resolve_sql('location')}) AS place_id
+              FROM products WHERE location IS NOT NULL) m
+        JOIN places p ON p.id = m.place_id
+    """)
+    # near= results and the place list on /items change
+    cache.invalidate(conn, "catalog")
+    return conn.execute("SELECT COUNT(*) FROM products_geo").fetchone()[0]
+
+
+def resolve(conn, text):
+    """(name, latitude, longitude) for a place name or "lat,lon"; None if unknown."""
+    match = _COORDINATES.match(text or "")
+    if match:
+        latitude, longitude = float(match.group(1)), float(match.group(2))
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            return f"{latitude:.5f},{longitude:.5f}", latitude, longitude
+        return None
+    row = conn.execute(f"SELECT name, latitude, longitude FROM places WHERE id = ({resolve_sql('?')})",
+                       (text,)).fetchone()
+    return tuple(row) if row else None
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """(min_lat, max_lat, min_lon, max_lon) around a circle of radius_km."""
+    dlat = radius_km / KM_PER_DEGREE
+    # Longitude degrees shrink towards the poles; past them, take every longitude
+    cos_lat = math.cos(math.radians(latitude))
+    dlon = 180.0 if cos_lat < 1e-6 else min(180.0, dlat / cos_lat)
+    return latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon
+
+
+def near_params(latitude, longitude, radius_km):
+    """Query parameters for repository's near= filter."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    return {
+        "lat": latitude, "lon": longitude, "lon_scale": math.cos(math.radians(latitude)),
+        # Compared with the squared distance in degrees, so rows need no sqrt()
+        "radius_deg2": (radius_km / KM_PER_DEGREE) ** 2,
+        "min_lat": min_lat, "max_lat": max_lat, "min_lon": min_lon, "max_lon": max_lon,
+    }
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Distance from point 1 to point 2, as repository.py computes it in SQL.
+
+    Equirectangular: within 0.1% of the great-circle distance up to
+    MAX_RADIUS_KM, for a few multiplications instead of a haversine's six
+    trigonometric calls per listing.
+    """
+    dlat = lat2 - lat1
+    dlon = (lon2 - lon1) * math.cos(math.radians(lat1))
+    return KM_PER_DEGREE * math.sqrt(dlat * dlat + dlon * dlon)
+
+
+def check(conn):
+    """Listings whose R*Tree point disagrees with their location.
+
+    Returns a list of (product id, stored place id, expected place id).
+    """
+    rows = conn.execute(f"""
+        SELECT p.id, g.place_id, ({resolve_sql('p.location')}) AS expected
+        FROM products p
+        LEFT JOIN products_geo g ON g.id = p.id
+        WHERE g.place_id IS NOT expected
+    """).fetchall()
+    orphans = conn.execute("""
+        SELECT g.id, g.place_id, NULL FROM products_geo g
+        WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.id = g.id)
+    """).fetchall()
+    return [tuple(row) for row in rows + orphans]
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+
+    db_path = "marketplace.db"
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    register_math(conn)
+    try:
+        command = sys.argv[1] if len(sys.argv) > 1 else None
+        if command == "load":
+            placed = load(conn, sys.argv[2] if len(sys.argv) > 2 else GAZETTEER_PATH)
+            conn.commit()
+            places = conn.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+            print(f"✅ Loaded {places} places; {placed} listings have a location on the map.")
+        elif command == "check":
+            problems = check(conn)
+            for product_id, stored, expected in problems[:20]:
+                print(f"❌ listing {product_id}: place {stored} stored, {expected} expected")
+            if not problems:
+                print("✅ The location index matches the listings.")
+            sys.exit(1 if problems else 0)
+        else:
+            print("Usage: python geo.py load [gazetteer.csv] | python geo.py check")
+    finally:
+        conn.close()
@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import signal
+import threading
+
+# Production server settings: gunicorn -c gunicorn.conf.py
+#
+# The app is imported once in the master (preload_app), so migrations run
+# once and workers fork with the code already loaded. Each worker then
+# sets up its own pools and connections in post_fork (see app.warm_up).
+#
+# Reloads:
+#   kill -HUP <master>   restart the workers with re-read settings; with
+#                        preload_app the code is not re-imported
+#   kill -USR2 <master>, then -TERM to the old master once the new one
+#                        is serving: deploy new code without dropping
+#                        requests
+# On SIGTERM a worker stops accepting, ends its event streams (clients
+# reconnect to another worker) and finishes in-flight requests within
+# graceful_timeout.
+
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5050')}"
+wsgi_app = "app:create_app()"
+preload_app = True
+pidfile = os.environ.get("GUNICORN_PIDFILE")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", cpus * 2 + 1))
+# gthread by default. WORKER_CLASS=gevent (pip install gevent) keeps many
+# idle event streams and long polls open per worker without a thread each.
+worker_class = os.environ.get("WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+if worker_class == "gevent":
+    # Patch before the app (and its locks and queues) is preloaded
+    from gevent import monkey
+    monkey.patch_all()
+
+# Settings the app reads when it is imported in the master
+if workers > 1:
+    # Workers must share events, or a message only reaches the streams
+    # open on the worker that stored it
+    os.environ.setdefault("EVENT_BACKEND", "sqlite")
+# Every worker has its own hashing pool; keep the total near the CPU count
+os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, cpus // workers)))
+# A login holds its request thread while it waits for the hashing pool:
+# past half the threads, shed logins (503) rather than stall the catalog
+os.environ.setdefault("PASSWORD_HASH_QUEUE", str(max(1, threads // 2)))
+if worker_class == "gthread":
+    # Every open event stream holds a worker thread for as long as its page
+    # is open: past a quarter of the threads, pages long-poll instead, and
+    # streams and long polls together never take more than half
+    os.environ.setdefault("EVENT_MAX_STREAMS", str(max(1, threads // 4)))
+    os.environ.setdefault("EVENT_MAX_CONNECTIONS", str(max(1, threads // 2)))
+# One pooled connection per request thread
+os.environ.setdefault("DB_POOL_SIZE", str(max(threads, 1) if worker_class == "gthread" else 8))
+
+
+def post_fork(server, worker):
+    from app import warm_up
+
+    warm_up(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    # gunicorn has installed its own signal handlers by now; end the event
+    # streams first when asked to stop gracefully
+    from app import shut_down
+
+    app = worker.wsgi
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def stop(signum, frame):
+        threading.Thread(target=shut_down, args=(app,), daemon=True).start()
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, stop)
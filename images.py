@@ -0,0 +1,222 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from assets import asset_url
+
+try:
+    from PIL import Image, ImageFile
+except ImportError:  # Pillow is optional: uploads still work, without variants
+    Image = ImageFile = None
+
+# Upload pipeline for product images.
+# Uploads are copied into static/uploads in chunks while being hashed and
+# size/pixel-checked, and stored under their content hash so the same
+# picture uploaded twice is kept once. Resized WebP variants are produced
+# on a small background pool; until they exist, pages get a placeholder.
+
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+MAX_PIXELS = 40_000_000
+# Non-file form fields sent with an upload
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+# variant name -> longest edge in pixels
+VARIANTS = {
+    "thumb": 240,
+    "large": 1200,
+}
+
+PLACEHOLDER = "img/placeholder.svg"
+
+FORMAT_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "GIF": "gif", "WEBP": "webp"}
+
+_HASHED_NAME = re.compile(r"/uploads/([0-9a-f]{64})\.\w+$")
+
+
+class UploadRejected(Exception):
+    pass
+
+
+def store_upload(file, upload_dir, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_PIXELS):
+    """Copy an uploaded file into `upload_dir` under its content hash.
+
+    Limits are checked chunk by chunk, so an oversized file or an image
+    whose header declares too many pixels is rejected as soon as that is
+    known rather than after the whole file is on disk. Returns the stored
+    filename.
+    """
+    digest = hashlib.sha256()
+    parser = ImageFile.Parser() if ImageFile else None
+    size_checked = parser is None
+    image_format = None
+    written = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadRejected(f"Image is larger than {max_bytes // (1024 * 1024)} MB.")
+                digest.update(chunk)
+                out.write(chunk)
+
+                if not size_checked:
+                    # Feed only until the header is parsed; the full decode
+                    # happens later on the variant pool.
+                    try:
+                        parser.feed(chunk)
+                    except Exception:
+                        raise UploadRejected("File is not a valid image.")
+                    if parser.image is not None:
+                        width, height = parser.image.size
+                        if width * height > max_pixels:
+                            raise UploadRejected("Image dimensions are too large.")
+                        image_format = parser.image.format
+                        size_checked = True
+
+        if not size_checked:
+            raise UploadRejected("File is not a valid image.")
+        if parser is not None and image_format not in FORMAT_EXTENSIONS:
+            raise UploadRejected("Unsupported image format.")
+
+        extension = FORMAT_EXTENSIONS.get(image_format) or _extension(file.filename)
+        filename = f"{digest.hexdigest()}.{extension}"
+        final_path = os.path.join(upload_dir, filename)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)  # already stored: keep the one copy
+        else:
+            os.replace(tmp_path, final_path)
+        return filename
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _extension(filename):
+    return filename.rsplit(".", 1)[1].lower() if "." in (filename or "") else "bin"
+
+
+def variant_name(digest, variant):
+    return f"{digest}_{variant}.webp"
+
+
+def make_variants(upload_dir, filename):
+    # Runs on the background pool: decode once, write every variant
+    digest = filename.split(".", 1)[0]
+    with Image.open(os.path.join(upload_dir, filename)) as source:
+        source.load()
+        if source.mode not in ("RGB", "RGBA"):
+            source = source.convert("RGBA" if "transparency" in source.info else "RGB")
+        for variant, edge in VARIANTS.items():
+            target = os.path.join(upload_dir, variant_name(digest, variant))
+            if os.path.exists(target):
+                continue
+            image = source.copy()
+            image.thumbnail((edge, edge))
+            fd, tmp_path = tempfile.mkstemp(dir=upload_dir, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    image.save(out, "WEBP", quality=80, method=4)
+                os.replace(tmp_path, target)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+
+class VariantWorker:
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="image-variants")
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, upload_dir, filename):
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+        self.executor.submit(self._run, upload_dir, filename)
+
+    def _run(self, upload_dir, filename):
+        try:
+            make_variants(upload_dir, filename)
+        except Exception as e:
+            print("Image variant error:", filename, e)
+        finally:
+            with self.lock:
+                self.pending.discard(filename)
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_worker():
+    # One pool per worker process (threads do not survive a gunicorn fork)
+    key = os.getpid()
+    worker = _workers.get(key)
+    if worker is None:
+        with _workers_lock:
+            worker = _workers.get(key)
+            if worker is None:
+                worker = VariantWorker(current_app.config["IMAGE_WORKERS"])
+                _workers[key] = worker
+    return worker
+
+
+def generate_variants_async(filename):
+    if Image is None:
+        return
+    get_worker().submit(current_app.config["UPLOAD_PATH"], filename)
+
+
+def variant_url(image_url, variant):
+    """URL to show for `image_url` at the given size.
+
+    Images stored by store_upload() are served as their WebP variant, or
+    a placeholder while it is still being generated. Older uploads get a
+    fingerprinted URL for the original, and external URLs are returned
+    unchanged.
+    """
+    if not image_url:
+        return image_url
+    match = _HASHED_NAME.search(image_url)
+    if not match or Image is None:
+        if image_url.startswith("/static/"):
+            return asset_url(image_url)
+        return image_url
+    upload_dir = current_app.config["UPLOAD_PATH"]
+    name = variant_name(match.group(1), variant)
+    if os.path.exists(os.path.join(upload_dir, name)):
+        return asset_url("uploads/" + name)
+    original = image_url.rsplit("/", 1)[1]
+    if os.path.exists(os.path.join(upload_dir, original)):
+        # Re-queue in case the worker that accepted the upload went away
+        get_worker().submit(upload_dir, original)
+    return asset_url(PLACEHOLDER)
+
+
+def limit_upload(request):
+    # Werkzeug stops reading this request's body past the upload limit plus
+    # room for the other form fields (413). Set per upload route, before the
+    # form is parsed: a global MAX_CONTENT_LENGTH would also cap the
+    # streamed /items/import
+    request.max_content_length = current_app.config["MAX_UPLOAD_BYTES"] + FORM_OVERHEAD_BYTES
+
+
+def init_app(app):
+    app.config.setdefault("UPLOAD_PATH", os.path.join(app.root_path, "static", "uploads"))
+    app.config.setdefault("IMAGE_WORKERS", 2)
+    app.config.setdefault("MAX_UPLOAD_BYTES", MAX_UPLOAD_BYTES)
+    if Image is not None:
+        Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    app.jinja_env.globals["image_variant"] = variant_url
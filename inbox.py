@@ -0,0 +1,85 @@
+import archive
+import events
+import repository
+from pagination import decode_token, encode_token
+
+# Paged reads of a user's conversations and threads, and the events that
+# keep open pages current; shared by the HTML views (app.py) and /api/v1
+# (routes/api.py). Every inbox / thread request reads a bounded page.
+INBOX_PAGE_SIZE = 20
+THREAD_PAGE_SIZE = 20
+
+
+def conversation_page(conn, user_id, before_token=None, limit=INBOX_PAGE_SIZE):
+    # Returns (conversations, token for the next page or None)
+    before = decode_position(before_token)
+    conversations = repository.conversations_for(conn, user_id, limit=limit + 1, before=before)
+    next_cursor = None
+    if len(conversations) > limit:
+        conversations = conversations[:limit]
+        last = conversations[-1]
+        next_cursor = encode_token([last["last_timestamp"], last["last_message_id"]])
+    return conversations, next_cursor
+
+
+def decode_position(token):
+    # (timestamp, id) of an inbox or thread token; None when it is missing
+    # or is not that shape, and the first page is served instead
+    values = decode_token(token, 2)
+    return values if is_position(values) else None
+
+
+def is_position(values):
+    return bool(values) and isinstance(values[0], str) and type(values[1]) is int
+
+
+def publish_message(message_id, item_id, sender, sender_name, receiver, content, timestamp):
+    # Push a new message to both sides' open pages
+    event = {"type": "message", "id": message_id, "item_id": item_id,
+             "sender": sender_name, "sender_id": sender, "receiver_id": receiver,
+             "content": content, "timestamp": timestamp}
+    events.publish(receiver, event)
+    events.publish(receiver, {"type": "unread", "item_id": item_id, "other_id": sender, "delta": 1})
+    if sender != receiver:
+        events.publish(sender, event)
+
+
+def publish_read(user_id, threads):
+    # Unread badge deltas for threads that mark_read() just cleared
+    for item_id, other_id, unread in threads:
+        if unread:
+            events.publish(user_id, {"type": "unread", "item_id": item_id,
+                                     "other_id": other_id, "delta": -unread})
+
+
+# Older-page tokens of a thread's archived messages start with this
+ARCHIVED = "archived"
+
+
+def thread_page(conn, item_id, user_id, other_id, before_token=None, limit=THREAD_PAGE_SIZE):
+    # Returns (messages oldest first, token for the older page or None).
+    # Archived messages are older than every hot one: once the hot pages
+    # run out, the token points into the archive, read only if asked for
+    archived = decode_token(before_token, 3)
+    if archived and archived[0] == ARCHIVED:
+        # [ARCHIVED, None, None] is the newest archived page; any other
+        # position that is not (timestamp, id) is read as that too
+        before = archived[1:] if is_position(archived[1:]) else None
+        messages = archive.get_reader().thread_messages(item_id, user_id, other_id, limit + 1, before)
+    else:
+        archived = None
+        messages = repository.thread_messages(conn, item_id, user_id, other_id, limit + 1,
+                                              decode_position(before_token))
+    older_cursor = None
+    if len(messages) > limit:
+        messages = messages[1:]
+        older = [messages[0]["timestamp"], messages[0]["id"]]
+        older_cursor = encode_token([ARCHIVED, *older] if archived else older)
+    elif not archived and messages and messages[0]["archived"]:
+        older_cursor = archived_thread_token()
+    return messages, older_cursor
+
+
+def archived_thread_token():
+    # The newest page of a thread's archived messages
+    return encode_token([ARCHIVED, None, None])
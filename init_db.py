@@ -1,10 +1,5 @@
 import sqlite3
-from app import app
-from models import db
-
-with app.app_context():
-    db.create_all()
-    print("Database tables created.")
+from migrations import migrate
 
 # Connect to the database (creates it if it doesn't exist)
 conn = sqlite3.connect("marketplace.db")
@@ -13,28 +8,12 @@ cursor = conn.cursor()
 # Drop tables if they exist (for clean setup)
 cursor.execute("DROP TABLE IF EXISTS products")
 cursor.execute("DROP TABLE IF EXISTS messages")
+cursor.execute("DROP TABLE IF EXISTS schema_migrations")
+cursor.execute("DROP TABLE IF EXISTS schema_backfills")
+conn.commit()
 
-# Create the products table
-cursor.execute('''
-CREATE TABLE products (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    product_name TEXT NOT NULL,
-    price REAL NOT NULL,
-    seller TEXT
-)
-''')
-
-# Create the messages table
-cursor.execute('''
-CREATE TABLE messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    sender TEXT NOT NULL,
-    receiver TEXT NOT NULL,
-    item_id INTEGER,
-    content TEXT NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-''')
+# Create the products and messages tables with their indexes
+migrate("marketplace.db")
 
 # Insert sample products
 sample_items = [
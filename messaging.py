@@ -0,0 +1,140 @@
+# Conversation bookkeeping for messages.
+# Every (item, pair of users) thread has one row in `conversations` that
+# holds a pointer to its latest message and an unread count per
+# participant. send() and mark_read() keep it current as messages come in,
+# so the inbox is rendered from one indexed query (repository.py) instead
+# of re-reading and re-counting the whole mailbox.
+# Users are referenced by their integer user ids; usernames are looked up
+# from the user table only for display.
+
+
+def participants(user, other):
+    # Conversation rows store the two user ids in sorted order
+    return (user, other) if user <= other else (other, user)
+
+
+def send(conn, item_id, sender, receiver, content, timestamp):
+    """Insert a message from user id `sender` to user id `receiver` and
+    fold it into its conversation row.
+
+    Does not commit; the caller owns the transaction.
+    """
+    # The username columns are still filled for older tooling; nothing
+    # here reads them
+    cursor = conn.execute("""
+        INSERT INTO messages (sender_id, receiver_id, sender, receiver, item_id, content,
+                              timestamp, read)
+        VALUES (?, ?, (SELECT username FROM user WHERE id = ?),
+                (SELECT username FROM user WHERE id = ?), ?, ?, ?, 0)
+    """, (sender, receiver, sender, receiver, item_id, content, timestamp))
+    message_id = cursor.lastrowid
+
+    user_a, user_b = participants(sender, receiver)
+    unread_a = 1 if receiver == user_a else 0
+    unread_b = 1 if receiver == user_b else 0
+    conn.execute("""
+        INSERT INTO conversations
+            (item_id, user_a, user_b, last_message_id, last_timestamp, unread_a, unread_b)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (item_id, user_a, user_b) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_timestamp = excluded.last_timestamp,
+            unread_a = unread_a + excluded.unread_a,
+            unread_b = unread_b + excluded.unread_b
+    """, (item_id, user_a, user_b, message_id, timestamp, unread_a, unread_b))
+    return message_id
+
+
+def send_many(conn, messages):
+    """send() each (item_id, sender, receiver, content, timestamp) tuple in
+    order; returns their ids. Does not commit, so the caller can make the
+    whole batch one transaction."""
+    return [send(conn, *message) for message in messages]
+
+
+# Lookups on every item page and message send; migrations.hot_queries()
+# checks their plans
+HAS_CONVERSATION = "SELECT 1 FROM conversations WHERE item_id = ? AND user_a = ? AND user_b = ?"
+# {column} is unread_a or unread_b
+UNREAD_COUNT = "SELECT {column} FROM conversations WHERE item_id = ? AND user_a = ? AND user_b = ?"
+TOTAL_UNREAD = """
+    SELECT COALESCE((SELECT SUM(unread_a) FROM conversations WHERE user_a = ?), 0)
+         + COALESCE((SELECT SUM(unread_b) FROM conversations
+                     WHERE user_b = ? AND user_a != user_b), 0)
+"""
+
+
+def has_conversation(conn, item_id, user, other):
+    user_a, user_b = participants(user, other)
+    row = conn.execute(HAS_CONVERSATION, (item_id, user_a, user_b)).fetchone()
+    return row is not None
+
+
+def mark_read(conn, user, threads):
+    """Mark the messages `user` received in `threads` as read.
+
+    `threads` is an iterable of (item_id, other user id, unread) tuples;
+    threads with nothing unread are skipped without touching the database.
+    Returns the number of threads updated. Does not commit.
+    """
+    updated = 0
+    for item_id, other, unread in threads:
+        if not unread:
+            continue
+        conn.execute("""
+            UPDATE messages SET read = 1
+            WHERE receiver_id = ? AND read = 0 AND item_id = ? AND sender_id = ?
+        """, (user, item_id, other))
+        user_a, user_b = participants(user, other)
+        column = "unread_a" if user == user_a else "unread_b"
+        conn.execute(f"""
+            UPDATE conversations SET {column} = 0
+            WHERE item_id = ? AND user_a = ? AND user_b = ?
+        """, (item_id, user_a, user_b))
+        updated += 1
+    return updated
+
+
+def unread_count(conn, item_id, user, other):
+    user_a, user_b = participants(user, other)
+    column = "unread_a" if user == user_a else "unread_b"
+    row = conn.execute(UNREAD_COUNT.format(column=column), (item_id, user_a, user_b)).fetchone()
+    return row[0] if row else 0
+
+
+def total_unread(conn, user):
+    return conn.execute(TOTAL_UNREAD, (user, user)).fetchone()[0]
+
+
+def fold(conn, condition, params=()):
+    """Add the messages matching the SQL `condition` to their conversation
+    rows, the way send() does one at a time. Does not commit.
+
+    Each message must be folded exactly once; rebuild() and the user id
+    backfill in migrations.py pick disjoint sets of messages.
+    """
+    # MAX(id) makes SQLite take the bare timestamp column from that same row
+    conn.execute(f"""
+        INSERT INTO conversations
+            (item_id, user_a, user_b, last_message_id, last_timestamp, unread_a, unread_b)
+        SELECT item_id, MIN(sender_id, receiver_id), MAX(sender_id, receiver_id),
+               MAX(id), COALESCE(timestamp, ''),
+               SUM(read = 0 AND receiver_id = MIN(sender_id, receiver_id)),
+               SUM(read = 0 AND receiver_id = MAX(sender_id, receiver_id))
+        FROM messages
+        WHERE item_id IS NOT NULL AND sender_id IS NOT NULL AND receiver_id IS NOT NULL
+          AND ({condition})
+        GROUP BY item_id, MIN(sender_id, receiver_id), MAX(sender_id, receiver_id)
+        ON CONFLICT (item_id, user_a, user_b) DO UPDATE SET
+            last_message_id = MAX(last_message_id, excluded.last_message_id),
+            last_timestamp = CASE WHEN excluded.last_message_id > last_message_id
+                                  THEN excluded.last_timestamp ELSE last_timestamp END,
+            unread_a = unread_a + excluded.unread_a,
+            unread_b = unread_b + excluded.unread_b
+    """, params)
+
+
+def rebuild(conn):
+    # Recompute every conversation row from the messages table
+    conn.execute("DELETE FROM conversations")
+    fold(conn, "1")
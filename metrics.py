@@ -0,0 +1,514 @@
+import collections
+import functools
+import hmac
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from flask import abort, before_render_template, current_app, g, has_request_context, request
+from flask import template_rendered
+
+# Per-request instrumentation and a Prometheus /metrics endpoint.
+# Every request gets a RequestStats on flask.g:
+#   - the pooled connections from database.py are created with
+#     InstrumentedConnection, whose cursors time each statement and count
+#     the rows fetched from it, whether it came from repository.py, the
+#     ORM or a module using the sqlite3 connection directly;
+#   - template rendering is timed through Flask's template signals;
+#   - ResponseMeter, the outermost WSGI middleware, times the first body
+#     byte and counts the bytes sent, after compression (streaming.py).
+# When the request ends the totals go into histograms labelled by route; a
+# page from streaming.stream_template() ends when its response is closed.
+# Statements slower than SLOW_QUERY_MS are logged with their EXPLAIN QUERY
+# PLAN. Metrics are kept per worker process, like the other per-process
+# singletons in this app, so each gunicorn worker reports its own series.
+#
+# With PROFILING enabled, selected requests (X-Profile: 1, ?_profile=1 or
+# a PROFILE_SAMPLE_RATE fraction) are sampled by a background thread and
+# written to PROFILE_DIR as collapsed stacks ("a;b;c count"), the input
+# format of flamegraph.pl and speedscope.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+DEFAULT_SLOW_QUERY_MS = 100
+SLOW_QUERY_HISTORY = 50
+PROFILE_INTERVAL = 0.005
+# WSGI environ key holding the matched route, for the middleware
+ROUTE_KEY = "marketplace.route"
+
+slow_query_log = logging.getLogger("marketplace.slow_queries")
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for label_values, (counts, total, count) in items:
+            labels = _labels(self.labels, label_values)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels.rstrip(',')}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{labels.rstrip(',')}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{{{_labels(self.labels, label_values).rstrip(',')}}} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    return "".join(f'{name}="{_escape(value)}",' for name, value in zip(names, values))
+
+
+class Registry:
+    def __init__(self):
+        self.request_latency = Histogram(
+            "marketplace_request_duration_seconds", "Time to handle a request.",
+            ("method", "route", "status"), LATENCY_BUCKETS)
+        self.request_queries = Histogram(
+            "marketplace_request_queries", "SQL statements run per request.",
+            ("route",), COUNT_BUCKETS)
+        self.query_latency = Histogram(
+            "marketplace_db_query_duration_seconds", "Time spent in one SQL statement.",
+            ("source",), LATENCY_BUCKETS)
+        self.template_latency = Histogram(
+            "marketplace_template_render_seconds", "Time to render a template.",
+            ("template",), LATENCY_BUCKETS)
+        self.rows_fetched = Counter(
+            "marketplace_db_rows_fetched_total", "Rows read from raw sqlite3 cursors.",
+            ("route",))
+        self.slow_queries = Counter(
+            "marketplace_db_slow_queries_total", "Statements slower than SLOW_QUERY_MS.",
+            ("route",))
+        self.first_byte = Histogram(
+            "marketplace_response_first_byte_seconds", "Time until the first body byte is sent.",
+            ("method", "route"), LATENCY_BUCKETS)
+        self.response_bytes = Histogram(
+            "marketplace_response_bytes", "Body bytes sent per response, after compression.",
+            ("route", "encoding"), BYTE_BUCKETS)
+        self.uncompressed_bytes = Counter(
+            "marketplace_response_uncompressed_bytes_total",
+            "Body bytes of compressed responses before compression.", ("route", "encoding"))
+        self.recent_slow = collections.deque(maxlen=SLOW_QUERY_HISTORY)
+
+    def collect(self):
+        lines = []
+        for metric in (self.request_latency, self.request_queries, self.query_latency,
+                       self.template_latency, self.rows_fetched, self.slow_queries,
+                       self.first_byte, self.response_bytes, self.uncompressed_bytes):
+            lines.extend(metric.collect())
+        return lines
+
+
+class QueryRecord:
+    __slots__ = ("source", "sql", "params", "seconds", "rows", "plan")
+
+    def __init__(self, source, sql, params, seconds):
+        self.source = source
+        self.sql = sql
+        self.params = params
+        self.seconds = seconds
+        self.rows = 0
+        self.plan = None
+
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = []
+        self.templates = []
+        self.rendering = []
+        self.status = 500
+        # Set for pages from streaming.stream_template()
+        self.streaming = False
+
+    @property
+    def query_seconds(self):
+        return sum(q.seconds for q in self.queries)
+
+    @property
+    def template_seconds(self):
+        return sum(seconds for _, seconds in self.templates)
+
+
+def current():
+    """RequestStats for the request being handled, or None."""
+    if has_request_context():
+        return g.get("request_stats")
+    return None
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times execute() and every fetch; rows fetched are credited to the
+    # statement the cursor is currently reading.
+    _record = None
+
+    def _track(self, method, sql, parameters, explainable):
+        stats = current()
+        if stats is None:
+            self._record = None
+            return method(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            # executemany() parameters may be a one-shot iterator: no EXPLAIN
+            record = QueryRecord("sqlite", sql, parameters if explainable else None,
+                                 time.perf_counter() - start)
+            stats.queries.append(record)
+            self._record = record
+
+    def execute(self, sql, parameters=()):
+        return self._track(super().execute, sql, parameters, True)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._track(super().executemany, sql, seq_of_parameters, False)
+
+    def _fetched(self, start, rows):
+        record = self._record
+        if record is not None:
+            record.seconds += time.perf_counter() - start
+            record.rows += rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        row = super().__next__()
+        self._fetched(start, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute() bypasses cursor(), so route it through one
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def explain(conn, sql, params):
+    try:
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return [f"(no plan: {e})"]
+    return [row[-1] for row in rows]
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack until stop() is called."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+def _profile_selected(app):
+    if not app.config["PROFILING"]:
+        return False
+    if request.headers.get("X-Profile") == "1" or request.args.get("_profile") == "1":
+        return True
+    return random.random() < app.config["PROFILE_SAMPLE_RATE"]
+
+
+def _write_profile(app, stacks, route):
+    os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", f"{request.method} {route}").strip("_")
+    path = os.path.join(app.config["PROFILE_DIR"], f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}.folded")
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry():
+    key = os.getpid()
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.get(key)
+            if registry is None:
+                registry = _registries[key] = Registry()
+    return registry
+
+
+def route_label():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def _start_request():
+    g.request_stats = RequestStats()
+    request.environ[ROUTE_KEY] = route_label()
+    if _profile_selected(current_app):
+        g.request_profiler = SamplingProfiler(threading.get_ident())
+
+
+def _finish_response(response):
+    stats = current()
+    if stats is None:
+        return response
+    stats.status = response.status_code
+    profiler = g.pop("request_profiler", None)
+    if profiler is not None:
+        path = _write_profile(current_app, profiler.stop(), route_label())
+        response.headers["X-Profile-File"] = os.path.basename(path)
+    if stats.streaming:
+        # Recorded once the server is done with the body, however it ends
+        response.call_on_close(functools.partial(
+            _record, stats, request.method, route_label(), current_app.config["SLOW_QUERY_MS"] / 1000,
+            None))
+    elapsed = time.perf_counter() - stats.start
+    response.headers["Server-Timing"] = (
+        f"db;dur={stats.query_seconds * 1000:.2f}, tpl;dur={stats.template_seconds * 1000:.2f}, "
+        f"app;dur={elapsed * 1000:.2f}"
+    )
+    return response
+
+
+def _record_request(exc=None):
+    # A streamed page keeps its stats on g while it renders (the request
+    # context is pushed back for the stream) and is recorded on close
+    stats = g.get("request_stats")
+    if stats is None or stats.streaming:
+        return
+    g.pop("request_stats")
+    profiler = g.pop("request_profiler", None)
+    if profiler is not None:
+        profiler.stop()
+    _record(stats, request.method, route_label(), current_app.config["SLOW_QUERY_MS"] / 1000,
+            g.get("db_conn"))
+
+
+def _record(stats, method, route, threshold, conn):
+    registry = get_registry()
+    registry.request_latency.observe(time.perf_counter() - stats.start, method, route, stats.status)
+    registry.request_queries.observe(len(stats.queries), route)
+
+    rows = 0
+    for record in stats.queries:
+        registry.query_latency.observe(record.seconds, record.source)
+        rows += record.rows
+        if record.seconds < threshold:
+            continue
+        if (record.plan is None and conn is not None and record.source == "sqlite"
+                and record.params is not None):
+            record.plan = explain(conn, record.sql, record.params)
+        registry.slow_queries.inc(1, route)
+        registry.recent_slow.append({
+            "route": route, "ms": round(record.seconds * 1000, 2), "sql": " ".join(record.sql.split()),
+            "rows": record.rows, "plan": record.plan, "at": time.time(),
+        })
+        slow_query_log.warning("%.1f ms on %s: %s | plan: %s", record.seconds * 1000, route,
+                               " ".join(record.sql.split()), "; ".join(record.plan or ()))
+    if rows:
+        registry.rows_fetched.inc(rows, route)
+    for template, seconds in stats.templates:
+        registry.template_latency.observe(seconds, template)
+
+
+def _template_started(sender, template, context, **extra):
+    stats = current()
+    if stats is not None:
+        stats.rendering.append(time.perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):
+    stats = current()
+    if stats is not None and stats.rendering:
+        stats.templates.append((template.name, time.perf_counter() - stats.rendering.pop()))
+
+
+class ResponseMeter:
+    """WSGI middleware: time to the first body byte and bytes sent, per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        # Content-Encoding and Content-Length of the response
+        sent_headers = {}
+
+        def capture(status, headers, exc_info=None):
+            for name, value in headers:
+                if name.lower() in ("content-encoding", "content-length"):
+                    sent_headers[name.lower()] = value
+            return start_response(status, headers, exc_info)
+
+        body = self.app(environ, capture)
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if file_wrapper is not None and isinstance(body, file_wrapper):
+            # Sent by the server (sendfile), all of it ready now
+            self._observe(environ, time.perf_counter() - start,
+                          int(sent_headers.get("content-length", 0)), sent_headers)
+            return body
+        return self._metered(environ, body, start, sent_headers)
+
+    def _metered(self, environ, body, start, sent_headers):
+        first_byte = None
+        sent = 0
+        try:
+            for data in body:
+                if data and first_byte is None:
+                    first_byte = time.perf_counter() - start
+                sent += len(data)
+                yield data
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            self._observe(environ, first_byte, sent, sent_headers)
+
+    @staticmethod
+    def _observe(environ, first_byte, sent, sent_headers):
+        registry = get_registry()
+        route = environ.get(ROUTE_KEY, "unmatched")
+        registry.first_byte.observe(first_byte, environ["REQUEST_METHOD"], route)
+        registry.response_bytes.observe(sent, route, sent_headers.get("content-encoding", "identity"))
+
+
+def render_metrics():
+    lines = get_registry().collect()
+    gauges = current_app.extensions.get("metrics_gauges")
+    for name, help, value in (gauges() if gauges else ()):
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def authorized():
+    """Whether the request carries the METRICS_TOKEN bearer token. Without a
+    token configured the endpoints are off (404): the slow query log holds
+    raw SQL."""
+    token = current_app.config["METRICS_TOKEN"]
+    if not token:
+        abort(404)
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+
+def metrics_view():
+    if not authorized():
+        return "Unauthorized\n", 401, {"Content-Type": "text/plain"}
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def slow_queries_view():
+    if not authorized():
+        return {"error": "Unauthorized"}, 401
+    return {"threshold_ms": current_app.config["SLOW_QUERY_MS"],
+            "queries": list(get_registry().recent_slow)}
+
+
+def init_app(app, gauges=None):
+    """Install the request hooks; `gauges()` yields extra (name, help,
+    value) gauges for /metrics."""
+    app.config.setdefault("SLOW_QUERY_MS", float(os.environ.get("SLOW_QUERY_MS", DEFAULT_SLOW_QUERY_MS)))
+    app.config.setdefault("METRICS_TOKEN", os.environ.get("METRICS_TOKEN"))
+    app.config.setdefault("PROFILING", os.environ.get("PROFILING") == "1")
+    app.config.setdefault("PROFILE_SAMPLE_RATE", float(os.environ.get("PROFILE_SAMPLE_RATE", 0)))
+    app.config.setdefault("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_record_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+    if gauges is not None:
+        app.extensions["metrics_gauges"] = gauges
+
+    # Outermost, so it sees the bytes that actually go out
+    app.wsgi_app = ResponseMeter(app.wsgi_app)
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    app.add_url_rule("/metrics/slow-queries", "slow_queries", slow_queries_view)
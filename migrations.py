@@ -0,0 +1,870 @@
+import csv
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+import messaging
+
+# Versioned schema migrations for marketplace.db.
+# Applied versions are recorded in schema_migrations, and the runner takes
+# SQLite's write lock before checking them, so it is safe for several
+# gunicorn workers to call migrate() at startup at the same time.
+
+PRODUCT_COLUMNS = {
+    "category": "TEXT",
+    "image_url": "TEXT",
+    "seller": "TEXT",
+    "location": "TEXT",
+    "description": "TEXT",
+    "timestamp": "TEXT",
+}
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _base_schema(conn):
+    # Replaces init_db.py + update_db.py + update_image_column.py: create the
+    # tables if missing and add any column an older database never got.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_name TEXT NOT NULL,
+            price REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            item_id INTEGER,
+            content TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    existing = _columns(conn, "products")
+    for name, sql_type in PRODUCT_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE products ADD COLUMN {name} {sql_type}")
+    if "read" not in _columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN read INTEGER DEFAULT 0")
+
+
+def _category_lower(conn):
+    # Virtual generated column so the /items filter can compare against an
+    # indexed value instead of evaluating LOWER(category) on every row.
+    if "category_lower" not in _columns(conn, "products"):
+        conn.execute("""
+            ALTER TABLE products ADD COLUMN category_lower TEXT
+            GENERATED ALWAYS AS (LOWER(category)) VIRTUAL
+        """)
+
+
+def _hot_path_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category_timestamp "
+                 "ON products (category_lower, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_seller_timestamp "
+                 "ON products (seller, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver_read_item "
+                 "ON messages (receiver, read, item_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_item_timestamp "
+                 "ON messages (sender, item_id, timestamp)")
+    conn.execute("ANALYZE")
+
+
+def _sort_indexes(conn):
+    # Expression indexes matching the keyset pagination ORDER BYs in
+    # pagination.SORTS; the row id is appended implicitly as a tiebreaker.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_newest "
+                 "ON products (COALESCE(timestamp, ''))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category_sort "
+                 "ON products (COALESCE(category, ''))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category_newest "
+                 "ON products (category_lower, COALESCE(timestamp, ''))")
+    conn.execute("ANALYZE")
+
+
+FTS_COLUMNS = "product_name, description, category, seller, location"
+
+
+def _product_search(conn):
+    # External-content FTS5 index over products (see search.py), kept in
+    # sync by triggers and backfilled from the rows already in the table.
+    new_values = ", ".join("new." + c for c in FTS_COLUMNS.split(", "))
+    old_values = ", ".join("old." + c for c in FTS_COLUMNS.split(", "))
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            {FTS_COLUMNS},
+            content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, {FTS_COLUMNS}) VALUES (new.id, {new_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, {FTS_COLUMNS})
+            VALUES ('delete', old.id, {old_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_fts_update
+        AFTER UPDATE OF {FTS_COLUMNS} ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, {FTS_COLUMNS})
+            VALUES ('delete', old.id, {old_values});
+            INSERT INTO products_fts (rowid, {FTS_COLUMNS}) VALUES (new.id, {new_values});
+        END
+    """)
+    conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+
+def _conversations(conn):
+    # Per-thread summary rows maintained by messaging.py
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            item_id INTEGER NOT NULL,
+            user_a TEXT NOT NULL,
+            user_b TEXT NOT NULL,
+            last_message_id INTEGER,
+            last_timestamp TEXT,
+            unread_a INTEGER NOT NULL DEFAULT 0,
+            unread_b INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (item_id, user_a, user_b)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_a "
+                 "ON conversations (user_a, last_timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_b "
+                 "ON conversations (user_b, last_timestamp)")
+    # Filled from the messages as they were then, keyed on usernames. This
+    # is messaging.rebuild() as released with this migration; migration 9
+    # re-keys the table on user ids and backfill_user_ids() refills it
+    conn.execute("DELETE FROM conversations")
+    conn.execute("""
+        INSERT INTO conversations
+            (item_id, user_a, user_b, last_message_id, last_timestamp, unread_a, unread_b)
+        SELECT item_id, MIN(sender, receiver), MAX(sender, receiver), MAX(id), '',
+               SUM(read = 0 AND receiver = MIN(sender, receiver)),
+               SUM(read = 0 AND receiver = MAX(sender, receiver))
+        FROM messages
+        WHERE item_id IS NOT NULL
+        GROUP BY item_id, MIN(sender, receiver), MAX(sender, receiver)
+    """)
+    conn.execute("""
+        UPDATE conversations SET last_timestamp =
+            (SELECT COALESCE(timestamp, '') FROM messages
+             WHERE messages.id = conversations.last_message_id)
+    """)
+
+
+def _cache_generations(conn):
+    # Version counters that cache.py folds into its keys; bumping a tag
+    # invalidates every cached entry built from it.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_generations (
+            tag TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _bulk_imports(conn):
+    # Progress of each bulk import job (bulk.py), committed together with
+    # the rows it counts so an interrupted import resumes where it stopped.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bulk_imports (
+            job TEXT PRIMARY KEY,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            imported INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            finished INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _user_ids(conn):
+    # Integer user references next to the old username columns. Users move
+    # into this database (they used to live in a separate SQLAlchemy file
+    # under instance/), so the new columns can reference user(id). Filling
+    # the columns is left to backfill_user_ids(), which works in short
+    # batches instead of rewriting every row under this transaction.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER PRIMARY KEY,
+            username VARCHAR(80) NOT NULL UNIQUE,
+            email VARCHAR(120) NOT NULL UNIQUE,
+            password_hash VARCHAR(128) NOT NULL,
+            created_at DATETIME
+        )
+    """)
+    _import_legacy_users(conn)
+    conn.execute("ALTER TABLE products ADD COLUMN seller_id INTEGER REFERENCES user (id)")
+    conn.execute("ALTER TABLE messages ADD COLUMN sender_id INTEGER REFERENCES user (id)")
+    conn.execute("ALTER TABLE messages ADD COLUMN receiver_id INTEGER REFERENCES user (id)")
+
+    # Writers that only know usernames (older scripts, a worker still on
+    # the previous release during a deploy) get the ids filled in for them
+    conn.execute("""
+        CREATE TRIGGER products_seller_id AFTER INSERT ON products
+        WHEN new.seller_id IS NULL AND new.seller IS NOT NULL BEGIN
+            UPDATE products SET seller_id = (SELECT id FROM user WHERE username = new.seller)
+            WHERE id = new.id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER messages_user_ids AFTER INSERT ON messages
+        WHEN new.sender_id IS NULL OR new.receiver_id IS NULL BEGIN
+            UPDATE messages SET
+                sender_id = COALESCE(sender_id, (SELECT id FROM user WHERE username = new.sender)),
+                receiver_id = COALESCE(receiver_id,
+                                       (SELECT id FROM user WHERE username = new.receiver))
+            WHERE id = new.id;
+        END
+    """)
+
+    # The same hot-path indexes, keyed on integers
+    conn.execute("DROP INDEX IF EXISTS idx_products_seller_timestamp")
+    conn.execute("DROP INDEX IF EXISTS idx_messages_receiver_read_item")
+    conn.execute("DROP INDEX IF EXISTS idx_messages_sender_item_timestamp")
+    conn.execute("CREATE INDEX idx_products_seller_id_timestamp ON products (seller_id, timestamp)")
+    conn.execute("CREATE INDEX idx_messages_receiver_id_read_item "
+                 "ON messages (receiver_id, read, item_id)")
+    conn.execute("CREATE INDEX idx_messages_sender_id_item_timestamp "
+                 "ON messages (sender_id, item_id, timestamp)")
+
+    # Conversation rows are derived data: recreate them keyed on user ids;
+    # backfill_user_ids() refills them as it fills the message columns
+    conn.execute("DROP TABLE IF EXISTS conversations")
+    conn.execute("""
+        CREATE TABLE conversations (
+            item_id INTEGER NOT NULL,
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_timestamp TEXT,
+            unread_a INTEGER NOT NULL DEFAULT 0,
+            unread_b INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (item_id, user_a, user_b)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_conversations_user_a ON conversations (user_a, last_timestamp)")
+    conn.execute("CREATE INDEX idx_conversations_user_b ON conversations (user_b, last_timestamp)")
+
+    # Cached listing pages were built without seller_id
+    conn.execute("UPDATE cache_generations SET version = version + 1")
+
+
+def _import_legacy_users(conn):
+    # Accounts from the old instance/<name> users database, if there is one
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    if not path:
+        return
+    legacy = os.path.join(os.path.dirname(path), "instance", os.path.basename(path))
+    if not os.path.exists(legacy) or os.path.samefile(legacy, path):
+        return
+    source = sqlite3.connect(legacy)
+    try:
+        if not source.execute("SELECT 1 FROM sqlite_master WHERE name = 'user'").fetchone():
+            return
+        rows = source.execute(
+            "SELECT id, username, email, password_hash, created_at FROM user").fetchall()
+    finally:
+        source.close()
+    conn.executemany("""
+        INSERT OR IGNORE INTO user (id, username, email, password_hash, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+
+
+# The price bucket of migration 10, frozen: facets.bucket_expression() with
+# PRICE_EDGES (0, 5, 10, 25, 50, 100, 250, 500) as released. New edges need
+# a migration of their own that recreates the triggers.
+_FACET_BUCKET = ("(CASE WHEN {price} IS NULL THEN 0 WHEN {price} < 5 THEN 0 WHEN {price} < 10 THEN 1 "
+                 "WHEN {price} < 25 THEN 2 WHEN {price} < 50 THEN 3 WHEN {price} < 100 THEN 4 "
+                 "WHEN {price} < 250 THEN 5 WHEN {price} < 500 THEN 6 ELSE 7 END)")
+
+
+def _facets(conn):
+    # Category x price bucket rollup behind the /items filters (facets.py),
+    # kept current by triggers and filled from the rows already there
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS facets (
+            category TEXT NOT NULL,
+            price_bucket INTEGER NOT NULL,
+            products INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (category, price_bucket)
+        ) WITHOUT ROWID
+    """)
+    add = """
+        INSERT INTO facets (category, price_bucket, products)
+        VALUES (COALESCE(new.category, ''), {bucket}, 1)
+        ON CONFLICT (category, price_bucket) DO UPDATE SET products = products + 1;
+    """.format(bucket=_FACET_BUCKET.format(price="new.price"))
+    remove = """
+        UPDATE facets SET products = products - 1
+        WHERE category = COALESCE(old.category, '') AND price_bucket = {bucket};
+        DELETE FROM facets
+        WHERE category = COALESCE(old.category, '') AND price_bucket = {bucket} AND products <= 0;
+    """.format(bucket=_FACET_BUCKET.format(price="old.price"))
+    conn.execute(f"CREATE TRIGGER products_facets_insert AFTER INSERT ON products BEGIN {add} END")
+    conn.execute(f"CREATE TRIGGER products_facets_delete AFTER DELETE ON products BEGIN {remove} END")
+    conn.execute(f"""
+        CREATE TRIGGER products_facets_update AFTER UPDATE OF category, price ON products
+        BEGIN {remove} {add} END
+    """)
+    # Price range filters, with and without a category
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category_price "
+                 "ON products (category_lower, price)")
+    # Filled as facets.rebuild() did when this migration was released
+    conn.execute("DELETE FROM facets")
+    conn.execute(f"""
+        INSERT INTO facets (category, price_bucket, products)
+        SELECT COALESCE(category, ''), {_FACET_BUCKET.format(price="price")}, COUNT(*)
+        FROM products
+        GROUP BY 1, 2
+    """)
+    _invalidate_catalog(conn)
+    conn.execute("ANALYZE")
+
+
+def _invalidate_catalog(conn):
+    # cache.invalidate(conn, "catalog") on the cache_generations table of
+    # migration 7: cached listing pages are stale
+    conn.execute("""
+        INSERT INTO cache_generations (tag, version) VALUES ('catalog', 1)
+        ON CONFLICT (tag) DO UPDATE SET version = version + 1
+    """)
+
+
+def _analytics(conn):
+    # Hourly and daily view / inquiry rollups behind /dashboard
+    # (analytics.py); inquiries are filled in from the existing messages
+    for table in ("analytics_hourly", "analytics_daily"):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                seller_id INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                product_id INTEGER NOT NULL,
+                views INTEGER NOT NULL DEFAULT 0,
+                inquiries INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (seller_id, bucket, product_id)
+            ) WITHOUT ROWID
+        """)
+    conn.execute("""
+        CREATE TRIGGER products_analytics_delete AFTER DELETE ON products BEGIN
+            DELETE FROM analytics_hourly WHERE seller_id = old.seller_id AND product_id = old.id;
+            DELETE FROM analytics_daily WHERE seller_id = old.seller_id AND product_id = old.id;
+        END
+    """)
+    # Inquiries from the messages, as analytics.rebuild_inquiries() counted
+    # them when this migration was released. With the user ids not filled
+    # in yet nothing matches, and backfill_user_ids() recounts afterwards
+    since_hour = (datetime.now() - timedelta(days=2)).strftime("%Y-%m-%dT%H")
+    for table, bucket, where in (
+            ("analytics_daily", "strftime('%Y-%m-%d', m.timestamp)", ""),
+            ("analytics_hourly", "strftime('%Y-%m-%dT%H', m.timestamp)",
+             "AND strftime('%Y-%m-%dT%H', m.timestamp) >= :since_hour")):
+        conn.execute(f"""
+            INSERT INTO {table} (seller_id, bucket, product_id, inquiries)
+            SELECT p.seller_id, {bucket}, m.item_id, COUNT(*)
+            FROM messages m
+            JOIN products p ON p.id = m.item_id
+            WHERE p.seller_id IS NOT NULL AND m.sender_id IS NOT p.seller_id
+              AND {bucket} IS NOT NULL {where}
+            GROUP BY 1, 2, 3
+        """, {"since_hour": since_hour})
+
+
+# Place matching of migration 12, frozen: geo.normalize(), normalized_sql()
+# and geo_row_sql() with the punctuation as released
+_PLACE_PUNCTUATION = ",.;:!?()/-&'#"
+_GAZETTEER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv")
+
+
+def _place_name(text):
+    text = (text or "").lower()
+    for char in _PLACE_PUNCTUATION:
+        text = text.replace(char, " ")
+    return " ".join(text.split())
+
+
+def _place_of(expr):
+    # SQL for the id of the place named in `expr`: the longest name found
+    # as whole words
+    words = expr
+    for char in _PLACE_PUNCTUATION:
+        words = f"replace({words}, '{char.replace(chr(39), chr(39) * 2)}', ' ')"
+    for _ in range(2):
+        words = f"replace({words}, '  ', ' ')"
+    return f"""
+        SELECT n.place_id
+        FROM (SELECT ' ' || trim(lower({words})) || ' ' AS words) s, place_names n
+        WHERE instr(s.words, ' ' || n.name || ' ') > 0
+        ORDER BY length(n.name) DESC
+        LIMIT 1
+    """
+
+
+def _places(conn):
+    # Gazetteer places and an R*Tree of listing locations behind the near=
+    # filter on /items (geo.py), kept current by triggers
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS places (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS place_names (
+            name TEXT PRIMARY KEY,
+            place_id INTEGER NOT NULL REFERENCES places(id)
+        ) WITHOUT ROWID
+    """)
+    # One point per placed listing; +place_id is stored alongside
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_geo
+        USING rtree(id, min_lat, max_lat, min_lon, max_lon, +place_id)
+    """)
+    place_row = f"""
+        INSERT INTO products_geo (id, min_lat, max_lat, min_lon, max_lon, place_id)
+        SELECT new.id, latitude, latitude, longitude, longitude, id
+        FROM places WHERE id = ({_place_of('new.location')})
+    """
+    conn.execute(f"""
+        CREATE TRIGGER products_geo_insert AFTER INSERT ON products
+        WHEN new.location IS NOT NULL
+        BEGIN {place_row}; END
+    """)
+    conn.execute("""
+        CREATE TRIGGER products_geo_delete AFTER DELETE ON products BEGIN
+            DELETE FROM products_geo WHERE id = old.id;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER products_geo_update AFTER UPDATE OF location ON products BEGIN
+            DELETE FROM products_geo WHERE id = old.id;
+            {place_row};
+        END
+    """)
+    # Loaded as geo.load() did when this migration was released. The
+    # gazetteer is data: whatever it holds today is loaded
+    with open(_GAZETTEER, newline="", encoding="utf-8") as f:
+        lines = (line for line in f if not line.startswith("#"))
+        for place_id, row in enumerate(csv.DictReader(lines), 1):
+            conn.execute("INSERT INTO places (id, name, latitude, longitude) VALUES (?, ?, ?, ?)",
+                         (place_id, row["name"].strip(), float(row["latitude"]), float(row["longitude"])))
+            names = [row["name"], *(row.get("aliases") or "").split(";")]
+            # A name listed twice keeps its first place
+            conn.executemany("INSERT OR IGNORE INTO place_names (name, place_id) VALUES (?, ?)",
+                             [(_place_name(n), place_id) for n in names if _place_name(n)])
+    conn.execute(f"""
+        INSERT INTO products_geo (id, min_lat, max_lat, min_lon, max_lon, place_id)
+        SELECT m.id, p.latitude, p.latitude, p.longitude, p.longitude, p.id
+        FROM (SELECT id, ({_place_of('location')}) AS place_id
+              FROM products WHERE location IS NOT NULL) m
+        JOIN places p ON p.id = m.place_id
+    """)
+    _invalidate_catalog(conn)
+
+
+def _message_archive(conn):
+    # Tombstones for threads moved to the archive database and the lease
+    # rows of background jobs (archive.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archived_threads (
+            item_id INTEGER NOT NULL,
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            PRIMARY KEY (item_id, user_a, user_b)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            name TEXT PRIMARY KEY,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            threads INTEGER,
+            messages INTEGER
+        ) WITHOUT ROWID
+    """)
+
+
+def _similar_listings(conn):
+    # Precomputed "similar items" per listing and the fitted TF-IDF model
+    # they were scored with (similar.py). Triggers queue new and edited
+    # listings for the refresher; a deleted listing leaves every list at
+    # once, and the pages that showed it are invalidated and queued to refill.
+    import similar
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS similar_products (
+            product_id INTEGER NOT NULL,
+            similar_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (product_id, similar_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_similar_products_similar "
+                 "ON similar_products (similar_id)")
+    # Inverted index: every listing's unit term weights
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS similar_terms (
+            term TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            PRIMARY KEY (term, product_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_similar_terms_product "
+                 "ON similar_terms (product_id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS similar_idf (
+            term TEXT PRIMARY KEY,
+            idf REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS similar_model (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            documents INTEGER NOT NULL,
+            default_idf REAL NOT NULL,
+            built_at TEXT NOT NULL
+        )
+    """)
+    # changed = 0: only the list needs refilling, the listing itself is as scored
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS similar_pending (
+            product_id INTEGER PRIMARY KEY,
+            changed INTEGER NOT NULL
+        )
+    """)
+    queue = """
+        INSERT INTO similar_pending (product_id, changed) VALUES (new.id, 1)
+        ON CONFLICT (product_id) DO UPDATE SET changed = 1;
+    """
+    conn.execute(f"CREATE TRIGGER products_similar_insert AFTER INSERT ON products BEGIN {queue} END")
+    conn.execute(f"""
+        CREATE TRIGGER products_similar_update
+        AFTER UPDATE OF product_name, description, category, price ON products
+        BEGIN {queue} END
+    """)
+    conn.execute("""
+        CREATE TRIGGER products_similar_delete AFTER DELETE ON products BEGIN
+            INSERT INTO similar_pending (product_id, changed)
+            SELECT product_id, 0 FROM similar_products WHERE similar_id = old.id
+            ON CONFLICT (product_id) DO NOTHING;
+            INSERT INTO cache_generations (tag, version)
+            SELECT 'item:' || product_id, 1 FROM similar_products WHERE similar_id = old.id
+            ON CONFLICT (tag) DO UPDATE SET version = version + 1;
+            DELETE FROM similar_products WHERE similar_id = old.id;
+            DELETE FROM similar_products WHERE product_id = old.id;
+            DELETE FROM similar_terms WHERE product_id = old.id;
+            DELETE FROM similar_pending WHERE product_id = old.id;
+        END
+    """)
+    # Deliberately not frozen: the lists are scored by NumPy code, not SQL,
+    # and are derived data that `python similar.py rebuild` recomputes at any
+    # time. A change to these tables needs its own migration anyway
+    similar.rebuild(conn)
+
+
+def _row_versions(conn):
+    # Per-listing version counter and last-change time (UTC) behind the
+    # /api/v1 validators, kept by triggers so every writer bumps them
+    for column, definition in (("version", "INTEGER NOT NULL DEFAULT 1"), ("updated_at", "TEXT")):
+        if column not in _columns(conn, "products"):
+            conn.execute(f"ALTER TABLE products ADD COLUMN {column} {definition}")
+    conn.execute("UPDATE products SET updated_at = datetime('now') WHERE updated_at IS NULL")
+    conn.execute("""
+        CREATE TRIGGER products_version_insert AFTER INSERT ON products BEGIN
+            UPDATE products SET updated_at = datetime('now') WHERE id = new.id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER products_version_update
+        AFTER UPDATE OF product_name, price, category, image_url, seller, seller_id, location,
+                        description, timestamp ON products
+        BEGIN
+            UPDATE products SET version = old.version + 1, updated_at = datetime('now')
+            WHERE id = new.id;
+        END
+    """)
+
+
+MIGRATIONS = [
+    (1, "base schema", _base_schema),
+    (2, "lowercase category column", _category_lower),
+    (3, "hot path indexes", _hot_path_indexes),
+    (4, "keyset pagination sort indexes", _sort_indexes),
+    (5, "product full-text search", _product_search),
+    (6, "conversation summaries", _conversations),
+    (7, "cache generations", _cache_generations),
+    (8, "bulk import jobs", _bulk_imports),
+    (9, "integer user references", _user_ids),
+    (10, "category and price facets", _facets),
+    (11, "seller analytics rollups", _analytics),
+    (12, "listing locations", _places),
+    (13, "message archive", _message_archive),
+    (14, "similar listings", _similar_listings),
+    (15, "listing row versions", _row_versions),
+]
+
+# table -> (username column, user id column) pairs filled by backfill_user_ids()
+USER_ID_COLUMNS = {
+    "products": [("seller", "seller_id")],
+    "messages": [("sender", "sender_id"), ("receiver", "receiver_id")],
+}
+BACKFILL_BATCH_SIZE = 2000
+BACKFILL_PAUSE = 0.03
+
+
+def current_version(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+
+def migrate(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    applied = []
+    try:
+        # Only takes effect on a new, empty database; an existing one is
+        # converted by `python archive.py vacuum`
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = current_version(conn)
+            for number, name, apply in MIGRATIONS:
+                if number <= version:
+                    continue
+                apply(conn)
+                conn.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                    (number, name, datetime.now().isoformat()),
+                )
+                applied.append(number)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    backfill_user_ids(path)
+    return applied
+
+
+def _in_transaction(conn, work):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = work()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return result
+
+
+def backfill_user_ids(path, batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE):
+    """Fill the user id columns from migration 9 from the username columns.
+
+    Every batch of `batch_size` rows is its own short write transaction,
+    and the runner sleeps `pause` seconds between batches so web workers
+    (and other writers) get the lock in between instead of waiting behind
+    one UPDATE over the whole table. Message batches are folded into the
+    re-keyed conversations table in the same transaction. Safe to
+    interrupt and to run from several processes at once. Returns the
+    number of rows updated.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_backfills (
+                name TEXT PRIMARY KEY,
+                finished_at TEXT NOT NULL
+            )
+        """)
+        if conn.execute("SELECT 1 FROM schema_backfills WHERE name = 'user ids'").fetchone():
+            return 0
+        if "seller_id" not in _columns(conn, "products"):
+            return 0
+
+        # Names with no account (listings and messages written before
+        # registration existed) get one nobody can log in to, so every row
+        # has a user to reference: an empty hash never verifies.
+        names = " UNION ".join(f"SELECT {name} AS name FROM {table} WHERE {name} IS NOT NULL"
+                               for table, pairs in USER_ID_COLUMNS.items() for name, _ in pairs)
+        _in_transaction(conn, lambda: conn.execute(f"""
+            INSERT OR IGNORE INTO user (username, email, password_hash, created_at)
+            SELECT name, name || '@users.invalid', '', ? FROM ({names})
+            WHERE name NOT IN (SELECT username FROM user)
+        """, (datetime.now().isoformat(sep=" "),)))
+
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS backfill_batch (id INTEGER PRIMARY KEY)")
+        updated = 0
+        for table, pairs in USER_ID_COLUMNS.items():
+            missing = " OR ".join(f"{id_column} IS NULL" for _, id_column in pairs)
+            assignments = ", ".join(
+                f"{id_column} = COALESCE({id_column}, "
+                f"(SELECT id FROM user WHERE username = {table}.{name}))"
+                for name, id_column in pairs)
+            last = 0
+            while True:
+                def batch():
+                    conn.execute("DELETE FROM backfill_batch")
+                    conn.execute(f"""
+                        INSERT INTO backfill_batch
+                        SELECT id FROM {table} WHERE id > ? AND ({missing}) ORDER BY id LIMIT ?
+                    """, (last, batch_size))
+                    end = conn.execute("SELECT MAX(id) FROM backfill_batch").fetchone()[0]
+                    if end is None:
+                        return None, 0
+                    cursor = conn.execute(f"""
+                        UPDATE {table} SET {assignments}
+                        WHERE id IN (SELECT id FROM backfill_batch)
+                    """)
+                    if table == "messages":
+                        # Deliberately the current messaging code: the
+                        # backfill runs after every migration, on the
+                        # current schema
+                        messaging.fold(conn, "id IN (SELECT id FROM backfill_batch)")
+                    return end, cursor.rowcount
+                last, count = _in_transaction(conn, batch)
+                if last is None:
+                    break
+                updated += count
+                if pause:
+                    time.sleep(pause)
+
+        def finish():
+            # Listing pages cached while seller_id was still missing are stale
+            conn.execute("UPDATE cache_generations SET version = version + 1")
+            # Migration 11 counted inquiries before the ids were there; the
+            # current code, like messaging.fold() above
+            if _columns(conn, "analytics_daily"):
+                import analytics
+                analytics.rebuild_inquiries(conn)
+            conn.execute("INSERT OR IGNORE INTO schema_backfills (name, finished_at) VALUES (?, ?)",
+                         ("user ids", datetime.now().isoformat()))
+        _in_transaction(conn, finish)
+    finally:
+        conn.close()
+    return updated
+
+
+# Queries that run on every hit of /items, /item/<id>, /dashboard, /inbox
+# and /message. None of them may fall back to a full table SCAN. Every
+# entry is a statement the app runs: compiled from repository.py, or the
+# SQL constants of messaging.py.
+def hot_queries():
+    import geo
+    import messaging
+    import repository
+
+    def compiled(stmt, **params):
+        return repository.compiled_sql(stmt, **params)
+
+    return {
+        "items by category": compiled(
+            repository.listing_statement("newest", False, True, False, False),
+            category="stationery", limit=11),
+        "items page (newest)": compiled(
+            repository.listing_statement("newest", False, False, True, False),
+            key="2025-01-01", row_id=100, limit=11),
+        "items page (price)": compiled(
+            repository.listing_statement("price_asc", False, False, True, False),
+            key=10.0, row_id=100, limit=11),
+        "items page (previous)": compiled(
+            repository.listing_statement("price_desc", False, False, True, True),
+            key=10.0, row_id=100, limit=11),
+        "items by price range": compiled(
+            repository.listing_statement(None, False, False, False, False, True, True),
+            min_price=10.0, max_price=24.99, limit=11),
+        "items by category and price": compiled(
+            repository.listing_statement("price_asc", False, True, False, False, True, True),
+            category="stationery", min_price=10.0, max_price=24.99, limit=11),
+        "items near a place": compiled(
+            repository.listing_statement("nearest", False, False, False, False, nearby=True),
+            **geo.near_params(43.7738, -79.5034, 1.0), limit=11),
+        "item detail": compiled(repository.PRODUCT_BY_ID, item_id=1),
+        "similar items": compiled(repository.SIMILAR_PRODUCTS, item_id=1),
+        "items by id": compiled(repository.items_statement(repository.ITEM_FIELDS), ids=[1, 2, 3]),
+        "item sellers": compiled(repository.SELLERS_BY_ID, ids=[1, 2, 3]),
+        "users page": compiled(repository.USERS_PAGE, after=100, limit=100),
+        "users page end": compiled(repository.USERS_PAGE_END, after=100, skip=99),
+        "dashboard products": compiled(repository.SELLER_PRODUCTS, seller_id=1),
+        "dashboard analytics": compiled(repository.ACTIVITY_SERIES, seller_id=1,
+                                        since_hour="2025-01-01T00", since_day="2025-01-01"),
+        "inbox conversations": compiled(repository.conversations_statement(False),
+                                        user_id=1, limit=20),
+        "inbox conversations page": compiled(repository.conversations_statement(True), user_id=1,
+                                             before_ts="2025-01-01", before_id=10, limit=20),
+        "thread latest page": compiled(repository.thread_statement(False), item_id=1, user_id=1,
+                                       other_id=2, limit=20),
+        "thread page": compiled(repository.thread_statement(True), item_id=1, user_id=1,
+                                other_id=2, before_ts="2025-01-01", before_id=10, limit=20),
+        "thread unread count": (messaging.UNREAD_COUNT.format(column="unread_a"), (1, 1, 2)),
+        "total unread": (messaging.TOTAL_UNREAD, (1, 1)),
+        "reply-to check": (messaging.HAS_CONVERSATION, (1, 1, 2)),
+        "message receiver lookup": compiled(repository.SELLER_OF, item_id=1),
+    }
+
+
+# A virtual table (the R*Tree) queried with constraints, e.g.
+# "SCAN g VIRTUAL TABLE INDEX 2:DaBbDcBd"; "INDEX 2:" alone is a full scan
+_VIRTUAL_TABLE_LOOKUP = re.compile(r"VIRTUAL TABLE INDEX \d+:\S")
+
+
+def full_scans(conn, queries=None):
+    problems = []
+    for name, (sql, params) in (queries or hot_queries()).items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            # SCAN CONSTANT ROW is a SELECT without FROM, not a table
+            if detail.startswith("SCAN") and "USING" not in detail and detail != "SCAN CONSTANT ROW" \
+                    and not _VIRTUAL_TABLE_LOOKUP.search(detail):
+                problems.append((name, detail))
+    return problems
+
+
+def check_query_plans(path):
+    import geo
+
+    conn = sqlite3.connect(path)
+    geo.register_math(conn)
+    try:
+        problems = full_scans(conn)
+    finally:
+        conn.close()
+    for name, detail in problems:
+        print(f"❌ {name}: {detail}")
+    if not problems:
+        print("✅ All hot queries use an index.")
+    return not problems
+
+
+if __name__ == "__main__":
+    db_path = "marketplace.db"
+    if "--check-plans" in sys.argv:
+        sys.exit(0 if check_query_plans(db_path) else 1)
+    applied = migrate(db_path)
+    if applied:
+        print("✅ Applied migrations:", ", ".join(str(v) for v in applied))
+    else:
+        print("ℹ️ Schema already up to date.")
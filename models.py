@@ -1,6 +1,7 @@
+from flask import session
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+import passwords
 
 db = SQLAlchemy()
 
@@ -12,17 +13,130 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # Hashed in the bounded pool (see passwords.py)
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify_password(self.password_hash, password)[0]
 
-class Item(db.Model):
+def current_user_id():
+    # The signed-in user's id, for the HTML views and /api/v1 alike.
+    # Sessions from before user ids were stored carry only the username.
+    # None when that account no longer exists: the session is signed out
+    # then, and the views' login checks send the user to /login
+    if "user_id" not in session:
+        user = User.query.filter_by(username=session["username"]).first()
+        if user is None:
+            session.pop("username", None)
+            return None
+        session["user_id"] = user.id
+    return session["user_id"]
+
+# Listings and messages, mapped onto the tables migrations.py creates.
+# The schema itself is owned by the migrations: never db.create_all() these.
+
+class Product(db.Model):
+    __tablename__ = "products"
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    product_name = db.Column(db.Text, nullable=False)
     price = db.Column(db.Float, nullable=False)
-    image_url = db.Column(db.String(255), nullable=True)  # Stores image filename or URL
-    description = db.Column(db.Text, nullable=True)
-    category = db.Column(db.String(50), nullable=True)
-    location = db.Column(db.String(100), nullable=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    category = db.Column(db.Text)
+    image_url = db.Column(db.Text)
+    seller = db.Column(db.Text)  # display copy of the seller's username
+    seller_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    location = db.Column(db.Text)
+    description = db.Column(db.Text)
+    timestamp = db.Column(db.Text)  # ISO 8601 string
+    category_lower = db.Column(db.Text, db.Computed("LOWER(category)", persisted=False))
+    # Bumped by triggers on every change (migrations.py); updated_at is UTC
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.Text)
+
+    seller_user = db.relationship(User, lazy="raise")
+
+class Message(db.Model):
+    __tablename__ = "messages"
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column(db.Text, nullable=False)
+    receiver = db.Column(db.Text, nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    receiver_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    item_id = db.Column(db.Integer, db.ForeignKey("products.id"))
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.Text)
+    read = db.Column(db.Integer, default=0)
+
+    # lazy="raise": every access path says how it loads the product
+    product = db.relationship(Product, lazy="raise")
+
+# Per-thread summaries maintained by messaging.py
+conversations = db.Table(
+    "conversations",
+    db.Column("item_id", db.Integer, db.ForeignKey("products.id"), primary_key=True),
+    db.Column("user_a", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("user_b", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("last_message_id", db.Integer, db.ForeignKey("messages.id")),
+    db.Column("last_timestamp", db.Text),
+    db.Column("unread_a", db.Integer, nullable=False, default=0),
+    db.Column("unread_b", db.Integer, nullable=False, default=0),
+)
+
+# Listings per (category, price bucket), maintained by triggers (facets.py)
+facets = db.Table(
+    "facets",
+    db.Column("category", db.Text, primary_key=True),
+    db.Column("price_bucket", db.Integer, primary_key=True),
+    db.Column("products", db.Integer, nullable=False, default=0),
+)
+
+# Listing views and buyer inquiries per seller, listing and hour / day,
+# written in batches by analytics.py
+def _activity_table(name):
+    return db.Table(
+        name,
+        db.Column("seller_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+        db.Column("bucket", db.Text, primary_key=True),  # local time, see analytics.py
+        db.Column("product_id", db.Integer, db.ForeignKey("products.id"), primary_key=True),
+        db.Column("views", db.Integer, nullable=False, default=0),
+        db.Column("inquiries", db.Integer, nullable=False, default=0),
+    )
+
+analytics_hourly = _activity_table("analytics_hourly")
+analytics_daily = _activity_table("analytics_daily")
+
+# Gazetteer places and the R*Tree of listing locations (geo.py). The
+# R*Tree is a virtual table created by migrations.py; this mapping only
+# lets repository.py query it.
+places = db.Table(
+    "places",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("name", db.Text, nullable=False),
+    db.Column("latitude", db.Float, nullable=False),
+    db.Column("longitude", db.Float, nullable=False),
+)
+
+products_geo = db.Table(
+    "products_geo",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("min_lat", db.Float),
+    db.Column("max_lat", db.Float),
+    db.Column("min_lon", db.Float),
+    db.Column("max_lon", db.Float),
+    db.Column("place_id", db.Integer),
+)
+
+# Threads moved to the archive database by archive.py, one tombstone each
+archived_threads = db.Table(
+    "archived_threads",
+    db.Column("item_id", db.Integer, primary_key=True),
+    db.Column("user_a", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("user_b", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+)
+
+# Each listing's top-K similar listings, precomputed by similar.py
+similar_products = db.Table(
+    "similar_products",
+    db.Column("product_id", db.Integer, db.ForeignKey("products.id"), primary_key=True),
+    db.Column("similar_id", db.Integer, db.ForeignKey("products.id"), primary_key=True),
+    db.Column("score", db.Float, nullable=False),
+)
@@ -0,0 +1,91 @@
+import base64
+import json
+import math
+
+# Keyset (cursor) pagination for /items.
+# A page is addressed by the (sort key, id) of the row next to it rather
+# than an OFFSET, so fetching page 500 costs the same as fetching page 1.
+
+# sort option -> (SQL sort expression, direction). The COALESCE wrappers
+# keep NULL timestamps/categories comparable inside a row-value cursor and
+# match the expression indexes created in migrations.py. The statements
+# themselves are built in repository.listing_statement().
+SORTS = {
+    "newest": ("COALESCE(timestamp, '')", "DESC"),
+    "price_asc": ("price", "ASC"),
+    "price_desc": ("price", "DESC"),
+    "category": ("COALESCE(category, '')", "ASC"),
+    # Only offered while searching: bm25 score from repository.listing_statement()
+    "relevance": ("score", "ASC"),
+    # Only offered with near=: distance in km from repository._nearby()
+    "nearest": ("distance", "ASC"),
+}
+DEFAULT_SORT = (None, "ASC")
+
+# Column holding each sort key in the selected row, for building the next cursor
+SORT_COLUMNS = {
+    "newest": "timestamp",
+    "price_asc": "price",
+    "price_desc": "price",
+    "category": "category",
+    "relevance": "score",
+    "nearest": "distance",
+}
+
+
+def encode_token(values):
+    # Opaque, URL-safe token for a list of JSON-serialisable values
+    payload = json.dumps(list(values), separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_token(token, length):
+    # Inverse of encode_token(); None for a missing or malformed token
+    if not token:
+        return None
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    # Only scalars: a list or dict would reach cache keys and SQL parameters
+    if not all(value is None or isinstance(value, str) or is_number(value) for value in values):
+        return None
+    return values
+
+
+def is_number(value):
+    # JSON numbers only: not true/false, and not NaN or Infinity, which
+    # json.loads() also accepts
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def encode_cursor(sort_option, row):
+    column = SORT_COLUMNS.get(sort_option)
+    key = row[column] if column else None
+    if key is None and column in ("timestamp", "category"):
+        key = ""
+    return encode_token([sort_option or "", key, row["id"]])
+
+
+def decode_cursor(token, sort_option):
+    # Returns (key, id), or None if the token is malformed or was issued for
+    # a different sort order (the caller then starts from the first page).
+    values = decode_token(token, 3)
+    if values is None:
+        return None
+    sort_name, key, row_id = values
+    if sort_name != (sort_option or "") or not isinstance(row_id, int) or isinstance(row_id, bool):
+        return None
+    # The key must be of the type the sort compares: text for the COALESCEd
+    # columns, a number for price / score / distance, nothing for the default
+    column = SORT_COLUMNS.get(sort_option)
+    if column in ("timestamp", "category"):
+        valid = isinstance(key, str)
+    elif column:
+        valid = is_number(key)
+    else:
+        valid = key is None
+    return (key, row_id) if valid else None
@@ -0,0 +1,254 @@
+import functools
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from flask import current_app, has_app_context, jsonify, render_template, request
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashing off the request threads.
+# werkzeug's scrypt is deliberately slow and memory-hard. Run inline, a
+# burst of logins ties up every worker thread and the catalog stalls
+# behind it. Hashes are therefore computed in a small process pool:
+#   - at most PASSWORD_HASH_QUEUE hashes may be queued or running per worker
+#     process; past that, callers get Overloaded (HTTP 503 + Retry-After)
+#     instead of waiting in line;
+#   - /login and /register are throttled per client IP and per account
+#     with token buckets, so brute-force attempts are refused before they
+#     cost any hashing at all;
+#   - a successful login whose stored hash was made with other parameters
+#     than PASSWORD_HASH_METHOD is re-hashed in the same pool call, so the
+#     cost can be raised in production and users migrate as they log in.
+
+DEFAULT_METHOD = "scrypt"
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRY_AFTER = 5
+
+# (burst, tokens refilled per minute)
+DEFAULT_IP_LIMIT = (20, 10)
+DEFAULT_ACCOUNT_LIMIT = (5, 5)
+MAX_BUCKETS = 50_000
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__("Password hashing is overloaded")
+        self.retry_after = retry_after
+
+
+# Run in the pool processes: keep these free of Flask state
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(stored_hash, password, method, current_prefix):
+    # Returns (password matches, replacement hash or None)
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if stored_hash.split("$", 1)[0] != current_prefix:
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+def _method_prefix(method):
+    # "scrypt" -> "scrypt:32768:8:1": the parameters werkzeug records in a hash
+    return generate_password_hash("", method=method).split("$", 1)[0]
+
+
+class HashPool:
+    def __init__(self, method=DEFAULT_METHOD, workers=1, max_pending=4, timeout=DEFAULT_TIMEOUT):
+        self.method = method
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        # workers=0 hashes on the calling thread (still bounded by the slots).
+        # The pool forks: "spawn" and "forkserver" re-run the __main__ script
+        # in every child, which breaks add_user.py-style scripts. With fork
+        # all hash processes start together on the first submit, so create
+        # the pool early in each worker process, while it has few threads.
+        self.executor = None
+        if workers:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+            self.prefix = self.executor.submit(_method_prefix, method).result()
+        else:
+            self.prefix = _method_prefix(method)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded()
+        with self._lock:
+            self.pending += 1
+        try:
+            if self.executor is None:
+                return fn(*args)
+            try:
+                return self.executor.submit(fn, *args).result(timeout=self.timeout)
+            except FutureTimeout:
+                with self._lock:
+                    self.rejected += 1
+                raise Overloaded()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, stored_hash, password):
+        ok, new_hash = self._run(_verify, stored_hash, password, self.method, self.prefix)
+        if new_hash:
+            with self._lock:
+                self.rehashed += 1
+        return ok, new_hash
+
+    def stats(self):
+        with self._lock:
+            return {
+                "method": self.prefix,
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "rehashed": self.rehashed,
+            }
+
+
+class TokenBuckets:
+    # One bucket per key, refilled continuously; least recently used keys
+    # are forgotten past MAX_BUCKETS (a forgotten key starts full again).
+    def __init__(self, burst, per_minute, max_keys=MAX_BUCKETS):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.refused = 0
+
+    def take(self, key):
+        """Spend one token; returns 0 if allowed, else seconds until one is free."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                self.refused += 1
+                wait = (1 - tokens) / self.rate
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class Guard:
+    def __init__(self, app):
+        config = app.config
+        self.pool = HashPool(
+            method=config["PASSWORD_HASH_METHOD"],
+            workers=config["PASSWORD_HASH_WORKERS"],
+            max_pending=config["PASSWORD_HASH_QUEUE"],
+            timeout=config["PASSWORD_HASH_TIMEOUT"],
+        )
+        self.by_ip = TokenBuckets(*config["AUTH_RATE_LIMIT_IP"])
+        self.by_account = TokenBuckets(*config["AUTH_RATE_LIMIT_ACCOUNT"])
+
+    def stats(self):
+        stats = self.pool.stats()
+        stats["throttled_ip"] = self.by_ip.refused
+        stats["throttled_account"] = self.by_account.refused
+        return stats
+
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def get_guard(app=None):
+    # One pool per worker process, created after gunicorn forks
+    app = app or current_app
+    key = os.getpid()
+    guard = _guards.get(key)
+    if guard is None:
+        with _guards_lock:
+            guard = _guards.get(key)
+            if guard is None:
+                guard = _guards[key] = Guard(app)
+    return guard
+
+
+def hash_password(password):
+    if not has_app_context():  # scripts such as add_user.py
+        return generate_password_hash(password, method=DEFAULT_METHOD)
+    return get_guard().pool.hash(password)
+
+
+def verify_password(stored_hash, password):
+    """(matches, new hash to store or None) for a login attempt."""
+    if not stored_hash or password is None:
+        return False, None
+    if not has_app_context():
+        return check_password_hash(stored_hash, password), None
+    return get_guard().pool.verify(stored_hash, password)
+
+
+def _refuse(template, status, message, retry_after):
+    if request.is_json:
+        response = jsonify({"error": message})
+    else:
+        response = current_app.make_response(render_template(template, error=message))
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def protect(template):
+    """Throttle POSTs to a login/register view and turn Overloaded into a 503.
+
+    `template` is re-rendered with an error message when a request is refused.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "POST":
+                return view(*args, **kwargs)
+            guard = get_guard()
+            data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+            account = (data.get("email") or "").strip().lower()
+            wait = guard.by_ip.take(request.remote_addr or "unknown")
+            if not wait and account:
+                wait = guard.by_account.take(account)
+            if wait:
+                return _refuse(template, 429, "Too many attempts. Please wait a moment and try again.", wait)
+            try:
+                return view(*args, **kwargs)
+            except Overloaded as e:
+                return _refuse(template, 503, "The server is busy. Please try again shortly.", e.retry_after)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    workers = max(1, (os.cpu_count() or 2) // 2)
+    app.config.setdefault("PASSWORD_HASH_METHOD", os.environ.get("PASSWORD_HASH_METHOD", DEFAULT_METHOD))
+    app.config.setdefault("PASSWORD_HASH_WORKERS", int(os.environ.get("PASSWORD_HASH_WORKERS", workers)))
+    app.config.setdefault("PASSWORD_HASH_QUEUE", int(os.environ.get(
+        "PASSWORD_HASH_QUEUE", app.config["PASSWORD_HASH_WORKERS"] * 4 or 4)))
+    app.config.setdefault("PASSWORD_HASH_TIMEOUT", DEFAULT_TIMEOUT)
+    app.config.setdefault("AUTH_RATE_LIMIT_IP", DEFAULT_IP_LIMIT)
+    app.config.setdefault("AUTH_RATE_LIMIT_ACCOUNT", DEFAULT_ACCOUNT_LIMIT)
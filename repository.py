@@ -0,0 +1,518 @@
+import functools
+from sqlalchemy import and_, bindparam, delete, func, insert, literal, literal_column, or_, select, text, union_all, update
+from sqlalchemy import Float, Integer
+from sqlalchemy.dialects import sqlite
+
+import cache
+import geo
+import messaging
+import search
+from models import (Message, Product, User, analytics_daily, analytics_hourly, archived_threads,
+                    conversations, facets, places, products_geo, similar_products)
+from pagination import DEFAULT_SORT, SORTS
+
+# Data access for listings and messages, on the request's pooled
+# SQLAlchemy connection (database.get_connection()). Every function takes
+# that connection first. Hot reads are Core statements built once per
+# query shape and memoised here; SQLAlchemy caches their compiled SQL, and
+# the sqlite3 statement cache keeps them prepared. Writes to listings bump
+# the cache generations in the same transaction. Conversation bookkeeping
+# (messaging.py) and FTS helpers (search.py) run on the same underlying
+# DB-API connection.
+
+products = Product.__table__
+messages = Message.__table__
+users = User.__table__
+
+LISTING_COLUMNS = (
+    products.c.id, products.c.product_name, products.c.price, products.c.category,
+    products.c.image_url, products.c.seller, products.c.seller_id, products.c.location,
+    products.c.description, products.c.timestamp,
+)
+
+
+def dbapi(conn):
+    # The sqlite3 connection under a SQLAlchemy Connection
+    return conn.connection.dbapi_connection
+
+
+def compiled_sql(stmt, **params):
+    """(SQL, positional parameters) for a statement, as SQLite receives it.
+
+    Expanding parameters (IN lists) become one placeholder per value."""
+    compiled = stmt.params(**params).compile(dialect=sqlite.dialect(),
+                                             compile_kwargs={"render_postcompile": True})
+    values = compiled.construct_params()
+    return str(compiled), tuple(values[name] for name in compiled.positiontup)
+
+
+# Listings
+
+def _fts_matches(scored):
+    # Rows matching the FTS5 expression bound to :match (bm25 score: lower is better)
+    columns = {"fts_id": Integer}
+    score = ""
+    if scored:
+        columns["score"] = Float
+        score = f", bm25(products_fts, {search.BM25_WEIGHTS}) AS score"
+    return text(f"SELECT rowid AS fts_id{score} FROM products_fts WHERE products_fts MATCH :match") \
+        .columns(**columns).subquery("fts")
+
+
+def _nearby():
+    # Listings within the radius of (:lat, :lon) and their distance
+    # (geo.near_params): the R*Tree finds the points in the bounding box,
+    # then the (equirectangular) distance of each point is checked. A point
+    # is its box's lower corner: the R*Tree stores 32-bit floats, rounded
+    # outwards, so that is within a metre of the place.
+    lat, lon, scale = bindparam("lat"), bindparam("lon"), bindparam("lon_scale")
+    dlat = products_geo.c.min_lat - lat
+    dlon = (products_geo.c.min_lon - lon) * scale
+    squared = dlat * dlat + dlon * dlon
+    return select(products_geo.c.id.label("near_id"),
+                  (geo.KM_PER_DEGREE * func.sqrt(squared)).label("distance")) \
+        .where(products_geo.c.max_lat >= bindparam("min_lat"), products_geo.c.min_lat <= bindparam("max_lat"),
+               products_geo.c.max_lon >= bindparam("min_lon"), products_geo.c.min_lon <= bindparam("max_lon"),
+               squared <= bindparam("radius_deg2")) \
+        .subquery("near")
+
+
+def _listing_source(searching, scored=False, nearby=False):
+    source, fts, near = products, None, None
+    if searching:
+        fts = _fts_matches(scored)
+        source = source.join(fts, fts.c.fts_id == products.c.id)
+    if nearby:
+        near = _nearby()
+        source = source.join(near, near.c.near_id == products.c.id)
+    return source, fts, near
+
+
+def _filtered(stmt, by_category, by_min_price, by_max_price):
+    # Category and price range filters, served by idx_products_category_price
+    if by_category:
+        stmt = stmt.where(products.c.category_lower == bindparam("category"))
+    if by_min_price:
+        stmt = stmt.where(products.c.price >= bindparam("min_price"))
+    if by_max_price:
+        stmt = stmt.where(products.c.price <= bindparam("max_price"))
+    return stmt
+
+
+@functools.lru_cache(maxsize=None)
+def listing_statement(sort_option, searching, by_category, keyset, backwards,
+                      by_min_price=False, by_max_price=False, nearby=False):
+    """One /items page: binds :match, :category, :min_price/:max_price,
+    :key/:row_id and :limit.
+
+    With `backwards` the page before the cursor is selected; rows come
+    back in reverse order and the caller flips them.
+    """
+    source, fts, near = _listing_source(searching, scored=True, nearby=nearby)
+    stmt = select(*LISTING_COLUMNS, *([fts.c.score] if searching else []),
+                  *([near.c.distance] if nearby else [])).select_from(source)
+    stmt = _filtered(stmt, by_category, by_min_price, by_max_price)
+
+    expr, direction = SORTS.get(sort_option, DEFAULT_SORT)
+    descending = (direction == "DESC") != backwards
+    # The sort expressions are spelled exactly as in the expression indexes
+    sort_key = literal_column(expr) if expr else None
+    if keyset:
+        row_id = bindparam("row_id")
+        past_row = products.c.id < row_id if descending else products.c.id > row_id
+        if sort_key is None:
+            stmt = stmt.where(past_row)
+        else:
+            # (sort_key, id) past (key, row_id), spelled out so SQLite can
+            # seek the expression index instead of scanning it
+            key = bindparam("key")
+            stmt = stmt.where(
+                sort_key <= key if descending else sort_key >= key,
+                or_(sort_key < key if descending else sort_key > key, past_row),
+            )
+    order = [sort_key, products.c.id] if sort_key is not None else [products.c.id]
+    return stmt.order_by(*(c.desc() if descending else c.asc() for c in order)) \
+        .limit(bindparam("limit"))
+
+
+@functools.lru_cache(maxsize=None)
+def count_statement(searching, by_category, by_min_price=False, by_max_price=False, nearby=False):
+    if nearby and not (searching or by_category or by_min_price or by_max_price):
+        # The R*Tree only holds listings, so no need to visit them
+        return select(func.count()).select_from(_nearby())
+    source, _, _ = _listing_source(searching, nearby=nearby)
+    return _filtered(select(func.count()).select_from(source),
+                     by_category, by_min_price, by_max_price)
+
+
+def _filter_params(category, match, min_price, max_price, near=None):
+    params = {}
+    if category:
+        params["category"] = category.lower()
+    if match:
+        params["match"] = match
+    if min_price is not None:
+        params["min_price"] = min_price
+    if max_price is not None:
+        params["max_price"] = max_price
+    if near is not None:
+        params.update(geo.near_params(*near))
+    return params
+
+
+def list_products(conn, category=None, match=None, sort_option=None, cursor=None,
+                  backwards=False, limit=10, min_price=None, max_price=None, near=None):
+    """Up to `limit` listings after (or with `backwards`, before) the
+    (key, id) `cursor`, as dicts. `near` is (latitude, longitude, radius km)."""
+    stmt = listing_statement(sort_option, bool(match), bool(category), cursor is not None, backwards,
+                             min_price is not None, max_price is not None, near is not None)
+    params = _filter_params(category, match, min_price, max_price, near)
+    params["limit"] = limit
+    if cursor is not None:
+        key, params["row_id"] = cursor
+        if SORTS.get(sort_option, DEFAULT_SORT)[0]:
+            params["key"] = key
+    return [dict(row) for row in conn.execute(stmt, params).mappings()]
+
+
+def count_products(conn, category=None, match=None, min_price=None, max_price=None, near=None):
+    stmt = count_statement(bool(match), bool(category), min_price is not None, max_price is not None,
+                           near is not None)
+    return conn.execute(stmt, _filter_params(category, match, min_price, max_price, near)).scalar()
+
+
+PLACE_NAMES = select(places.c.name).order_by(places.c.name)
+
+
+def place_names(conn):
+    # Gazetteer place names, for the near= picker
+    return conn.execute(PLACE_NAMES).scalars().all()
+
+
+def resolve_place(conn, text):
+    return geo.resolve(dbapi(conn), text)
+
+
+FACET_COUNTS = select(facets.c.category, facets.c.price_bucket, facets.c.products) \
+    .where(facets.c.products > 0)
+
+
+def facet_counts(conn):
+    # Every (category, price bucket, listings) rollup row; see facets.summarize()
+    return conn.execute(FACET_COUNTS).all()
+
+
+def highlights(conn, match, ids):
+    return search.highlights(dbapi(conn), match, ids)
+
+
+def suggest(conn, text):
+    return search.suggest(dbapi(conn), text)
+
+
+PRODUCT_BY_ID = select(*LISTING_COLUMNS).where(products.c.id == bindparam("item_id"))
+
+
+def get_product(conn, item_id):
+    row = conn.execute(PRODUCT_BY_ID, {"item_id": item_id}).mappings().first()
+    return dict(row) if row else None
+
+
+SIMILAR_PRODUCTS = (
+    select(products.c.id, products.c.product_name, products.c.price, products.c.image_url)
+    .select_from(similar_products.join(products, products.c.id == similar_products.c.similar_id))
+    .where(similar_products.c.product_id == bindparam("item_id"))
+    .order_by(similar_products.c.score.desc(), similar_products.c.similar_id)
+)
+
+
+def similar_listings(conn, item_id):
+    # The precomputed "similar items" of a listing, best first (similar.py)
+    return [dict(row) for row in conn.execute(SIMILAR_PRODUCTS, {"item_id": item_id}).mappings()]
+
+
+def product_form(conn, item_id):
+    # (product_name, price, category, image_url), the fields edit.html fills in
+    return conn.execute(
+        select(products.c.product_name, products.c.price, products.c.category, products.c.image_url)
+        .where(products.c.id == item_id)
+    ).first()
+
+
+SELLER_OF = select(products.c.seller_id).where(products.c.id == bindparam("item_id"))
+
+
+def seller_of(conn, item_id):
+    return conn.execute(SELLER_OF, {"item_id": item_id}).scalar()
+
+
+SELLERS_BY_ID = select(products.c.id, products.c.seller_id).where(
+    products.c.id.in_(bindparam("ids", expanding=True)))
+
+
+def sellers_of(conn, item_ids):
+    # {item id: seller id} for the listings that exist
+    return dict(conn.execute(SELLERS_BY_ID, {"ids": list(item_ids)}).all())
+
+
+# Listing fields /api/v1 clients can pick (fields=); id always comes first
+ITEM_FIELDS = tuple(column.name for column in LISTING_COLUMNS)
+
+
+@functools.lru_cache(maxsize=None)
+def items_statement(fields):
+    """Listings by :ids (expanding), selecting (version, updated_at) and
+    then `fields`, a tuple of ITEM_FIELDS names starting with "id"."""
+    return (
+        select(products.c.version, products.c.updated_at, *(products.c[name] for name in fields))
+        .where(products.c.id.in_(bindparam("ids", expanding=True)))
+    )
+
+
+def items_by_id(conn, ids, fields):
+    # Rows of (version, updated_at, *fields), in no particular order
+    return conn.execute(items_statement(fields), {"ids": list(ids)}).all()
+
+
+def add_product(conn, **values):
+    """Insert a listing and commit; returns its id."""
+    item_id = conn.execute(insert(products).values(**values)).inserted_primary_key[0]
+    cache.invalidate_product(dbapi(conn))
+    conn.commit()
+    return item_id
+
+
+def update_product(conn, item_id, **values):
+    conn.execute(update(products).where(products.c.id == item_id).values(**values))
+    cache.invalidate_product(dbapi(conn), item_id)
+    conn.commit()
+
+
+def delete_product(conn, item_id):
+    conn.execute(delete(products).where(products.c.id == item_id))
+    cache.invalidate_product(dbapi(conn), item_id)
+    conn.commit()
+
+
+# Rows fetched per cursor round trip by generators streaming a result
+STREAM_BATCH = 256
+
+
+USERS_PAGE = (
+    select(users.c.id, users.c.username, users.c.email, users.c.created_at)
+    .where(users.c.id > bindparam("after"))
+    .order_by(users.c.id)
+    .limit(bindparam("limit"))
+)
+
+
+def users_page(conn, after, limit):
+    # A generator over up to `limit` accounts with ids above `after`, by id
+    yield from conn.execute(USERS_PAGE, {"after": after, "limit": limit}).yield_per(STREAM_BATCH)
+
+
+# The limit-th account id after :after, and the one after it if any
+USERS_PAGE_END = (
+    select(users.c.id).where(users.c.id > bindparam("after")).order_by(users.c.id)
+    .limit(2).offset(bindparam("skip"))
+)
+
+
+def next_users_page(conn, after, limit):
+    """Where the page after the one starting after `after` starts (an id to
+    pass as `after`), or None when this page is the last; one primary key
+    lookup, made before the page itself is streamed."""
+    ids = conn.execute(USERS_PAGE_END, {"after": after, "skip": limit - 1}).scalars().all()
+    return ids[0] if len(ids) == 2 else None
+
+
+SELLER_PRODUCTS = (
+    select(products.c.id, products.c.product_name, products.c.price, products.c.category,
+           products.c.timestamp)
+    .where(products.c.seller_id == bindparam("seller_id"))
+    .order_by(products.c.timestamp.desc())
+)
+
+
+def seller_products(conn, seller_id):
+    # A generator: rows come off the cursor in batches as the caller consumes them
+    yield from conn.execute(SELLER_PRODUCTS, {"seller_id": seller_id}).mappings().yield_per(STREAM_BATCH)
+
+
+# Seller analytics (rollups written by analytics.py)
+
+def _activity_upsert(table):
+    stmt = sqlite.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.seller_id, table.c.bucket, table.c.product_id],
+        set_={"views": table.c.views + stmt.excluded.views,
+              "inquiries": table.c.inquiries + stmt.excluded.inquiries},
+    )
+
+
+ADD_HOURLY_ACTIVITY = _activity_upsert(analytics_hourly)
+ADD_DAILY_ACTIVITY = _activity_upsert(analytics_daily)
+
+# A seller's hourly rows since :since_hour and daily rows since :since_day,
+# in one statement; both halves are primary key range scans
+ACTIVITY_SERIES = union_all(*(
+    select(literal(grain).label("grain"), table.c.bucket, table.c.product_id, table.c.views,
+           table.c.inquiries)
+    .where(table.c.seller_id == bindparam("seller_id"), table.c.bucket >= bindparam(since))
+    for grain, table, since in (("hour", analytics_hourly, "since_hour"),
+                                ("day", analytics_daily, "since_day"))
+))
+
+
+def add_activity(conn, hourly, daily):
+    # Add batches of {seller_id, bucket, product_id, views, inquiries} to the rollups
+    if hourly:
+        conn.execute(ADD_HOURLY_ACTIVITY, hourly)
+    if daily:
+        conn.execute(ADD_DAILY_ACTIVITY, daily)
+    conn.commit()
+
+
+def prune_hourly_activity(conn, before):
+    conn.execute(delete(analytics_hourly).where(analytics_hourly.c.bucket < before))
+    conn.commit()
+
+
+def activity_series(conn, seller_id, since_hour, since_day):
+    return conn.execute(ACTIVITY_SERIES, {"seller_id": seller_id, "since_hour": since_hour,
+                                          "since_day": since_day}).all()
+
+
+# Conversations and messages
+
+@functools.lru_cache(maxsize=None)
+def conversations_statement(paged):
+    """Latest conversations of :user_id, newest first, :limit rows.
+
+    Each thread row comes with its product name, the other user's name and
+    the last message through explicit joins, so rendering the inbox never
+    goes back to the database per thread. With `paged`, only threads
+    before the (:before_ts, :before_id) cursor are returned.
+    """
+    c, m, p, other = conversations, messages.alias("m"), products.alias("p"), users.alias("o")
+    sender = users.alias("s")
+
+    def branch(user, other_column, unread, extra=()):
+        stmt = (
+            select(
+                c.c.item_id, c.c[other_column].label("other_id"),
+                other.c.username.label("other_user"), c.c[unread].label("unread"),
+                c.c.last_timestamp, c.c.last_message_id,
+                select(sender.c.username).where(sender.c.id == m.c.sender_id)
+                .scalar_subquery().label("last_sender"),
+                m.c.content.label("last_content"), p.c.product_name,
+            )
+            .select_from(
+                c.join(m, m.c.id == c.c.last_message_id)
+                .join(p, p.c.id == c.c.item_id)
+                .join(other, other.c.id == c.c[other_column])
+            )
+            .where(c.c[user] == bindparam("user_id"), *extra)
+        )
+        if paged:
+            before_ts = bindparam("before_ts")
+            stmt = stmt.where(or_(
+                c.c.last_timestamp < before_ts,
+                and_(c.c.last_timestamp == before_ts, c.c.last_message_id < bindparam("before_id")),
+            ))
+        return stmt
+
+    # A user talking to themselves only appears once
+    return union_all(
+        branch("user_a", "user_b", "unread_a"),
+        branch("user_b", "user_a", "unread_b", [c.c.user_a != c.c.user_b]),
+    ).order_by(literal_column("last_timestamp").desc(), literal_column("last_message_id").desc()) \
+        .limit(bindparam("limit"))
+
+
+def conversations_for(conn, user_id, limit=-1, before=None):
+    """Latest conversations for `user_id`, newest first.
+
+    `before` is the (last_timestamp, last_message_id) of the last thread
+    on the previous page; a negative limit returns every thread. Threads
+    for deleted listings drop out through the products join.
+    """
+    params = {"user_id": user_id, "limit": limit}
+    if before:
+        params["before_ts"], params["before_id"] = before
+    return conn.execute(conversations_statement(bool(before)), params).mappings().all()
+
+
+@functools.lru_cache(maxsize=None)
+def thread_statement(paged):
+    m, sender = messages.alias("m"), users.alias("u")
+    user_id, other_id = bindparam("user_id"), bindparam("other_id")
+    # Whether earlier messages of the thread were moved to the archive
+    # (archive.py); not correlated, so SQLite looks it up once per query
+    archived = select(archived_threads.c.item_id).where(
+        archived_threads.c.item_id == bindparam("item_id"),
+        archived_threads.c.user_a == func.min(user_id, other_id),
+        archived_threads.c.user_b == func.max(user_id, other_id),
+    ).exists()
+    stmt = (
+        select(m.c.id, m.c.sender_id, sender.c.username.label("sender"), m.c.content,
+               m.c.timestamp, m.c.read, archived.label("archived"))
+        .select_from(m.join(sender, sender.c.id == m.c.sender_id))
+        .where(or_(
+            and_(m.c.item_id == bindparam("item_id"), m.c.sender_id == bindparam("user_id"),
+                 m.c.receiver_id == bindparam("other_id")),
+            and_(m.c.item_id == bindparam("item_id"), m.c.sender_id == bindparam("other_id"),
+                 m.c.receiver_id == bindparam("user_id")),
+        ))
+    )
+    if paged:
+        before_ts = bindparam("before_ts")
+        stmt = stmt.where(or_(m.c.timestamp < before_ts,
+                              and_(m.c.timestamp == before_ts, m.c.id < bindparam("before_id"))))
+    return stmt.order_by(m.c.timestamp.desc(), m.c.id.desc()).limit(bindparam("limit"))
+
+
+def thread_messages(conn, item_id, user_id, other_id, limit, before=None):
+    """One page of the thread between two users about an item.
+
+    Returns up to `limit` messages in chronological order, ending just
+    before the (timestamp, id) cursor `before` when it is given. Every row
+    says whether the thread also has archived messages, all older than
+    these.
+    """
+    params = {"item_id": item_id, "user_id": user_id, "other_id": other_id, "limit": limit}
+    if before:
+        params["before_ts"], params["before_id"] = before
+    rows = conn.execute(thread_statement(bool(before)), params).mappings().all()
+    rows.reverse()
+    return rows
+
+
+# Views send messages and mark threads read through writer.py, which
+# group-commits them; these commit one write at a time on `conn`
+
+def send_message(conn, item_id, sender_id, receiver_id, content, timestamp):
+    """Store a message, fold it into its conversation and commit; returns its id."""
+    message_id = messaging.send(dbapi(conn), item_id, sender_id, receiver_id, content, timestamp)
+    conn.commit()
+    return message_id
+
+
+def has_conversation(conn, item_id, user_id, other_id):
+    return messaging.has_conversation(dbapi(conn), item_id, user_id, other_id)
+
+
+def unread_count(conn, item_id, user_id, other_id):
+    return messaging.unread_count(dbapi(conn), item_id, user_id, other_id)
+
+
+def total_unread(conn, user_id):
+    return messaging.total_unread(dbapi(conn), user_id)
+
+
+def mark_read(conn, user_id, threads):
+    """messaging.mark_read(), committed; returns the threads updated."""
+    updated = messaging.mark_read(dbapi(conn), user_id, threads)
+    if updated:
+        conn.commit()
+    return updated
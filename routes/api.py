@@ -0,0 +1,304 @@
+import functools
+import hashlib
+import json
+import math
+import operator
+from datetime import datetime, timezone
+from flask import Blueprint, Response, jsonify, request, session
+from werkzeug.http import is_resource_modified
+import analytics
+import cache
+import inbox
+import repository
+import search
+import writer
+from database import get_connection, get_db
+from models import current_user_id
+from pagination import SORTS, decode_cursor, encode_cursor
+
+# Versioned JSON API over the same queries as the HTML views. Responses
+# carry validators, so a client repeating a fetch gets a 304 before
+# anything is serialized:
+#   listing pages   ETag from the catalog generation and the page's
+#                   arguments (one query to check)
+#   listings by id  ETag from each row's version, Last-Modified from its
+#                   updated_at (both kept by triggers, see migrations.py)
+#   threads         ETag from the ids, last messages and read flags read
+# Every endpoint needs a signed-in session.
+api_routes = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Listings per ?ids= fetch, messages per POST /messages
+MAX_BATCH = 100
+MAX_SEND_BATCH = 50
+
+# Compact, and without the circular-reference walk: bodies are plain rows
+_encode = json.JSONEncoder(separators=(",", ":"), check_circular=False).encode
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api_routes.errorhandler(ApiError)
+def api_error(e):
+    return jsonify({"error": e.message}), e.status
+
+
+def login_required(view):
+    # Signed in as the HTML views see it, with an account that still exists
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if "username" not in session or current_user_id() is None:
+            return jsonify({"error": "Login required"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def fields_arg():
+    # fields=name,price -> ("id", "product_name", "price"): always id, then
+    # the picked fields in ITEM_FIELDS order so equal sets share a projection
+    value = request.args.get("fields")
+    if not value:
+        return repository.ITEM_FIELDS
+    picked = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = picked.difference(repository.ITEM_FIELDS)
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(name for name in repository.ITEM_FIELDS if name == "id" or name in picked)
+
+
+def limit_arg():
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def price_arg(name):
+    value = request.args.get(name, type=float)
+    if value is None or not math.isfinite(value) or value < 0:
+        return None
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def projection(fields):
+    """A function from a listing row (any mapping with the `fields` keys)
+    to its JSON object, built once per fieldset."""
+    pick = operator.itemgetter(*fields)
+    if len(fields) == 1:
+        return lambda row: {fields[0]: pick(row)}
+    return lambda row: dict(zip(fields, pick(row)))
+
+
+def make_etag(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def http_date(updated_at):
+    # updated_at is SQLite's datetime('now'): UTC, to the second
+    return datetime.fromisoformat(updated_at).replace(tzinfo=timezone.utc) if updated_at else None
+
+
+def conditional(etag, serialize, last_modified=None, status=200):
+    """304 when the client's copy matches, without calling `serialize`;
+    otherwise the JSON text it returns. The compressor turns ETags weak, so
+    validators are compared weakly."""
+    modified = is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+    response = Response(serialize() if modified else None, status if modified else 304,
+                        mimetype="application/json")
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Per user, and always revalidated
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@api_routes.route("/items")
+@login_required
+def list_items():
+    fields = fields_arg()
+    if "ids" in request.args:
+        return items_by_id(fields)
+
+    category = request.args.get("category")
+    match = search.match_expression(request.args.get("search"))
+    min_price, max_price = price_arg("min_price"), price_arg("max_price")
+    limit = limit_arg()
+    sort_option = request.args.get("sort")
+    if sort_option not in SORTS or sort_option == "nearest" or (sort_option == "relevance" and not match):
+        sort_option = "relevance" if match else None
+    after = decode_cursor(request.args.get("after"), sort_option)
+    before = None if after else decode_cursor(request.args.get("before"), sort_option)
+    backwards = before is not None
+
+    conn = get_connection()
+    catalog_cache = cache.get_cache()
+    # The page changes only with the catalog generation, so it is both the
+    # validator and the cache key of the serialized body
+    key = ("api_items", cache.generations(get_db(), "catalog"), category and category.lower(), match,
+           min_price, max_price, sort_option, after, before, limit, fields)
+
+    def serialize():
+        items = repository.list_products(conn, category, match, sort_option, after or before,
+                                         backwards, limit=limit + 1,
+                                         min_price=min_price, max_price=max_price)
+        has_more = len(items) > limit
+        items = items[:limit]
+        if backwards:
+            items.reverse()
+        next_cursor = prev_cursor = None
+        if items:
+            if has_more or backwards:
+                next_cursor = encode_cursor(sort_option, items[-1])
+            if after or (backwards and has_more):
+                prev_cursor = encode_cursor(sort_option, items[0])
+        project = projection(fields)
+        return _encode({"items": [project(item) for item in items],
+                        "next": next_cursor, "prev": prev_cursor})
+
+    return conditional(make_etag(key), lambda: catalog_cache.get_or_set(key, serialize))
+
+
+def items_by_id(fields):
+    # ?ids=3,1,2: the listings in the order asked for; ids with no listing
+    # are returned under "missing"
+    try:
+        ids = list(dict.fromkeys(int(value) for value in request.args["ids"].split(",") if value.strip()))
+    except ValueError:
+        raise ApiError("ids must be a comma-separated list of integers")
+    if not 1 <= len(ids) <= MAX_BATCH:
+        raise ApiError(f"Pass between 1 and {MAX_BATCH} ids")
+
+    # Rows are (version, updated_at, id, *other fields)
+    rows = {row[2]: row for row in repository.items_by_id(get_connection(), ids, fields)}
+    versions = [(item_id, rows[item_id][0] if item_id in rows else None) for item_id in ids]
+
+    def serialize():
+        return _encode({"items": [dict(zip(fields, rows[item_id][2:])) for item_id in ids if item_id in rows],
+                        "missing": [item_id for item_id in ids if item_id not in rows]})
+
+    return conditional(make_etag(("api_items_by_id", fields, versions)), serialize)
+
+
+@api_routes.route("/items/<int:item_id>")
+@login_required
+def get_item(item_id):
+    fields = fields_arg()
+    rows = repository.items_by_id(get_connection(), [item_id], fields)
+    if not rows:
+        raise ApiError("Listing not found", 404)
+    version, updated_at, *values = rows[0]
+    return conditional(make_etag(("api_item", item_id, version, fields)),
+                       lambda: _encode(dict(zip(fields, values))), last_modified=http_date(updated_at))
+
+
+@api_routes.route("/threads")
+@login_required
+def list_threads():
+    user_id = current_user_id()
+    conversations, next_cursor = inbox.conversation_page(get_connection(), user_id,
+                                                         request.args.get("before"), limit_arg())
+    # A thread's summary changes with its last message and unread count
+    key = ("api_threads", user_id, next_cursor, [
+        (c["item_id"], c["other_id"], c["last_message_id"], c["unread"], c["product_name"])
+        for c in conversations
+    ])
+
+    def serialize():
+        return _encode({
+            "threads": [
+                {
+                    "item_id": c["item_id"],
+                    "product_name": c["product_name"],
+                    "other_id": c["other_id"],
+                    "other_user": c["other_user"],
+                    "unread": c["unread"],
+                    "last_sender": c["last_sender"],
+                    "last_content": c["last_content"],
+                    "last_timestamp": c["last_timestamp"],
+                }
+                for c in conversations
+            ],
+            "next": next_cursor,
+        })
+
+    return conditional(make_etag(key), serialize)
+
+
+@api_routes.route("/threads/<int:item_id>/<int:other_id>")
+@login_required
+def thread_messages(item_id, other_id):
+    user_id = current_user_id()
+    messages, older_cursor = inbox.thread_page(get_connection(), item_id, user_id, other_id,
+                                               request.args.get("before"), limit_arg())
+    # Messages never change once sent, except for being read
+    key = ("api_thread", item_id, user_id, other_id, older_cursor,
+           [(m["id"], m["read"]) for m in messages])
+
+    def serialize():
+        return _encode({
+            "messages": [
+                {
+                    "id": m["id"],
+                    "sender": m["sender"],
+                    "sender_id": m["sender_id"],
+                    "content": m["content"],
+                    "timestamp": m["timestamp"],
+                    "read": bool(m["read"]),
+                }
+                for m in messages
+            ],
+            "before": older_cursor,
+        })
+
+    return conditional(make_etag(key), serialize)
+
+
+@api_routes.route("/messages", methods=["POST"])
+@login_required
+def send_messages():
+    # {"messages": [{"item_id": 1, "content": "...", "to": 7}, ...]}; "to"
+    # lets a seller reply to a buyer, as on the item page. Every message is
+    # checked first, then all are stored in one group commit, or none are
+    payload = request.get_json(silent=True)
+    batch = payload.get("messages") if isinstance(payload, dict) else None
+    if not isinstance(batch, list) or not 1 <= len(batch) <= MAX_SEND_BATCH:
+        raise ApiError(f"Send a JSON object with 1 to {MAX_SEND_BATCH} messages")
+
+    sender = current_user_id()
+    conn = get_connection()
+    sellers = repository.sellers_of(conn, {m["item_id"] for m in batch
+                                           if isinstance(m, dict) and isinstance(m.get("item_id"), int)})
+    errors, messages, receivers = [], [], []
+    timestamp = datetime.now().isoformat()
+    for index, message in enumerate(batch):
+        message = message if isinstance(message, dict) else {}
+        item_id, content, reply_to = message.get("item_id"), message.get("content"), message.get("to")
+        if not isinstance(content, str) or not content.strip():
+            errors.append({"index": index, "error": "content is required"})
+            continue
+        seller = sellers.get(item_id) if isinstance(item_id, int) else None
+        if seller is None:
+            errors.append({"index": index, "error": "Product not found"})
+            continue
+        receiver = seller
+        if sender == seller and isinstance(reply_to, int) and repository.has_conversation(
+                conn, item_id, sender, reply_to):
+            receiver = reply_to
+        messages.append((item_id, sender, receiver, content, timestamp))
+        receivers.append(seller)
+    if errors:
+        return jsonify({"errors": errors}), 400
+
+    # Returns once every message is committed
+    message_ids = writer.send_messages(messages)
+    for message_id, seller, (item_id, _, receiver, content, _) in zip(message_ids, receivers, messages):
+        analytics.record_inquiry(item_id, seller, sender)
+        inbox.publish_message(message_id, item_id, sender, session["username"], receiver, content,
+                              timestamp)
+    return jsonify({"ids": message_ids}), 201
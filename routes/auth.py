@@ -1,9 +1,11 @@
 from flask import Blueprint, request, jsonify, render_template, redirect, session
-from models import User, Item, db
+from models import User, db
+import passwords
 
 auth_routes = Blueprint("auth", __name__)
 
 @auth_routes.route("/login", methods=["GET", "POST"])
+@passwords.protect("login.html")
 def login():
     if request.method == "GET":
         return render_template("login.html")
@@ -18,9 +20,14 @@ def login():
     password = data.get("password")
 
     user = User.query.filter_by(email=email).first()
+    valid, new_hash = passwords.verify_password(user.password_hash, password) if user else (False, None)
 
-    if user and user.check_password(password):
+    if valid:
+        if new_hash:
+            user.password_hash = new_hash  # upgrade to the current hash parameters
+            db.session.commit()
         session["username"] = user.username  # ✅ Store username in session
+        session["user_id"] = user.id
         if request.is_json:
             return jsonify({"message": "Login successful"}), 200
         else:
@@ -32,6 +39,7 @@ def login():
             return render_template("login.html", error="Invalid credentials")
 
 @auth_routes.route("/register", methods=["GET", "POST"])
+@passwords.protect("register.html")
 def register():
     if request.method == "GET":
         return render_template("register.html")
@@ -1,11 +1,13 @@
-from flask import Blueprint, render_template, request, redirect, session
-from models import Item, db
+from datetime import datetime
+from flask import Blueprint, abort, render_template, request, redirect, session
+import repository
+from database import get_connection
 
 product_routes = Blueprint("products", __name__)
 
 @product_routes.route("/items")
 def view_items():
-    items = Item.query.all()
+    items = repository.list_products(get_connection(), limit=-1)
     username = session.get("username")
     return render_template("items.html", items=items, username=username)
 
@@ -18,16 +20,19 @@ def add_item():
     price = request.form.get("price")
 
     if name and price:
-        new_item = Item(name=name, price=float(price))
-        db.session.add(new_item)
-        db.session.commit()
+        repository.add_product(get_connection(), product_name=name, price=float(price),
+                               seller=session.get("username"), seller_id=session.get("user_id"),
+                               timestamp=datetime.now().isoformat())
         return redirect("/items")
     else:
         return render_template("add_item.html", error="Please provide both name and price.")
 
 @product_routes.route("/edit/<int:item_id>", methods=["GET", "POST"])
 def edit_item(item_id):
-    item = Item.query.get_or_404(item_id)
+    conn = get_connection()
+    item = repository.get_product(conn, item_id)
+    if item is None:
+        abort(404)
 
     if request.method == "GET":
         return render_template("edit_item.html", item=item)
@@ -36,16 +41,15 @@ def edit_item(item_id):
     price = request.form.get("price")
 
     if name and price:
-        item.name = name
-        item.price = float(price)
-        db.session.commit()
+        repository.update_product(conn, item_id, product_name=name, price=float(price))
         return redirect("/items")
     else:
         return render_template("edit_item.html", item=item, error="Please provide both name and price.")
 
 @product_routes.route("/delete/<int:item_id>", methods=["POST"])
 def delete_item(item_id):
-    item = Item.query.get_or_404(item_id)
-    db.session.delete(item)
-    db.session.commit()
+    conn = get_connection()
+    if repository.get_product(conn, item_id) is None:
+        abort(404)
+    repository.delete_product(conn, item_id)
     return redirect("/items")
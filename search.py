@@ -0,0 +1,101 @@
+import re
+import sqlite3
+import sys
+from markupsafe import Markup, escape
+
+# Full-text product search over the products_fts FTS5 table created in
+# migrations.py. The table is external-content (it indexes products by id
+# without storing a second copy of the text) and triggers keep it in sync
+# with every INSERT/UPDATE/DELETE on products.
+
+MAX_TERMS = 8
+
+# bm25 column weights, in products_fts column order:
+# product_name, description, category, seller, location
+BM25_WEIGHTS = "10.0, 2.0, 4.0, 3.0, 1.0"
+
+# Control-character markers for highlight()/snippet(); swapped for <mark> tags
+# only after the listing text itself has been HTML-escaped.
+_OPEN, _CLOSE = "\x02", "\x03"
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def match_expression(text, prefix=True):
+    """Turn free text from the search box into a safe FTS5 MATCH string.
+
+    Every term is quoted so FTS5 operators typed by users are taken
+    literally, and the last term is a prefix query for type-ahead.
+    Returns None when the text has no searchable terms.
+    """
+    terms = _TERM_RE.findall(text or "")[:MAX_TERMS]
+    if not terms:
+        return None
+    quoted = ['"%s"' % term for term in terms]
+    if prefix:
+        quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def highlights(conn, match, ids):
+    # Highlighted name and description snippet for one page of results.
+    # Done as a second query so they are only computed for the rows shown,
+    # not for every row that matched.
+    if not ids:
+        return {}
+    placeholders = ", ".join("?" for _ in ids)
+    rows = conn.execute(f"""
+        SELECT rowid,
+               highlight(products_fts, 0, '{_OPEN}', '{_CLOSE}'),
+               snippet(products_fts, 1, '{_OPEN}', '{_CLOSE}', '…', 12)
+        FROM products_fts
+        WHERE products_fts MATCH ? AND rowid IN ({placeholders})
+    """, [match, *ids])
+    return {row[0]: (mark_up(row[1]), mark_up(row[2])) for row in rows}
+
+
+def mark_up(text):
+    if not text:
+        return Markup("")
+    return Markup(str(escape(text)).replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>"))
+
+
+def suggest(conn, text, limit=8):
+    match = match_expression(text)
+    if not match:
+        return []
+    rows = conn.execute(f"""
+        SELECT products.id, products.product_name
+        FROM products_fts JOIN products ON products.id = products_fts.rowid
+        WHERE products_fts MATCH ?
+        ORDER BY bm25(products_fts, {BM25_WEIGHTS})
+        LIMIT ?
+    """, ("product_name : (" + match + ")", limit))
+    return [{"id": row[0], "product_name": row[1]} for row in rows]
+
+
+def rebuild(conn):
+    # Re-index every existing row in products (backfill after import or
+    # a restore, or to repair an index that drifted out of sync).
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES ('optimize')")
+    conn.commit()
+    return conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+
+    db_path = "marketplace.db"
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+            print(f"✅ Indexed {rebuild(conn)} products for search.")
+        elif len(sys.argv) > 1:
+            for row in suggest(conn, " ".join(sys.argv[1:]), limit=20):
+                print(row["id"], row["product_name"])
+        else:
+            print("Usage: python search.py rebuild | python search.py <terms>")
+    finally:
+        conn.close()
@@ -0,0 +1,576 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+import numpy as np
+from flask import current_app
+
+import archive
+import cache
+
+# "Similar items" on the listing page.
+# Each listing is a TF-IDF vector over the words of its name (counted
+# NAME_WEIGHT times), its description and a category:<name> term, scaled to
+# unit length. Two listings score their cosine similarity times a price
+# factor between 1 - PRICE_WEIGHT (prices far apart) and 1 (equal prices),
+# and each listing's top-K scores above MIN_SCORE are stored in
+# similar_products, so the page reads them with one indexed lookup.
+#   - build() scores the whole catalog with NumPy, a batch of rows at a
+#     time: the most common terms go through a dense matrix product, the
+#     rest through their posting lists. rebuild() stores the result along
+#     with the IDF it was fitted with (similar_idf) and every listing's
+#     term weights (similar_terms, an inverted index);
+#   - triggers queue every inserted or edited listing in similar_pending.
+#     The Refresher thread (one per worker process) scores queued listings
+#     against similar_terms with the stored IDF, replaces their lists and
+#     inserts them into the lists of listings they now rank in. A deleted
+#     listing's rows go with it, and the listings that showed it are queued
+#     to refill their lists;
+#   - when many listings are queued (a bulk import) or the catalog has more
+#     than doubled since the IDF was fitted, the refresher rebuilds
+#     everything instead, one worker at a time.
+# Scoring runs outside any transaction; results are written only for
+# listings that have not changed again in the meantime.
+
+DEFAULT_K = 6
+MIN_SCORE = 0.05
+NAME_WEIGHT = 2.0
+CATEGORY_WEIGHT = 2.0
+PRICE_WEIGHT = 0.3
+# build() scores terms found in more than DENSE_SHARE of the listings (at
+# most DENSE_TERMS of them) with a dense (listings x terms) matrix product
+DENSE_SHARE = 0.05
+DENSE_TERMS = 256
+# Score cells per batch in build(): batch rows x catalog size
+BATCH_CELLS = 1 << 21
+REFRESH_BATCH = 256
+REBUILD_BACKLOG = 1000
+REBUILD_LEASE = 600
+REBUILD_JOB = "similar listings rebuild"
+DEFAULT_REFRESH_SECONDS = 10
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have in into is it its of on or so
+    than that the this to was were will with
+""".split())
+TOKEN = re.compile(r"[^\W_]+")
+
+
+def terms(product_name, description, category):
+    """{term: weighted count} for one listing."""
+    counts = {}
+    for text, weight in ((product_name, NAME_WEIGHT), (description, 1.0)):
+        for token in TOKEN.findall((text or "").lower()):
+            if len(token) > 1 and not token.isdigit() and token not in STOP_WORDS:
+                counts[token] = counts.get(token, 0.0) + weight
+    category = " ".join((category or "").lower().split())
+    if category:
+        counts["category:" + category] = CATEGORY_WEIGHT
+    return counts
+
+
+def _price(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def idf_for(documents, df):
+    # Smoothed, as if one more listing contained every term
+    return np.log((1 + documents) / (1 + df)) + 1
+
+
+def _tfidf(documents, idf=None, default_idf=1.0):
+    """Unit-length TF-IDF rows for a list of terms() dicts.
+
+    Returns (vocabulary, idf per vocabulary term, indptr, term ids,
+    weights): row i is term_ids/weights[indptr[i]:indptr[i + 1]]. The IDF is
+    fitted on `documents` unless a {term: idf} mapping is given, in which
+    case terms it lacks get `default_idf`.
+    """
+    vocabulary, lengths, term_ids, counts = {}, [], [], []
+    for document in documents:
+        lengths.append(len(document))
+        for term, count in document.items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(count)
+    words = list(vocabulary)
+    indptr = np.zeros(len(documents) + 1, np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    term_ids = np.asarray(term_ids, np.int64)
+    if idf is None:
+        term_idf = idf_for(len(documents), np.bincount(term_ids, minlength=len(words)))
+    else:
+        term_idf = np.array([idf.get(word, default_idf) for word in words], float)
+    # Sublinear term frequency: a word repeated in a long description does
+    # not outweigh the name
+    weights = (1 + np.log(np.asarray(counts, float))) * term_idf[term_ids]
+    rows = np.repeat(np.arange(len(documents)), lengths)
+    norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(documents)))
+    weights /= norms[rows]
+    return words, term_idf, indptr, term_ids, weights
+
+
+def _postings(docs, term_ids, weights, vocabulary_size):
+    # (pointer per term, documents, weights): the postings of term t are
+    # documents/weights[pointer[t]:pointer[t + 1]]
+    order = np.argsort(term_ids, kind="stable")
+    pointer = np.zeros(vocabulary_size + 1, np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=vocabulary_size), out=pointer[1:])
+    return pointer, docs[order], weights[order]
+
+
+def _expand(rows, term_ids, weights, postings, shape):
+    """Dot products of the query entries (row, term, weight) with every
+    document sharing a term, as a dense `shape` array."""
+    pointer, docs, doc_weights = postings
+    start = pointer[term_ids]
+    count = pointer[term_ids + 1] - start
+    total = int(count.sum())
+    if not total:
+        return np.zeros(shape)
+    # Index of every posting of every query term, without a Python loop
+    ends = np.cumsum(count)
+    positions = np.repeat(start - ends + count, count) + np.arange(total)
+    cells = np.repeat(rows, count) * shape[1] + docs[positions]
+    values = np.repeat(weights, count) * doc_weights[positions]
+    return np.bincount(cells, weights=values, minlength=shape[0] * shape[1]).reshape(shape)
+
+
+def apply_prices(scores, prices, other_prices):
+    """Scale `scores` (len(prices) x len(other_prices)) in place by the price
+    factor: 1 for equal prices, down to 1 - PRICE_WEIGHT as they grow apart."""
+    # (low + 1) / (high + 1), one float32 pass at a time
+    factor = np.divide.outer((prices + 1).astype(np.float32), (other_prices + 1).astype(np.float32))
+    np.minimum(factor, 1 / factor, out=factor)
+    factor *= PRICE_WEIGHT
+    factor += 1 - PRICE_WEIGHT
+    scores *= factor
+
+
+def _top(scores, ids, k):
+    # [(similar ids, scores)] per row, best first, scores above MIN_SCORE
+    if scores.shape[1] > k:
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    best = np.take_along_axis(scores, columns, axis=1)
+    order = np.lexsort((ids[columns], -best), axis=1)
+    columns = np.take_along_axis(columns, order, axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+    return [(ids[c[s > MIN_SCORE]], s[s > MIN_SCORE]) for c, s in zip(columns, best)]
+
+
+class Model:
+    """A fitted catalog: IDF, unit term weights (CSR rows) and prices."""
+
+    def __init__(self, ids, prices, words, idf, indptr, term_ids, weights):
+        self.ids = ids
+        self.prices = prices
+        self.words = words
+        self.idf = idf
+        self.indptr = indptr
+        self.term_ids = term_ids
+        self.weights = weights
+
+    @property
+    def default_idf(self):
+        # For terms first seen after the fit: as rare as can be
+        return float(idf_for(len(self.ids), 1))
+
+    def term_rows(self):
+        # (term, product_id, weight) for similar_terms
+        docs = np.repeat(self.ids, np.diff(self.indptr))
+        return zip([self.words[t] for t in self.term_ids.tolist()], docs.tolist(),
+                   self.weights.tolist())
+
+
+def build(rows, k=DEFAULT_K):
+    """Fit the catalog `rows` of (id, product_name, description, category,
+    price) and find every listing's top-k.
+
+    Returns (Model, [(product_id, similar_id, score)]).
+    """
+    n = len(rows)
+    ids = np.array([row[0] for row in rows], np.int64)
+    prices = np.array([_price(row[4]) for row in rows])
+    words, idf, indptr, term_ids, weights = _tfidf([terms(*row[1:4]) for row in rows])
+    model = Model(ids, prices, words, idf, indptr, term_ids, weights)
+    if n < 2:
+        return model, []
+    docs = np.repeat(np.arange(n), np.diff(indptr))
+    df = np.bincount(term_ids, minlength=len(words))
+
+    # Terms in more than DENSE_SHARE of the listings would make the longest
+    # posting lists (expanding one costs df^2): score them as a dense matrix
+    # product instead. Terms of a single listing score nothing.
+    dense = np.argsort(-df, kind="stable")[:DENSE_TERMS]
+    dense = dense[df[dense] > max(1, DENSE_SHARE * n)]
+    column = np.full(len(words), -1)
+    column[dense] = np.arange(len(dense))
+    in_dense = column[term_ids] >= 0
+    matrix = np.zeros((n, len(dense)), np.float32)
+    matrix[docs[in_dense], column[term_ids[in_dense]]] = weights[in_dense]
+    sparse = ~in_dense & (df[term_ids] > 1)
+    postings = _postings(docs[sparse], term_ids[sparse], weights[sparse], len(words))
+
+    neighbors = []
+    batch = max(1, BATCH_CELLS // n)
+    for lo in range(0, n, batch):
+        hi = min(n, lo + batch)
+        entries = slice(indptr[lo], indptr[hi])
+        query = sparse[entries]
+        scores = matrix[lo:hi] @ matrix.T
+        if query.any():
+            scores += _expand(docs[entries][query] - lo, term_ids[entries][query],
+                              weights[entries][query], postings, (hi - lo, n))
+        apply_prices(scores, prices[lo:hi], prices)
+        scores[np.arange(hi - lo), np.arange(lo, hi)] = 0
+        for product_id, (similar_ids, best) in zip(ids[lo:hi].tolist(), _top(scores, ids, k)):
+            neighbors.extend(zip([product_id] * len(similar_ids), similar_ids.tolist(), best.tolist()))
+    return model, neighbors
+
+
+PRODUCT_ROWS = "SELECT id, product_name, description, category, price FROM products"
+
+
+def _store(conn, model, neighbors, done):
+    # Replace the fitted model and every list; `done` is the JSON list of
+    # listing ids whose queue entries this build covered. Does not commit.
+    for table in ("similar_products", "similar_terms", "similar_idf", "similar_model"):
+        conn.execute(f"DELETE FROM {table}")
+    conn.executemany("INSERT INTO similar_idf (term, idf) VALUES (?, ?)",
+                     zip(model.words, model.idf.tolist()))
+    conn.executemany("INSERT INTO similar_terms (term, product_id, weight) VALUES (?, ?, ?)",
+                     model.term_rows())
+    conn.executemany("INSERT INTO similar_products (product_id, similar_id, score) VALUES (?, ?, ?)",
+                     neighbors)
+    conn.execute("""
+        INSERT INTO similar_model (id, documents, default_idf, built_at) VALUES (1, ?, ?, ?)
+    """, (len(model.ids), model.default_idf, datetime.now().isoformat()))
+    # Listings deleted since they were read
+    conn.execute("DELETE FROM similar_products WHERE product_id NOT IN (SELECT id FROM products) "
+                 "OR similar_id NOT IN (SELECT id FROM products)")
+    conn.execute("DELETE FROM similar_terms WHERE product_id NOT IN (SELECT id FROM products)")
+    conn.execute("DELETE FROM similar_pending WHERE product_id IN (SELECT value FROM json_each(?))",
+                 (done,))
+    # Every listing page shows a list
+    cache.invalidate(conn, "similar")
+
+
+def rebuild(conn, k=DEFAULT_K):
+    """Refit on the whole catalog and recompute every list. Does not commit.
+
+    Returns the number of listings.
+    """
+    rows = conn.execute(PRODUCT_ROWS).fetchall()
+    model, neighbors = build(rows, k)
+    _store(conn, model, neighbors, json.dumps(model.ids.tolist()))
+    return len(rows)
+
+
+def _in_transaction(conn, work):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = work()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return result
+
+
+def _unchanged(conn, rows):
+    # The ids among `rows` that still read the same (call inside the write transaction)
+    current = {row[0]: tuple(row) for row in conn.execute(
+        f"{PRODUCT_ROWS} WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps([row[0] for row in rows]),))}
+    return [row[0] for row in rows if current.get(row[0]) == tuple(row)]
+
+
+def rebuild_online(conn, k=DEFAULT_K):
+    """rebuild() on an autocommit connection, scoring outside the write
+    transaction. Listings edited meanwhile stay queued."""
+    rows = conn.execute(PRODUCT_ROWS).fetchall()
+    model, neighbors = build(rows, k)
+    _in_transaction(conn, lambda: _store(conn, model, neighbors, json.dumps(_unchanged(conn, rows))))
+    return len(rows)
+
+
+def _json_rows(conn, sql, values, *params):
+    return conn.execute(sql, (json.dumps(values), *params)).fetchall()
+
+
+def refresh(conn, rows, changed, k=DEFAULT_K):
+    """Recompute the lists of `rows` (id, product_name, description,
+    category, price) on an autocommit connection, and for the ids in
+    `changed` (new or edited listings) update the lists they now rank in.
+
+    Returns the number of listings written.
+    """
+    batch_ids = [row[0] for row in rows]
+    documents = [terms(*row[1:4]) for row in rows]
+    vocabulary = sorted({term for document in documents for term in document})
+    model_row = conn.execute("SELECT default_idf FROM similar_model WHERE id = 1").fetchone()
+    idf = dict(_json_rows(conn, "SELECT term, idf FROM similar_idf "
+                                "WHERE term IN (SELECT value FROM json_each(?))", vocabulary))
+    words, _, indptr, term_ids, weights = _tfidf(documents, idf, model_row[0] if model_row else 1.0)
+
+    # Every other listing sharing a term, from the inverted index; the
+    # batch's own new vectors go last
+    postings = _json_rows(conn, """
+        SELECT term, product_id, weight FROM similar_terms
+        WHERE term IN (SELECT value FROM json_each(?))
+          AND product_id NOT IN (SELECT value FROM json_each(?))
+    """, words, json.dumps(batch_ids))
+    term_index = {word: i for i, word in enumerate(words)}
+    stored_ids = np.array([row[1] for row in postings], np.int64)
+    candidates, stored_docs = np.unique(stored_ids, return_inverse=True)
+    ids = np.concatenate([candidates, np.array(batch_ids, np.int64)])
+    batch_docs = np.repeat(np.arange(len(rows)), np.diff(indptr)) + len(candidates)
+    index = _postings(
+        np.concatenate([stored_docs.reshape(-1), batch_docs]),
+        np.concatenate([np.array([term_index[row[0]] for row in postings], np.int64), term_ids]),
+        np.concatenate([np.array([row[2] for row in postings]), weights]),
+        len(words),
+    )
+    prices = dict(_json_rows(conn, "SELECT id, price FROM products "
+                                   "WHERE id IN (SELECT value FROM json_each(?))",
+                             candidates.tolist()))
+    all_prices = np.array([_price(prices.get(i)) for i in candidates.tolist()]
+                          + [_price(row[4]) for row in rows])
+    shape = (len(rows), len(ids))
+    scores = _expand(np.repeat(np.arange(len(rows)), np.diff(indptr)), term_ids, weights, index, shape)
+    apply_prices(scores, all_prices[len(candidates):], all_prices)
+    scores[np.arange(len(rows)), np.arange(len(rows)) + len(candidates)] = 0
+    lists = _top(scores, ids, k)
+
+    # Where the edited listings stand in the other listings' lists: the
+    # score to beat (MIN_SCORE for a list with room) and their current entries
+    full = dict(_json_rows(conn, """
+        SELECT product_id, MIN(score) FROM similar_products
+        WHERE product_id IN (SELECT value FROM json_each(?))
+        GROUP BY product_id HAVING COUNT(*) >= ?
+    """, candidates.tolist(), k))
+    to_beat = np.array([full.get(i, MIN_SCORE) for i in candidates.tolist()])
+    listed = {}
+    for product_id, similar_id, score in _json_rows(conn, """
+        SELECT product_id, similar_id, score FROM similar_products
+        WHERE similar_id IN (SELECT value FROM json_each(?))
+    """, [i for i in batch_ids if i in changed]):
+        listed.setdefault(similar_id, {})[product_id] = score
+    position = {product_id: i for i, product_id in enumerate(candidates.tolist())}
+
+    upserts, removals, requeue = [], [], set()
+    for row_index, product_id in enumerate(batch_ids):
+        if product_id not in changed:
+            continue
+        row = scores[row_index, :len(candidates)]
+        for other in np.nonzero(row > to_beat)[0].tolist():
+            upserts.append((candidates[other].item(), product_id, row[other].item()))
+        for other_id, old in listed.get(product_id, {}).items():
+            column = position.get(other_id)
+            score = row[column].item() if column is not None else 0.0
+            if score <= MIN_SCORE:
+                removals.append((other_id, product_id))
+            elif column is not None and score <= to_beat[column]:
+                upserts.append((other_id, product_id, score))
+            if score < old:
+                # Something else may rank above it now
+                requeue.add(other_id)
+
+    def write():
+        fresh = set(_unchanged(conn, rows))
+        for row_index, product_id in enumerate(batch_ids):
+            if product_id not in fresh:
+                continue
+            conn.execute("DELETE FROM similar_terms WHERE product_id = ?", (product_id,))
+            entries = slice(indptr[row_index], indptr[row_index + 1])
+            conn.executemany("INSERT INTO similar_terms (term, product_id, weight) VALUES (?, ?, ?)",
+                             [(words[t], product_id, w) for t, w in
+                              zip(term_ids[entries].tolist(), weights[entries].tolist())])
+            conn.execute("DELETE FROM similar_products WHERE product_id = ?", (product_id,))
+            similar_ids, best = lists[row_index]
+            # Listings deleted since they were scored are left out
+            conn.executemany("""
+                INSERT INTO similar_products (product_id, similar_id, score)
+                SELECT ?, id, ? FROM products WHERE id = ?
+            """, [(product_id, score, s) for s, score in zip(similar_ids.tolist(), best.tolist())])
+        ours = [row for row in upserts if row[1] in fresh]
+        conn.executemany("""
+            INSERT INTO similar_products (product_id, similar_id, score)
+            SELECT id, ?, ? FROM products WHERE id = ?
+            ON CONFLICT (product_id, similar_id) DO UPDATE SET score = excluded.score
+        """, [(product_id, score, other) for other, product_id, score in ours])
+        conn.executemany("DELETE FROM similar_products WHERE product_id = ? AND similar_id = ?",
+                         [row for row in removals if row[1] in fresh])
+        # Lists that took a new entry keep their best k
+        conn.executemany("""
+            DELETE FROM similar_products WHERE product_id = ? AND similar_id NOT IN (
+                SELECT similar_id FROM similar_products WHERE product_id = ?
+                ORDER BY score DESC, similar_id LIMIT ?
+            )
+        """, [(other, other, k) for other in {row[0] for row in ours}])
+        conn.executemany("""
+            INSERT INTO similar_pending (product_id, changed) VALUES (?, 0)
+            ON CONFLICT (product_id) DO NOTHING
+        """, [(other,) for other in requeue - fresh])
+        conn.execute("DELETE FROM similar_pending WHERE product_id IN (SELECT value FROM json_each(?))",
+                     (json.dumps(sorted(fresh)),))
+        touched = fresh | {row[0] for row in ours} | {row[0] for row in removals if row[1] in fresh}
+        if touched:
+            cache.invalidate(conn, *(f"item:{product_id}" for product_id in sorted(touched)))
+        return len(fresh)
+
+    return _in_transaction(conn, write)
+
+
+def drain(conn, path, k=DEFAULT_K, busy_timeout_ms=5000):
+    """Work through the queue on an autocommit connection to `path`.
+
+    Returns (listings refreshed, whether the catalog was rebuilt).
+    """
+    refreshed, rebuilt = 0, False
+    while True:
+        pending = conn.execute("SELECT COUNT(*) FROM similar_pending").fetchone()[0]
+        if not pending:
+            return refreshed, rebuilt
+        products = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        model = conn.execute("SELECT documents FROM similar_model WHERE id = 1").fetchone()
+        fitted = model[0] if model else 0
+        if not rebuilt and (pending > REBUILD_BACKLOG or products > 2 * fitted + REBUILD_BACKLOG):
+            # One worker rebuilds; the others leave the queue to it
+            if not archive.claim(path, REBUILD_LEASE, busy_timeout_ms, name=REBUILD_JOB):
+                return refreshed, rebuilt
+            try:
+                refreshed += rebuild_online(conn, k)
+            finally:
+                conn.execute("UPDATE maintenance_runs SET started_at = 0, finished_at = ? "
+                             "WHERE name = ?", (time.time(), REBUILD_JOB))
+            rebuilt = True
+            continue
+        queued = conn.execute(f"""
+            SELECT p.id, p.product_name, p.description, p.category, p.price, q.changed
+            FROM similar_pending q JOIN products p ON p.id = q.product_id
+            ORDER BY q.product_id LIMIT {REFRESH_BATCH}
+        """).fetchall()
+        if not queued:
+            return refreshed, rebuilt
+        count = refresh(conn, [row[:5] for row in queued], {row[0] for row in queued if row[5]}, k)
+        refreshed += count
+        if not count:
+            # All of them were edited again meanwhile: next time
+            return refreshed, rebuilt
+
+
+class Refresher:
+    """Drains the queue every `interval` seconds, or as soon as this worker
+    adds or edits a listing."""
+
+    def __init__(self, path, k=DEFAULT_K, interval=DEFAULT_REFRESH_SECONDS, busy_timeout_ms=5000):
+        self.path = path
+        self.k = k
+        self.interval = interval
+        self.busy_timeout_ms = busy_timeout_ms
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.refreshed = 0
+        self.rebuilds = 0
+        self.failures = 0
+        self._thread = threading.Thread(target=self._run, name="similar-refresh", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        conn = None
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                if conn is None:
+                    conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                                           isolation_level=None)
+                refreshed, rebuilt = drain(conn, self.path, self.k, self.busy_timeout_ms)
+                self.refreshed += refreshed
+                self.rebuilds += rebuilt
+            except Exception as e:
+                # Not only database errors: anything raised while scoring
+                # (NumPy, bad data) would otherwise end the thread silently
+                # and leave this worker's lists stale. Logged, counted, and
+                # retried on a fresh connection at the next wake-up
+                print("Similar listings refresh error:", repr(e))
+                traceback.print_exc()
+                self.failures += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def close(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {"refreshed": self.refreshed, "rebuilds": self.rebuilds, "failures": self.failures}
+
+
+_refreshers = {}
+_refreshers_lock = threading.Lock()
+
+
+def get_refresher(app=None):
+    # One refresh thread per worker process, started after the fork; None
+    # when SIMILAR_REFRESH_SECONDS is 0 (then run `python similar.py refresh`)
+    app = app or current_app
+    if not app.config["SIMILAR_REFRESH_SECONDS"]:
+        return None
+    key = os.getpid()
+    refresher = _refreshers.get(key)
+    if refresher is None:
+        with _refreshers_lock:
+            refresher = _refreshers.get(key)
+            if refresher is None:
+                refresher = Refresher(app.config["DATABASE"], k=app.config["SIMILAR_K"],
+                                      interval=app.config["SIMILAR_REFRESH_SECONDS"],
+                                      busy_timeout_ms=app.config.get("DB_BUSY_TIMEOUT_MS", 5000))
+                _refreshers[key] = refresher
+    return refresher
+
+
+def init_app(app):
+    app.config.setdefault("SIMILAR_K", int(os.environ.get("SIMILAR_K", DEFAULT_K)))
+    app.config.setdefault("SIMILAR_REFRESH_SECONDS", float(os.environ.get(
+        "SIMILAR_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS)))
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+
+    db_path = "marketplace.db"
+    migrate(db_path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        command = sys.argv[1] if len(sys.argv) > 1 else None
+        if command == "rebuild":
+            start = time.perf_counter()
+            count = _in_transaction(conn, lambda: rebuild(conn))
+            print(f"✅ Recomputed similar listings for {count} listings "
+                  f"in {time.perf_counter() - start:.1f}s.")
+        elif command == "refresh":
+            refreshed, rebuilt = drain(conn, db_path)
+            print(f"✅ {'Rebuilt' if rebuilt else 'Refreshed'} {refreshed} listings.")
+        else:
+            print("Usage: python similar.py rebuild | python similar.py refresh")
+    finally:
+        conn.close()
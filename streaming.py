@@ -0,0 +1,226 @@
+import zlib
+from flask import before_render_template, current_app, get_flashed_messages, stream_with_context
+from flask import template_rendered
+from werkzeug.http import parse_accept_header
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Streamed, compressed responses.
+#   - stream_template() renders a page as it goes, so the browser gets the
+#     <head> (and starts fetching CSS) while the rows are still being read.
+#     Jinja yields many tiny strings; they are sent in chunks of about
+#     STREAM_CHUNK_SIZE characters, and at every FLUSH_MARKER (base.html
+#     puts one after the navigation) whatever is pending goes out at once.
+#     A streamed view must not touch the session once it returns (it has
+#     already been saved), and must read its rows through get_connection()
+#     inside the stream: the connection it used while the view ran is back
+#     in the pool by then. metrics.py records the request when the server
+#     closes the response rather than when the view returns.
+#   - Compressor is WSGI middleware that gzips (or, with the brotli package,
+#     brotli-compresses) responses for clients that accept it, chunk by
+#     chunk with a sync flush after each, so streamed pages stay streamed.
+#     Bodies smaller than COMPRESS_MIN_SIZE, already-encoded responses
+#     (pre-compressed assets), ranges, server-sent events and types in
+#     SKIP_TYPES (images and other compressed formats) pass through
+#     untouched, file_wrapper bodies (sendfile) included.
+
+DEFAULT_CHUNK_SIZE = 8192
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_GZIP_LEVEL = 6
+# On-the-fly brotli: quality 4 compresses about as well as gzip -6, faster
+DEFAULT_BROTLI_QUALITY = 4
+FLUSH_MARKER = "<!--flush-->"
+
+# Content types never worth compressing (prefix match)
+SKIP_TYPES = (
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/avif", "video/", "audio/",
+    "font/woff", "application/zip", "application/gzip", "application/x-gzip",
+    "application/pdf", "application/octet-stream", "text/event-stream",
+)
+
+
+def stream_template(template_name, **context):
+    """Like flask.render_template(), but returns an iterator of chunks."""
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    context["streaming"] = True
+    # Flashes are popped from the session, which is saved before the body
+    # is sent: read them now (base.html's call gets the same list)
+    get_flashed_messages()
+    before_render_template.send(app, _async_wrapper=app.ensure_sync, template=template,
+                                context=context)
+    stats = metrics.current()
+    if stats is not None:
+        stats.streaming = True
+    chunk_size = app.config["STREAM_CHUNK_SIZE"]
+
+    def generate():
+        pending, size = [], 0
+        for piece in template.generate(context):
+            if FLUSH_MARKER in piece:
+                before, _, after = piece.partition(FLUSH_MARKER)
+                pending.append(before)
+                yield "".join(pending)
+                pending, size = [after], len(after)
+                continue
+            pending.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield "".join(pending)
+                pending, size = [], 0
+        if pending:
+            yield "".join(pending)
+        template_rendered.send(app, _async_wrapper=app.ensure_sync, template=template,
+                               context=context)
+
+    return stream_with_context(generate())
+
+
+def negotiate(accept_encoding):
+    # "br" or "gzip" per Accept-Encoding (ties go to brotli); None for identity
+    accepted = parse_accept_header(accept_encoding)
+    choices = [encoding for encoding in ("br", "gzip")
+               if accepted[encoding] and (encoding != "br" or brotli is not None)]
+    return max(choices, key=lambda encoding: accepted[encoding]) if choices else None
+
+
+class _Gzip:
+    def __init__(self, level):
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data):
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self._brotli = brotli.Compressor(quality=quality)
+
+    def chunk(self, data):
+        return self._brotli.process(data) + self._brotli.flush()
+
+    def finish(self):
+        return self._brotli.finish()
+
+
+class Compressor:
+    """WSGI middleware compressing response bodies as they are produced."""
+
+    def __init__(self, app, min_size=DEFAULT_MIN_SIZE, gzip_level=DEFAULT_GZIP_LEVEL,
+                 brotli_quality=DEFAULT_BROTLI_QUALITY):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def __call__(self, environ, start_response):
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            # Headers go out once it is known whether the body is compressed
+            response[:] = [status, headers, exc_info]
+            return self._no_write
+
+        body = self.app(environ, capture)
+        status, headers, exc_info = response
+        if not self._compressible(status, headers):
+            start_response(status, headers, exc_info)
+            return body
+        headers = [(name, value) for name, value in headers if name.lower() != "vary"] \
+            + [("Vary", self._vary(headers))]
+        encoding = negotiate(environ.get("HTTP_ACCEPT_ENCODING"))
+        length = _header(headers, "Content-Length")
+        if (encoding is None or environ["REQUEST_METHOD"] == "HEAD" or "HTTP_RANGE" in environ
+                or (length is not None and int(length) < self.min_size)):
+            start_response(status, headers, exc_info)
+            return body
+        return self._compress(environ, start_response, status, headers, body, encoding)
+
+    @staticmethod
+    def _no_write(data):
+        raise RuntimeError("Compressor does not support the WSGI write() callable")
+
+    @staticmethod
+    def _compressible(status, headers):
+        if not status.startswith("200") or _header(headers, "Content-Encoding"):
+            return False
+        if "no-transform" in (_header(headers, "Cache-Control") or ""):
+            return False
+        content_type = (_header(headers, "Content-Type") or "").lower()
+        return bool(content_type) and not content_type.startswith(SKIP_TYPES)
+
+    @staticmethod
+    def _vary(headers):
+        values = [value.strip() for name, value in headers if name.lower() == "vary"
+                  for value in value.split(",") if value.strip()]
+        if not any(value.lower() == "accept-encoding" for value in values):
+            values.append("Accept-Encoding")
+        return ", ".join(values)
+
+    def _compress(self, environ, start_response, status, headers, body, encoding):
+        # Hold back the first bytes until there are min_size of them (or the
+        # body ends): only then is it known whether compressing is worth it
+        try:
+            pending, size = [], 0
+            iterator = iter(body)
+            for data in iterator:
+                pending.append(data)
+                size += len(data)
+                if size >= self.min_size:
+                    break
+            else:
+                start_response(status, headers)
+                yield b"".join(pending)
+                return
+
+            encoded = [(name, value) for name, value in headers
+                       if name.lower() not in ("content-length", "etag")]
+            etag = _header(headers, "ETag")
+            if etag:
+                # The validator names the identity bytes; keep it as a weak one
+                encoded.append(("ETag", etag if etag.startswith("W/") else "W/" + etag))
+            encoded.append(("Content-Encoding", encoding))
+            start_response(status, encoded)
+
+            compressor = _Brotli(self.brotli_quality) if encoding == "br" else _Gzip(self.gzip_level)
+            sent = size
+            yield compressor.chunk(b"".join(pending))
+            for data in iterator:
+                if data:
+                    sent += len(data)
+                    yield compressor.chunk(data)
+            yield compressor.finish()
+            metrics.get_registry().uncompressed_bytes.inc(
+                sent, environ.get(metrics.ROUTE_KEY, "unmatched"), encoding)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def init_app(app):
+    """Compress responses; install before metrics.init_app() so that
+    /metrics counts the bytes actually sent."""
+    app.config.setdefault("STREAM_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+    app.config.setdefault("COMPRESS_MIN_SIZE", DEFAULT_MIN_SIZE)
+    app.config.setdefault("COMPRESS_GZIP_LEVEL", DEFAULT_GZIP_LEVEL)
+    app.config.setdefault("COMPRESS_BROTLI_QUALITY", DEFAULT_BROTLI_QUALITY)
+    app.wsgi_app = Compressor(app.wsgi_app, min_size=app.config["COMPRESS_MIN_SIZE"],
+                              gzip_level=app.config["COMPRESS_GZIP_LEVEL"],
+                              brotli_quality=app.config["COMPRESS_BROTLI_QUALITY"])
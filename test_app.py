@@ -1,20 +1,312 @@
+import base64
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
 from flask import Flask
 from models import db
+import database
+import inbox
+import migrations
+import passwords
+import writer
+from pagination import decode_cursor, decode_token, encode_cursor, encode_token
 from routes.auth import auth_routes
 from routes.products import product_routes
 
 app = Flask(__name__)
 app.secret_key = "supersecret123"  # ✅ Enables session support
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///users.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
-db.init_app(app)
 app.register_blueprint(auth_routes)
 app.register_blueprint(product_routes)
 
-with app.app_context():
-    db.create_all()
+
+# Behaviour tests (pytest). They run against the full app in app.py, on a
+# temporary database; the app above is only the dev server below.
+
+def raw_token(values):
+    # A token as a client could craft it, bypassing encode_token()
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+@pytest.fixture(scope="module")
+def marketplace(tmp_path_factory):
+    # One app per test process: the writer, event hub and caches are
+    # per-process singletons
+    from app import create_app
+
+    path = tmp_path_factory.mktemp("marketplace")
+    marketplace = create_app({
+        "TESTING": True,
+        "DATABASE": str(path / "marketplace.db"),
+        "ARCHIVE_DATABASE": str(path / "marketplace-archive.db"),
+        "EVENTS_DATABASE": str(path / "events.db"),
+        "UPLOAD_PATH": str(path / "uploads"),
+        "MAINTENANCE_INTERVAL_SECONDS": 0,
+        "SIMILAR_REFRESH_SECONDS": 0,
+    })
+    client = marketplace.test_client()
+    for username in ("alice", "bob"):
+        client.post("/register", data={"username": username, "email": f"{username}@example.com",
+                                       "password": "pw"})
+    login(client, "bob")
+    client.post("/add", data={"product_name": "Desk lamp", "price": "15", "category": "Home",
+                              "location": "Scott Library", "description": "Bright"})
+    client.post("/logout")
+    return marketplace
+
+
+def login(client, username):
+    client.post("/login", data={"email": f"{username}@example.com", "password": "pw"})
+
+
+@pytest.fixture(scope="module")
+def alice(marketplace):
+    # Signed in once: logins are rate-limited
+    client = marketplace.test_client()
+    login(client, "alice")
+    return client
+
+
+@pytest.mark.parametrize("sort_option, row, key", [
+    (None, {"id": 7}, None),
+    ("newest", {"id": 7, "timestamp": "2025-06-01T14:00:00"}, "2025-06-01T14:00:00"),
+    ("newest", {"id": 7, "timestamp": None}, ""),
+    ("price_asc", {"id": 7, "price": 12.5}, 12.5),
+    ("price_desc", {"id": 7, "price": 3}, 3),
+    ("category", {"id": 7, "category": "Books"}, "Books"),
+    ("relevance", {"id": 7, "score": -1.25}, -1.25),
+    ("nearest", {"id": 7, "distance": 0.4}, 0.4),
+])
+def test_cursor_round_trip(sort_option, row, key):
+    assert decode_cursor(encode_cursor(sort_option, row), sort_option) == (key, 7)
+
+
+@pytest.mark.parametrize("token, sort_option", [
+    (None, None),
+    ("not base64!", None),
+    (raw_token({"a": 1}), None),
+    (raw_token(["", None]), None),
+    (raw_token(["", [1], 5]), None),
+    (raw_token(["newest", {"a": 1}, 5]), "newest"),
+    (raw_token(["nearest", [1], 5]), "nearest"),
+    (raw_token(["price_asc", "12", 5]), "price_asc"),
+    (raw_token(["newest", 3, 5]), "newest"),
+    (raw_token(["", None, "5"]), None),
+    (raw_token(["", None, True]), None),
+    (raw_token(["newest", "2025", 5]), "price_asc"),
+    ("WyJwcmljZV9hc2MiLE5hTiw1XQ", "price_asc"),  # ["price_asc",NaN,5]
+])
+def test_bad_cursors_are_ignored(token, sort_option):
+    assert decode_cursor(token, sort_option) is None
+
+
+def test_tokens_hold_only_scalars():
+    assert decode_token(encode_token(["archived", None, 3]), 3) == ["archived", None, 3]
+    assert decode_token(raw_token([[1], 2]), 2) is None
+    assert decode_token(raw_token([{"x": 1}, 2]), 2) is None
+
+
+def test_inbox_positions():
+    assert inbox.decode_position(encode_token(["2025-06-01T14:00:00", 3])) == ["2025-06-01T14:00:00", 3]
+    for values in ([[1], 2], ["2025", "3"], [None, 3], ["2025", 3.5], ["2025"]):
+        assert inbox.decode_position(raw_token(values)) is None
+
+
+@pytest.mark.parametrize("url", [
+    "/items?after=" + raw_token(["", [1], 5]),
+    "/items?sort=newest&after=" + raw_token(["newest", {"a": 1}, 5]),
+    "/items?near=0,0&sort=nearest&after=" + raw_token(["nearest", [1], 5]),
+    "/api/v1/items?after=" + raw_token(["", [1], 5]),
+    "/api/v1/items?sort=price_asc&before=" + raw_token(["price_asc", {"a": 1}, 5]),
+    "/inbox?before=" + raw_token([[1], 2]),
+    "/inbox/archived?before=" + raw_token([[1], 2]),
+    "/inbox/thread/1/2?before=" + raw_token([{"x": 1}, 2]),
+    "/inbox/thread/1/2?before=" + raw_token(["archived", [1], 2]),
+    "/api/v1/threads?before=" + raw_token([[1], 2]),
+    "/api/v1/threads/1/2?before=" + raw_token([{"x": 1}, 2]),
+])
+def test_bad_tokens_serve_the_first_page(alice, url):
+    response = alice.get(url)
+    response.get_data()
+    assert response.status_code == 200
+
+
+def test_listing_pages_follow_cursors(alice):
+    first = alice.get("/api/v1/items?limit=1&sort=price_asc").get_json()
+    assert len(first["items"]) == 1
+    if first["next"]:
+        second = alice.get(f"/api/v1/items?limit=1&sort=price_asc&after={first['next']}").get_json()
+        assert second["items"][0]["id"] != first["items"][0]["id"]
+
+
+def test_api_answers_304_when_unchanged(alice):
+    page = alice.get("/api/v1/items")
+    assert page.status_code == 200 and page.headers["ETag"]
+    again = alice.get("/api/v1/items", headers={"If-None-Match": page.headers["ETag"]})
+    assert again.status_code == 304 and not again.get_data()
+
+    item_id = page.get_json()["items"][0]["id"]
+    item = alice.get(f"/api/v1/items/{item_id}")
+    assert item.headers["Last-Modified"]
+    assert alice.get(f"/api/v1/items/{item_id}",
+                     headers={"If-None-Match": item.headers["ETag"]}).status_code == 304
+    assert alice.get(f"/api/v1/items/{item_id}",
+                     headers={"If-Modified-Since": item.headers["Last-Modified"]}).status_code == 304
+    batch = alice.get(f"/api/v1/items?ids={item_id}")
+    assert alice.get(f"/api/v1/items?ids={item_id}",
+                     headers={"If-None-Match": batch.headers["ETag"]}).status_code == 304
+
+    threads = alice.get("/api/v1/threads")
+    assert alice.get("/api/v1/threads",
+                     headers={"If-None-Match": threads.headers["ETag"]}).status_code == 304
+
+    # A new message changes the thread list
+    sent = alice.post("/api/v1/messages", json={"messages": [{"item_id": item_id, "content": "Still there?"}]})
+    assert sent.status_code == 201
+    assert alice.get("/api/v1/threads",
+                     headers={"If-None-Match": threads.headers["ETag"]}).status_code == 200
+
+
+def test_api_needs_a_session(marketplace):
+    assert marketplace.test_client().get("/api/v1/items").status_code == 401
+
+
+def legacy_database(path):
+    # marketplace.db as it was before migrations.py: usernames only, and
+    # SQLite's CURRENT_TIMESTAMP format on older messages
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_name TEXT NOT NULL,
+            price REAL NOT NULL,
+            category TEXT, image_url TEXT, seller TEXT, location TEXT, description TEXT,
+            timestamp TEXT
+        );
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            item_id INTEGER,
+            content TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            read INTEGER DEFAULT 0
+        );
+        INSERT INTO products (product_name, price, category, seller) VALUES ('Desk lamp', 15, 'Home', 'bob');
+    """)
+    return conn
+
+
+def test_migrating_a_legacy_database_keeps_inquiries(tmp_path):
+    path = str(tmp_path / "marketplace.db")
+    conn = legacy_database(path)
+    now = datetime.now()
+    for hours in range(6):
+        when = now - timedelta(hours=hours)
+        timestamp = when.isoformat() if hours % 2 else when.strftime("%Y-%m-%d %H:%M:%S")
+        conn.execute("INSERT INTO messages (sender, receiver, item_id, content, timestamp) "
+                     "VALUES ('alice', 'bob', 1, 'Still there?', ?)", (timestamp,))
+    # The seller's replies are not inquiries
+    conn.execute("INSERT INTO messages (sender, receiver, item_id, content, timestamp) "
+                 "VALUES ('bob', 'alice', 1, 'Yes', ?)", (now.isoformat(),))
+    conn.commit()
+    conn.close()
+
+    migrations.migrate(path)
+
+    conn = sqlite3.connect(path)
+    try:
+        daily = conn.execute("SELECT bucket, SUM(inquiries) FROM analytics_daily GROUP BY 1").fetchall()
+        hourly = conn.execute("SELECT bucket, inquiries FROM analytics_hourly ORDER BY 1").fetchall()
+        seller = conn.execute("SELECT seller_id FROM products").fetchone()[0]
+        owners = {row[0] for row in conn.execute("SELECT seller_id FROM analytics_daily")}
+    finally:
+        conn.close()
+    assert sum(count for _, count in daily) == 6
+    assert [count for _, count in hourly] == [1] * 6
+    assert all("T" in bucket and len(bucket) == 13 for bucket, _ in hourly)
+    assert owners == {seller}
+
+
+def test_migrating_twice_changes_nothing(tmp_path):
+    path = str(tmp_path / "marketplace.db")
+    legacy_database(path).close()
+    migrations.migrate(path)
+    assert migrations.migrate(path) == []
+
+
+@pytest.fixture
+def message_writer(tmp_path):
+    # A writer on a table of its own; batches are committed by calling
+    # _commit() directly, so their make-up does not depend on timing
+    path = str(tmp_path / "writes.db")
+    sqlite3.connect(path).execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, text TEXT)")
+    group_writer = writer.GroupCommitWriter(path)
+    conn = group_writer._connect()
+    yield group_writer, conn
+    conn.close()
+
+
+def jobs(group_writer, *work):
+    # Jobs as submit() queues them, each holding a queue slot
+    batch = []
+    for function, *args in work:
+        group_writer._slots.acquire()
+        batch.append(writer.Job(function, args))
+    return batch
+
+
+def add_note(conn, text):
+    return conn.execute("INSERT INTO notes (text) VALUES (?)", (text,)).lastrowid
+
+
+def fail(conn):
+    raise ValueError("bad note")
+
+
+def notes(conn):
+    return [row[0] for row in conn.execute("SELECT text FROM notes ORDER BY id")]
+
+
+def test_writer_fails_only_the_failing_job(message_writer):
+    group_writer, conn = message_writer
+    batch = jobs(group_writer, (add_note, "a"), (fail,), (add_note, "b"))
+    group_writer._commit(conn, batch)
+
+    assert notes(conn) == ["a", "b"]
+    assert [job.error is None for job in batch] == [True, False, True]
+    assert isinstance(batch[1].error, ValueError)
+    assert batch[0].result and batch[2].result
+    assert group_writer.stats()["writes"] == 2
+
+
+def test_writer_keeps_results_committed_before_a_database_error(message_writer):
+    group_writer, conn = message_writer
+
+    def end_transaction(conn):
+        # The COMMIT after this job fails: no transaction is open
+        conn.execute("ROLLBACK")
+
+    batch = jobs(group_writer, (add_note, "a"), (fail,), (end_transaction,), (add_note, "b"))
+    group_writer._commit(conn, batch)
+
+    # "a" was committed by the replay before the error and keeps its result
+    assert notes(conn) == ["a"]
+    assert batch[0].error is None and batch[0].result
+    assert isinstance(batch[1].error, ValueError)
+    assert isinstance(batch[2].error, sqlite3.Error)
+    assert isinstance(batch[3].error, sqlite3.Error)
+    assert not conn.in_transaction
+
 
 if __name__ == "__main__":
+    # Same marketplace.db and schema as app.py. Set up only when run, so
+    # that collecting this file (pytest) never migrates the database
+    database.init_app(app, db)
+    passwords.init_app(app)
+    migrations.migrate(app.config["DATABASE"])
     app.run(debug=True, port=5001)
@@ -1,15 +1,8 @@
-import sqlite3
+from migrations import migrate
 
-# Connect to your existing database
-conn = sqlite3.connect("marketplace.db")
-cursor = conn.cursor()
-
-# Add 'category' column if it doesn't exist
-try:
-    cursor.execute("ALTER TABLE products ADD COLUMN category TEXT")
-    print("✅ 'category' column added successfully.")
-except sqlite3.OperationalError as e:
-    print("⚠️ Column may already exist or error occurred:", e)
-
-conn.commit()
-conn.close()
+# Columns are now added by the versioned migrations in migrations.py.
+applied = migrate("marketplace.db")
+if applied:
+    print("✅ Applied migrations:", ", ".join(str(v) for v in applied))
+else:
+    print("ℹ️ Schema already up to date.")
@@ -1,13 +1,8 @@
-import sqlite3
+from migrations import migrate
 
-conn = sqlite3.connect("marketplace.db")
-cursor = conn.cursor()
-
-try:
-    cursor.execute("ALTER TABLE products ADD COLUMN image_url TEXT")
-    print("✅ 'image_url' column added successfully.")
-except sqlite3.OperationalError as e:
-    print("⚠️ Column may already exist or error occurred:", e)
-
-conn.commit()
-conn.close()
+# Columns are now added by the versioned migrations in migrations.py.
+applied = migrate("marketplace.db")
+if applied:
+    print("✅ Applied migrations:", ", ".join(str(v) for v in applied))
+else:
+    print("ℹ️ Schema already up to date.")
@@ -0,0 +1,240 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from flask import current_app
+
+import messaging
+
+# Group commit for message sends and read-marks.
+# Each request used to commit its own message on its pooled connection, so
+# under chat-heavy traffic the request threads queued on SQLite's write
+# lock (sleeping in the busy handler) and paid one commit each. Instead,
+# one writer thread per worker process owns a dedicated connection and a
+# queue:
+#   - it takes whatever is queued, optionally waits MESSAGE_WRITE_WINDOW_MS
+#     for more (at most MESSAGE_WRITE_BATCH jobs), and runs the batch in one
+#     BEGIN IMMEDIATE ... COMMIT; if a job raises, the batch is rolled back
+#     and replayed one job per transaction, so only that caller gets the
+#     error. The window defaults to 0: writes that arrive while a commit is
+#     running already form the next batch, and waiting longer only adds
+#     latency, since every caller is blocked until its write is committed
+#     (see benchmarks/messages.py);
+#   - the connection uses synchronous=FULL, so when submit() returns, the
+#     write is durable (one fsync per batch, not per message);
+#   - the queue holds at most MESSAGE_WRITE_QUEUE jobs; past that, or when
+#     a job is not committed within MESSAGE_WRITE_TIMEOUT, callers get
+#     Busy (HTTP 503 + Retry-After). A timed-out job may still be committed.
+# Callers must not hold an open write transaction on their own connection
+# while they wait, or the writer waits for them in turn.
+
+DEFAULT_WINDOW_MS = 0
+DEFAULT_BATCH = 256
+DEFAULT_QUEUE = 1024
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRY_AFTER = 1
+
+
+class Busy(Exception):
+    def __init__(self, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__("The message writer is overloaded")
+        self.retry_after = retry_after
+
+
+class Job:
+    __slots__ = ("work", "args", "done", "result", "error")
+
+    def __init__(self, work, args):
+        self.work = work
+        self.args = args
+        # Held until the job is committed (cheaper than an Event)
+        self.done = threading.Lock()
+        self.done.acquire()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitWriter:
+    def __init__(self, path, window_ms=DEFAULT_WINDOW_MS, max_batch=DEFAULT_BATCH,
+                 queue_size=DEFAULT_QUEUE, timeout=DEFAULT_TIMEOUT, busy_timeout_ms=5000):
+        self.path = path
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self._queue = queue.SimpleQueue()
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.failures = 0
+        self.rejected = 0
+        thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        thread.start()
+
+    def submit(self, work, *args):
+        """Run work(conn, *args) in the next group commit; returns its result once durable."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Busy()
+        job = Job(work, args)
+        self._queue.put(job)
+        if not job.done.acquire(timeout=self.timeout):
+            with self._lock:
+                self.rejected += 1
+            raise Busy()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _connect(self):
+        # Autocommit mode: _commit() issues BEGIN/COMMIT itself
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+        conn.executescript(f"""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=FULL;
+            PRAGMA busy_timeout={int(self.busy_timeout_ms)};
+        """)
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        # Jobs not committed yet; on a database error these, and only
+        # these, get the error
+        pending = list(batch)
+        try:
+            if self._transaction(conn, batch):
+                pending = []
+            else:
+                # A job failed: redo the batch one job per transaction, so
+                # only that job's caller sees the error
+                for job in batch:
+                    job.result = job.error = None
+                while pending:
+                    self._transaction(conn, pending[:1])
+                    pending.pop(0)
+        except sqlite3.Error as e:
+            print("Message writer error:", e)
+            for job in pending:
+                job.result, job.error = None, job.error or e
+            with self._lock:
+                self.failures += 1
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        finally:
+            with self._lock:
+                self.writes += sum(job.error is None for job in batch)
+                if len(pending) < len(batch):
+                    self.batches += 1
+                self.largest_batch = max(self.largest_batch, len(batch))
+            for job in batch:
+                job.done.release()
+                self._slots.release()
+
+    def _transaction(self, conn, jobs):
+        # Run `jobs` in one transaction; commits and returns True unless one
+        # of them raises, in which case everything is rolled back
+        conn.execute("BEGIN IMMEDIATE")
+        for job in jobs:
+            try:
+                job.result = job.work(conn, *job.args)
+            except Exception as e:
+                job.error = e
+                conn.execute("ROLLBACK")
+                return False
+        conn.execute("COMMIT")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "writes": self.writes,
+                "batches": self.batches,
+                "largest_batch": self.largest_batch,
+                "failures": self.failures,
+                "rejected": self.rejected,
+            }
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(app=None):
+    # One writer thread per worker process, started after the fork
+    app = app or current_app
+    key = os.getpid()
+    writer = _writers.get(key)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(key)
+            if writer is None:
+                config = app.config
+                writer = GroupCommitWriter(
+                    config["DATABASE"],
+                    window_ms=config["MESSAGE_WRITE_WINDOW_MS"],
+                    max_batch=config["MESSAGE_WRITE_BATCH"],
+                    queue_size=config["MESSAGE_WRITE_QUEUE"],
+                    timeout=config["MESSAGE_WRITE_TIMEOUT"],
+                    busy_timeout_ms=config.get("DB_BUSY_TIMEOUT_MS", 5000),
+                )
+                _writers[key] = writer
+    return writer
+
+
+def send_message(item_id, sender_id, receiver_id, content, timestamp):
+    """messaging.send() in the next group commit; returns the message id once durable."""
+    return get_writer().submit(messaging.send, item_id, sender_id, receiver_id, content, timestamp)
+
+
+def send_messages(messages):
+    """messaging.send_many() as one job of the next group commit: all of the
+    (item_id, sender_id, receiver_id, content, timestamp) messages are
+    stored, or none. Returns their ids once durable."""
+    return get_writer().submit(messaging.send_many, messages)
+
+
+def mark_read(user_id, threads):
+    """messaging.mark_read() in the next group commit; returns the threads updated.
+
+    Threads with nothing unread never reach the writer.
+    """
+    threads = [thread for thread in threads if thread[2]]
+    if not threads:
+        return 0
+    return get_writer().submit(messaging.mark_read, user_id, threads)
+
+
+def init_app(app):
+    app.config.setdefault("MESSAGE_WRITE_WINDOW_MS", DEFAULT_WINDOW_MS)
+    app.config.setdefault("MESSAGE_WRITE_BATCH", DEFAULT_BATCH)
+    app.config.setdefault("MESSAGE_WRITE_QUEUE", DEFAULT_QUEUE)
+    app.config.setdefault("MESSAGE_WRITE_TIMEOUT", DEFAULT_TIMEOUT)
+
+    @app.errorhandler(Busy)
+    def busy(e):
+        return ("The server is busy. Please try again shortly.", 503,
+                {"Retry-After": str(e.retry_after)})